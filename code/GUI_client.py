@@ -8,7 +8,11 @@ import tkinter as tk
 from tkinter.ttk import Progressbar
 
 # Client code
-from client import SendSettings, ReceiveSpecData
+from client import SendSettings, ReceiveSpecData, SpecSession, SpecStream
+from recorder import RunRecorder, RunReader
+from exporter import export_run, Y_MARGIN
+from control import ControlError
+from metrics import timed
 
 # For plotting in GUI
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
@@ -17,7 +21,12 @@ import matplotlib.pyplot as plt
 
 # uhh Other stuff
 import numpy as np
-import gc
+import threading
+import queue
+
+# Milliseconds between redraws (about 60 per second). Frames are received on the stream's thread,
+# so redrawing any faster only takes the GIL away from it
+REDRAW_INTERVAL = 16
 
 
 class SpecApp(tk.Frame, SendSettings, ReceiveSpecData):
@@ -50,9 +59,16 @@ class SpecApp(tk.Frame, SendSettings, ReceiveSpecData):
         self.pack()
 
         # Initializing some things
-        self.spec_list = []
+        # Every received spectrum is streamed to disk by a RunRecorder, made for the first frame of each run
+        self.recorder = None
+        self.recorder_lock = threading.Lock()
+        self.run_settings = (None, None)
         self.file_number = 0
         self.save_bool = True
+        # Finished runs are exported by a worker thread, which reports its progress to the Tk thread
+        self.save_jobs = queue.Queue()
+        self.save_progress = queue.Queue()
+        self.save_thread = None
 
         # tells program that there is no re-entry yet
         self.re_entry = False
@@ -65,7 +81,8 @@ class SpecApp(tk.Frame, SendSettings, ReceiveSpecData):
         int_entry = self.create_entry("Integration Time (\u03BCs)", default=4000, pady=(5, 0))
         ip_entry = self.create_entry("Server IP", default='127.0.0.1', pady=(5, 0))
         port_entry = self.create_entry("Server Port", default=5004, pady=(5, 0))
-        self.setting_entries = [trig_entry, int_entry, ip_entry, port_entry]
+        multicast_entry = self.create_entry("Multicast Group:Port", default='', pady=(5, 0))
+        self.setting_entries = [trig_entry, int_entry, ip_entry, port_entry, multicast_entry]
         
         # Creates all the buttons
         # self.create_button("Start Only\nData Collection", self.collect_only_data, location=TOP, pady=(10, 5), width=15)
@@ -77,6 +94,7 @@ class SpecApp(tk.Frame, SendSettings, ReceiveSpecData):
         self.create_progress_bar()
         # Creates the percentage under the progress bar.
         self.progress_label = self.create_label(text='0%')
+        self.root.after(100, self.poll_save_progress)
         # Creates notes.
         self.create_text(
                 "------------- Notes ------------\n" +
@@ -97,12 +115,50 @@ class SpecApp(tk.Frame, SendSettings, ReceiveSpecData):
         '''Creates and packs embedded plot.'''
         self.fig = plt.Figure()
         self.ax = self.fig.add_subplot(111)
-        self.ax.set_xlabel("Wavelengths")
-        self.ax.set_ylabel("Intensities")
-        self.ax.set_title("Spectrum")
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.root)
         self.canvas.get_tk_widget().pack(side=tk.RIGHT, fill=tk.BOTH, expand=1, pady=20, padx=(0, 10))
-        self.ax.plot()
+        self.reset_plot()
+
+    def reset_plot(self):
+        '''Sets up the labels and the one line that every live spectrum is drawn with.
+
+        The line is animated, so full redraws leave it out and `animate` blits it on top of the
+        cached background instead.
+        '''
+        self.ax.cla()
+        self.ax.set_xlabel("Wavelengths")
+        self.ax.set_ylabel("Intensities")
+        self.ax.set_title("Spectrums")
+        self.line, = self.ax.plot([], [], animated=True)
+
+    def update_limits(self, spec):
+        '''Rescales the axes if the spectrum no longer fits them.
+
+        The limits only change when the wavelengths change, the intensities leave the axes or
+        shrink to less than half of them, so most frames need no full redraw.
+
+        Parameters
+        ----------
+        spec: <numpy.ndarray>
+            In the form `np.array([[wavelengths], [intensities]])`.
+
+        Returns
+        -------
+        changed: <bool>
+            True if the limits changed and the figure has to be redrawn.
+        '''
+        changed = False
+        if not np.array_equal(spec[0], self.line.get_xdata()):
+            self.line.set_xdata(spec[0])
+            self.ax.set_xlim(spec[0][0], spec[0][-1])
+            changed = True
+        low, high = self.ax.get_ylim()
+        y_min, y_max = spec[1].min(), spec[1].max()
+        if changed or y_min < low or y_max > high or (y_max - y_min) < (high - low) / 2:
+            margin = max(y_max - y_min, 1) * Y_MARGIN
+            self.ax.set_ylim(y_min - margin, y_max + margin)
+            changed = True
+        return changed
 
     def create_entry(self, entry : str, default='', pady=0) -> tk.Entry:
         '''Creates an entry for an `int` variable.
@@ -160,41 +216,61 @@ class SpecApp(tk.Frame, SendSettings, ReceiveSpecData):
         text.config(fg='#fff', bg='#345')
 
     def save_spectrum_files(self):
-        '''Saves both npz and mp4 files.'''
+        '''Finishes the recorded run and exports it as an mp4 file in the background.
+
+        The next frame already starts a new run, so acquisition and display never stop. The
+        finished run belongs to the save worker from here on, and runs are exported one after
+        another in the order they were saved.
+        '''
+        with self.recorder_lock:
+            recorder, self.recorder = self.recorder, None
+            file_number = self.file_number
+            self.file_number += 1
+        if recorder is None:
+            return
         self.save_bool = False
-        self.ani.event_source.stop()
-        d = SaveData(self.file_number)
-        # Saves the data as numpy array.
-        d.save_data(self.spec_list)
-        npzfiles = d.load_data()
-
-        amount_of_spectra = len(npzfiles['arr_0'])
-
-        # annoying to take this out of save_spectrum_files method so it's staying for now
-        def animate_for_saving(i):
-            '''Re-creates animation with saved data and updates progress bar.'''
-            wavelengths = npzfiles['arr_0'][0][0]
-            intensities = npzfiles['arr_0'][i][1]
-
-            self.ax.cla()
-            self.ax.set_xlabel("Wavelengths")
-            self.ax.set_ylabel("Intensities")
-            self.ax.set_title("Spectrum {} / {}".format(i+1, amount_of_spectra))
-            self.ax.plot(wavelengths, intensities)
-
-            percentage = (i + 1) / len(npzfiles['arr_0']) * 100
+        self.save_jobs.put((file_number, recorder))
+        if self.save_thread is None:
+            self.save_thread = threading.Thread(target=self.save_worker, name="SaveWorker", daemon=True)
+            self.save_thread.start()
+
+    def save_worker(self):
+        '''Closes and exports finished runs. Runs on the save thread, so it never touches Tk.'''
+        while True:
+            file_number, recorder = self.save_jobs.get()
+            try:
+                recorder.close()
+                SaveData(file_number).export_animation(
+                    progress=lambda written, total: self.save_progress.put((file_number, written, total)))
+                self.save_progress.put((file_number, None, None))
+            except Exception as e:
+                self.save_progress.put((file_number, e, None))
+            finally:
+                self.save_jobs.task_done()
+
+    def poll_save_progress(self):
+        '''Shows the progress of the save worker on the progress bar, every 100 ms on the Tk thread.'''
+        message = None
+        while True:
+            try:
+                message = self.save_progress.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(message[1], Exception):
+                print("Saving run {} failed: {!r}".format(message[0], message[1]))
+        if message is not None:
+            file_number, written, total = message
+            if written is None:
+                percentage, text = 100, "Saved run {}".format(file_number)
+            elif isinstance(written, Exception):
+                percentage, text = 0, "Saving run {} failed".format(file_number)
+            else:
+                percentage = written / total * 100
+                text = "Run {}: {:.1f}%".format(file_number, percentage)
             self.progress['value'] = percentage
-            self.progress_label.set("{:.1f}%".format(percentage))
-            self.root.update_idletasks()
-        
-            gc.collect()
-
-        d.save_animation_file(self.fig, animate_for_saving, amount_of_spectra)
-        self.spec_list.clear()
-
-        self.file_number += 1
-        self.save_bool = True
-        self.ani.event_source.start()
+            self.progress_label.set(text)
+        self.save_bool = self.save_jobs.unfinished_tasks == 0
+        self.root.after(100, self.poll_save_progress)
 
     def save_settings(self):
         '''Stores user's inputs into a list and uses those inputs to send and receive data, which
@@ -210,11 +286,20 @@ class SpecApp(tk.Frame, SendSettings, ReceiveSpecData):
         trig_val = int(setting_list[0])
         self.int_time_micros = int(setting_list[1])
         self.server_address = (setting_list[2], int(setting_list[3]))
+        multicast_group = None
+        if setting_list[4]:
+            group, group_port = setting_list[4].split(':')
+            multicast_group = (group, int(group_port))
 
-        self.send_settings_from_gui(self.server_address, trig_val, self.int_time_micros)
+        self.send_settings_from_gui(self.server_address, trig_val, self.int_time_micros, multicast_group)
 
-    def send_settings_from_gui(self, server_address, trig_val, int_time_micros):
-        '''Sends settings from GUI using methods from SendSettings
+    def send_settings_from_gui(self, server_address, trig_val, int_time_micros, multicast_group=None):
+        '''Sends the settings from the GUI, opening a `SpecSession` if needed.
+
+        If a session to the same server is already open, its settings are changed in place.
+        Otherwise the old session is closed first so the server never streams to an old port.
+        A `SpecStream` receives the session's frames on a worker thread, so the GUI never waits
+        on the network.
         
         Parameters
         ----------
@@ -228,23 +313,37 @@ class SpecApp(tk.Frame, SendSettings, ReceiveSpecData):
                 edge/hardware = 3
         int_time_micros: <int>
             Integration time in microseconds.
+        multicast_group: <tuple>
+            (group, port) to receive the server's multicast stream on, None to get frames unicast.
         '''
-        self.s = SendSettings(server_address, trig_val, int_time_micros)
-        self.s.send_settings()
-        self.client_port = self.s.get_port()
+        with self.recorder_lock:
+            self.run_settings = (trig_val, int_time_micros)
+        if self.re_entry == True:
+            if (self.session.control.server_address == server_address
+                    and self.session.multicast_group == multicast_group):
+                try:
+                    self.session.update_settings(trig_val, int_time_micros)
+                except (TimeoutError, ControlError) as e:
+                    print("Settings were not applied: {}".format(e))
+                return
+            self.stream.stop()
+            self.session.close()
+        # The session's sockets stay open for the whole stream.
+        self.session = SpecSession(server_address, trig_val, int_time_micros,
+                                   multicast_group=multicast_group, timeout=0.5)
+        self.session.open()
+        self.stream = SpecStream(self.session, on_frame=self.record_frame)
+        self.stream.start()
 
     def display_animation(self):
         '''Creates the animation.'''
         self.save_settings()
-        # Initializing class that receives spectrum data.
-        self.r = ReceiveSpecData()
 
         # Creates animation
-        interval = self.int_time_micros / 1000
         self.ani = FuncAnimation(self.fig, 
                             self.animate, 
-                            fargs=(self.s, self.r, self.server_address, self.client_port,), 
-                            interval=0,
+                            interval=REDRAW_INTERVAL,
+                            blit=True,
                             cache_frame_data=False)
 
         self.canvas.draw()
@@ -267,73 +366,72 @@ class SpecApp(tk.Frame, SendSettings, ReceiveSpecData):
 
         self.re_entry = True
 
-    def animate(self, i, send, receive, server_address, client_port):
+    @timed('animate')
+    def animate(self, i):
         '''Continuously receives data from server and plots it.
         
-        Used to animate spectrum received from spectrometer. Uses methods from the `SendSettings` and
-        `ReceiveSpecData` classes. Every time the method loops around, it sends zero bytes to the server to indicate
-        that it should continue sending data.
+        Used to animate spectrum received from spectrometer. Shows the newest spectrum from the
+        `SpecStream` started by `send_settings_from_gui`, whose thread receives (and records) every
+        frame however fast this is called.
+
+        Only the line is redrawn (blitted) for each spectrum. The whole figure is only redrawn
+        when the axes have to be rescaled.
 
         Parameters
         ----------
         i: <int>
             Needed for FuncAnimation.
-        send: <class 'SendSettings'>
-            class from client.py that sends spectrometer settings.
-        receive: <class 'ReceiveSpecData'>
-            class from client.py that receives spectrum data.
-        server_address: <list>
-            List in the form of [IP, port]. The IP and port are the server's IP and port.
-        client_port: <int>
-            This is the port that the client has been assigned (after sending something) to receive data.
-
-        Notes
-        -----
-        Having `send` and `receive` as parameters is really odd but I haven't found a solution to it yet.
+
+        Returns
+        -------
+        artists: <tuple>
+            Artists that FuncAnimation blits.
         '''
-        spec = self.receive_data_for_gui(send, receive, server_address, client_port)
-        # Clearing and then plotting
-        self.ax.cla()
-        self.ax.set_xlabel("Wavelengths")
-        self.ax.set_ylabel("Intensities")
-        self.ax.set_title("Spectrums")
-        self.ax.plot(spec[0], spec[1])
-        gc.collect()
+        spec = self.receive_data_for_gui()
+        if spec is None:
+            return self.line,
+        if self.update_limits(spec):
+            # New ticks and labels; FuncAnimation caches the new background after this
+            self.canvas.draw()
+        self.line.set_ydata(spec[1])
+        return self.line,
     
-    def receive_data_for_gui(self, send, receive, server_address, client_port):
-        '''Does all the receiving using methods from client.py.
-        
+    def receive_data_for_gui(self):
+        '''Takes the newest spectrum from the receiver thread, older ones are only recorded.
+
+        Returns
+        -------
+        spec: <numpy.ndarray> or None
+            In the form `np.array([[wavelengths], [intensities]])`, None if no new frame arrived.
+        '''
+        return self.stream.latest()
+
+    def record_frame(self, spec, frame):
+        '''Streams every received spectrum to the current run on disk. Called on the receiver thread.
+
         Parameters
         ----------
-        i: <int>
-            Needed for FuncAnimation.
-        send: <class 'SendSettings'>
-            class from client.py that sends spectrometer settings.
-        receive: <class 'ReceiveSpecData'>
-            class from client.py that receives spectrum data.
-        server_address: <list>
-            List in the form of [IP, port]. The IP and port are the server's IP and port.
-        client_port: <int>
-            This is the port that the client has been assigned (after sending something) to receive data.
-
-        Notes
-        -----
-        Having `send` and `receive` as parameters is really odd but I haven't found a solution to it yet.
+        spec: <numpy.ndarray>
+            In the form `np.array([[wavelengths], [intensities]])`.
+        frame: <class 'protocol.Frame'>
+            Header of the spectrum, e.g. its timestamp.
         '''
-        # Sends zero bytes to server so the server knows when to continue sending data.
-        send.send_zero_bytes()
-        receive.create_socket()
-
-        # Receiving data
-        receive.set_socket_receive()
-        receive.bind_socket(client_port, server_address)
-        receive.receive_data()
-        spec = receive.prepare_data()
-        self.spec_list.append(spec)
-        return spec
+        with self.recorder_lock:
+            if self.recorder is None:
+                self.recorder = RunRecorder(SaveData(self.file_number).file_name)
+            self.recorder.set_settings(*self.run_settings)
+            self.recorder.record(spec, frame)
 
     def _quit(self):
         '''Closes the window and stops the mainloop.'''
+        if self.re_entry == True:
+            self.stream.stop()
+            self.session.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if not self.save_bool:
+            print("Waiting for saves to finish...")
+            self.save_jobs.join()
         self.root.quit()     # stops mainloop
         self.root.destroy()
 
@@ -361,39 +459,22 @@ class SaveData:
         self.file_number = file_number
         self.file_name = 'C:/Users/orrk9/Code/spectrometer/servers/testing_saving copy 2/animations_and_npz/spectrums_run00{}'.format(file_number)
 
-    def save_data(self, spec):
-        '''Saves raw data of a spectrum in a .npz file.
-        
-        Parameters
-        ----------
-        spec: <numpy.array> or <list>
-            Spectrum that is being saved. 2D array or list.
+    def load_data(self):
+        '''Opens the run recorded by `recorder.RunRecorder` in the `file_name` directory.
+
+        Returns
+        -------
+        run: <class 'recorder.RunReader'>
+            Memory-mapped frames, `run[i]` are the intensities of frame i and `run.wavelengths` the wavelengths.
         '''
-        np.savez(self.file_name + ".npz", spec)
+        return RunReader(self.file_name)
 
-    def load_data(self):
-        '''Loads the .npz file.'''
-        npzfiles = np.load(self.file_name + ".npz")
-        npzfiles.files
-        return npzfiles
+    def export_animation(self, progress=None):
+        '''Renders the recorded run into an .mp4 file, see `exporter.export_run`.
 
-    def save_animation_file(self, fig, save_ani, amount_of_spectra):
-        '''Saves an animation of the saved spectrum data in .mp4 format.
-        
         Parameters
         ----------
-        fig: <class matplotlib.pyplot Figure>
-        save_ani: <class FuncAnimation>
-            Animation function that creates the data that you want to save.
-        amount_of_spectra: <int>
-             The number of spectra that is being saved (aka the amount of frames in your animation).
+        progress: <function>
+            Called with `(frames written, total frames)` after every frame.
         '''
-        ani_save = FuncAnimation(fig, 
-                            save_ani,
-                            cache_frame_data=False,
-                            frames=amount_of_spectra)
-
-        # Saves the animation as .mp4 file.
-        ani_save.save(self.file_name + ".mp4")
-
-        ani_save.event_source.stop
+        export_run(self.file_name, self.file_name + ".mp4", progress=progress)
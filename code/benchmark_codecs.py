@@ -0,0 +1,70 @@
+#
+# Compares the spectrum codecs from spec_codecs.py: bytes per frame and encode/decode time.
+# Run with: python benchmark_codecs.py --pixels 3648 --frames 500
+#
+
+from spec_codecs import SpecEncoder, SpecDecoder, CODECS
+from protocol import Frame, MSG_FRAME
+import numpy as np
+import argparse
+import time
+
+
+def synthetic_spectra(pixels, frames, seed=0):
+    '''Makes spectra that look like ADC counts: a dark baseline, a few peaks and shot noise.'''
+    rng = np.random.default_rng(seed)
+    x = np.arange(pixels)
+    clean = 1500 + np.zeros(pixels)
+    for center, height, width in zip(rng.uniform(0, pixels, 6), rng.uniform(2000, 50000, 6), rng.uniform(3, 40, 6)):
+        clean += height * np.exp(-0.5 * ((x - center) / width) ** 2)
+    noisy = rng.poisson(np.clip(clean, 0, 60000), size=(frames, pixels))
+    return np.clip(noisy, 0, 65535).astype(np.float64)
+
+
+def benchmark(codec, zlib_level, spectra):
+    '''Encodes and decodes every spectrum once.
+
+    Returns
+    -------
+    result: <dict>
+        Average bytes per frame and encode/decode time per frame in microseconds.
+    '''
+    encoder = SpecEncoder(codec, zlib_level)
+    decoder = SpecDecoder()
+    frames = []
+    start = time.perf_counter()
+    for frame_id, intensities in enumerate(spectra, 1):
+        codec_id, flags, dtype, payload = encoder.encode(intensities, frame_id)
+        frames.append(Frame(MSG_FRAME, frame_id, dtype, codec_id, flags, (1, len(intensities)), 0.0, 0, payload))
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for frame in frames:
+        decoded = decoder.decode(frame)
+    decode_time = time.perf_counter() - start
+
+    if not np.array_equal(decoded, spectra[-1]) and codec != 'float32':
+        raise RuntimeError("{} with zlib level {} is not lossless".format(codec, zlib_level))
+    return {
+        "bytes": sum(len(frame.payload) for frame in frames) / len(frames),
+        "encode_us": encode_time / len(frames) * 1e6,
+        "decode_us": decode_time / len(frames) * 1e6,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks spectrum codecs.")
+    parser.add_argument('--pixels', type=int, default=3648)
+    parser.add_argument('--frames', type=int, default=500)
+    parser.add_argument('--levels', type=int, nargs='*', default=[1, 6, 9], help="zlib levels to try")
+    args = parser.parse_args()
+
+    spectra = synthetic_spectra(args.pixels, args.frames)
+    print("{} pixels, {} frames, raw float64 frame is {} bytes".format(args.pixels, args.frames, args.pixels * 8))
+    print("{:<10}{:>6}{:>12}{:>10}{:>14}{:>14}".format("codec", "zlib", "bytes", "ratio", "encode (us)", "decode (us)"))
+    for codec in CODECS:
+        for zlib_level in [None] + args.levels:
+            result = benchmark(codec, zlib_level, spectra)
+            print("{:<10}{:>6}{:>12.0f}{:>10.2f}{:>14.1f}{:>14.1f}".format(
+                codec, "-" if zlib_level is None else zlib_level, result["bytes"],
+                args.pixels * 8 / result["bytes"], result["encode_us"], result["decode_us"]))
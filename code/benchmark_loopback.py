@@ -0,0 +1,152 @@
+#
+# End-to-end benchmark: SendSpecData with a simulated spectrometer streams to a SpecSession over 127.0.0.1.
+# Reports frames/s, p50/p99 latency (acquisition to decoded spectrum), datagram loss and CPU per frame
+# on each side for every combination of pixels, chunk size and integration time, and saves them as json.
+# Run with: python benchmark_loopback.py --pixels 2048 3648 --chunk-sizes 500 auto --int-times 1000 4000
+#
+
+from server import SendSpecData
+from client import SpecSession
+from spec_simulator import SimulatedSpectrometer
+import multiprocessing
+import numpy as np
+import argparse
+import platform
+import asyncio
+import socket
+import json
+import time
+import sys
+import os
+
+
+def free_port():
+    '''Returns a UDP port on 127.0.0.1 that nothing is bound to.'''
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def run_server(port, pixels, chunk_size, conn):
+    '''Serves on `port` in its own process until "stop" arrives on `conn`.
+
+    Every message on `conn` is answered with the process's CPU time and frame and datagram counts,
+    so the client can measure the server over exactly the same window as itself.
+    '''
+    sys.stdout = open(os.devnull, 'w')
+    server = SendSpecData(chunk_size, ('127.0.0.1', port), 2, device=SimulatedSpectrometer(pixels, seed=0))
+    server.set_socket_send()
+
+    async def serve_until_stopped():
+        loop = asyncio.get_running_loop()
+        serving = asyncio.ensure_future(server.serve())
+        conn.send("ready")
+        while True:
+            command = await loop.run_in_executor(None, conn.recv)
+            conn.send({"cpu": time.process_time(), "frames": server.frame_id, "datagrams": server.datagrams_sent})
+            if command == "stop":
+                break
+        serving.cancel()
+
+    asyncio.run(serve_until_stopped())
+
+
+def benchmark(pixels, chunk_size, int_time_micros, duration=2.0, warmup=0.5, codec='raw'):
+    '''Streams for `duration` seconds (after `warmup`) and measures both sides.
+
+    Returns
+    -------
+    result: <dict>
+        The settings and their measurements.
+    '''
+    port = free_port()
+    conn, server_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_server, args=(port, pixels, chunk_size, server_conn), daemon=True)
+    process.start()
+    conn.recv()
+    try:
+        with SpecSession(('127.0.0.1', port), int_time_micros=int_time_micros, codec=codec, timeout=0.2) as session:
+            # The first subscribe can arrive before the server is listening, next_frame sends it again
+            start = time.monotonic()
+            while time.monotonic() - start < warmup:
+                try:
+                    session.next_frame()
+                except TimeoutError:
+                    pass
+            session.set_timeout(2.0)
+
+            assembler = session.data.assembler
+            conn.send("mark")
+            server_start = conn.recv()
+            cpu_start, frames_start, datagrams_start = time.process_time(), assembler.frames_received, assembler.datagrams_received
+            lost_start = assembler.frames_lost
+            latencies = []
+            start = time.monotonic()
+            while time.monotonic() - start < duration:
+                session.next_frame()
+                latencies.append(time.time() - session.frame.timestamp)
+            elapsed = time.monotonic() - start
+            conn.send("stop")
+            server_end = conn.recv()
+
+            frames = assembler.frames_received - frames_start
+            datagrams_sent = server_end["datagrams"] - server_start["datagrams"]
+            datagrams_received = assembler.datagrams_received - datagrams_start
+            server_frames = (server_end["frames"] - server_start["frames"]) & 0xffffffff
+            frames_lost = assembler.frames_lost - lost_start
+            client_cpu = time.process_time() - cpu_start
+    finally:
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+
+    latencies = np.array(latencies) * 1e3
+    return {
+        "pixels": pixels,
+        "chunk_size": chunk_size,
+        "int_time_micros": int_time_micros,
+        "codec": codec,
+        "fps": frames / elapsed,
+        "expected_fps": 1e6 / int_time_micros,
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+        "frames_lost": frames_lost,
+        "datagram_loss": max(0.0, 1 - datagrams_received / datagrams_sent) if datagrams_sent else 0.0,
+        "server_cpu_us_per_frame": (server_end["cpu"] - server_start["cpu"]) / max(1, server_frames) * 1e6,
+        "client_cpu_us_per_frame": client_cpu / max(1, frames) * 1e6,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the server and client over loopback.")
+    parser.add_argument('--pixels', type=int, nargs='+', default=[512, 2048, 3648])
+    parser.add_argument('--chunk-sizes', nargs='+', default=['500', '1400', 'auto'],
+                        help="payload bytes per datagram, 'auto' to size them to the path MTU")
+    parser.add_argument('--int-times', type=int, nargs='+', default=[1000, 4000, 10000],
+                        help="integration times in microseconds")
+    parser.add_argument('--codec', default='raw')
+    parser.add_argument('--duration', type=float, default=2.0, help="seconds measured per combination")
+    parser.add_argument('--warmup', type=float, default=0.5, help="seconds streamed before measuring")
+    parser.add_argument('--output', default='benchmark_loopback.json', help="json file the results are written to")
+    args = parser.parse_args()
+
+    results = []
+    print("{:>7}{:>7}{:>9}{:>9}{:>10}{:>10}{:>8}{:>10}{:>12}{:>12}".format(
+        "pixels", "chunk", "int (us)", "fps", "p50 (ms)", "p99 (ms)", "lost", "loss", "server (us)", "client (us)"))
+    for pixels in args.pixels:
+        for chunk in args.chunk_sizes:
+            chunk_size = None if chunk == 'auto' else int(chunk)
+            for int_time_micros in args.int_times:
+                result = benchmark(pixels, chunk_size, int_time_micros, args.duration, args.warmup, args.codec)
+                results.append(result)
+                print("{:>7}{:>7}{:>9}{:>9.1f}{:>10.2f}{:>10.2f}{:>8}{:>10.2%}{:>12.0f}{:>12.0f}".format(
+                    pixels, chunk, int_time_micros, result["fps"], result["latency_p50_ms"],
+                    result["latency_p99_ms"], result["frames_lost"], result["datagram_loss"],
+                    result["server_cpu_us_per_frame"], result["client_cpu_us_per_frame"]))
+
+    with open(args.output, 'w') as f:
+        json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "platform": platform.platform(),
+                   "python": platform.python_version(), "numpy": np.__version__, "results": results}, f, indent=2)
+    print("Results written to {}.".format(args.output))
@@ -1,8 +1,20 @@
 import socket
-import zlib
+import struct
+import threading
+import queue
+import time
 import json
 import csv
 import numpy as np
+from collections import deque
+from protocol import Frame, FrameAssembler, fec_from_request, MSG_AXIS, MSG_PRODUCTS, MSG_BURST, MAX_DATAGRAM
+from spec_codecs import SpecDecoder, decode_burst
+from products import unpack_products
+from control import encode_message, ControlError
+from metrics import timed, watch
+
+# Seconds to wait for lost chunks after asking the server for them again, see `protocol.FrameAssembler`
+RECOVERY_WINDOW = 0.02
 
 # Sends parameters for spectrometer from client
 class SendSettings:
@@ -15,8 +27,15 @@ class SendSettings:
     trig_val (int): Sets trigger mode.
     int_time_micros (int): Integration time in microseconds.
     server_address (tuple): contains ip address (group) and port number in form [IP, port].
+    codec (str): How the server encodes spectra for this client, see `spec_codecs.CODECS`.
+    zlib_level (int): zlib level the server compresses spectra with, None for no compression.
+    reduction (dict): How the server reduces spectra for this client, see `reduction.Reduction`. None for full spectra.
+    products (dict): Products the server sends instead of spectra, see `products.Products`. None for spectra.
+    fec (dict): Parity the server adds to every frame, see `protocol.add_parity`. None for none.
+    shot_micros (int): Duration of the shot every trigger captures in trigger mode 3, None for one spectrum per trigger.
     '''
-    def __init__(self, server_address, trig_val, int_time_micros):
+    def __init__(self, server_address, trig_val, int_time_micros, codec='raw', zlib_level=None, reduction=None,
+                 products=None, fec=None, shot_micros=None):
         '''Constructor for SendSettings class.
         
         Parameters
@@ -31,11 +50,36 @@ class SendSettings:
                 edge/hardware = 3
         int_time_micros: <int>
             Integration time in microseconds.
+        codec: <str>
+            raw, float32, uint16 or delta, see `spec_codecs.SpecEncoder`. Only used when subscribing.
+        zlib_level: <int>
+            zlib level (0-9) the server compresses spectra with, None for no compression.
+        reduction: <dict>
+            Any of `"roi"` ([first, last] wavelength in nm), `"binning"`, `"smoothing"` (pixels) and
+            `"average"` (scans), applied by the server before encoding. None for full spectra.
+        products: <dict>
+            Any of `"peaks"` (how many), `"threshold"` (counts) and `"bands"` ([[first, last], ...] in nm),
+            sent instead of spectra. None for spectra.
+        fec: <dict>
+            `{"k": 8, "m": 1}` adds `m` parity datagrams to every `k` datagrams of a frame, so the
+            client rebuilds lost chunks without asking for them again. None for no parity.
+        shot_micros: <int>
+            In trigger mode 3, every trigger captures spectra back to back for this many microseconds,
+            which arrive as one burst. None for one spectrum per trigger.
         '''
         self.server_address = server_address
         self.trig_val = trig_val
         self.int_time_micros = int_time_micros
+        self.codec = codec
+        self.zlib_level = zlib_level
+        self.reduction = reduction
+        self.products = products
+        self.fec = fec
+        self.shot_micros = shot_micros
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.last_keepalive = 0.0
+        # Sequence number of the last request that asked to be acknowledged
+        self.seq = 0
     
     # Sending chosen spectrometer settings to server side
     def send_settings(self):
@@ -53,14 +97,198 @@ class SendSettings:
     def get_port(self):
         '''Gets the port that was last used after sending.'''
         return self.sock.getsockname()[1]
+
+    def subscribe(self, data_port=None, device=None, trig_val=None, int_time_micros=None):
+        '''Asks the server to keep streaming spectra to `data_port` with the current settings.
+
+        Parameters
+        ----------
+        data_port: <int>
+            Port of the socket that receives the spectra (see `ReceiveSpecData.bind_stream_socket`).
+            None if the client joined the server's multicast group (see `ReceiveSpecData.join_multicast`),
+            in which case the server's multicast codec is used.
+        device: <str> or <int>
+            Serial number or index of the spectrometer, None for the server's first one.
+        trig_val: <int>
+            Trigger mode of this device, None for `self.trig_val`.
+        int_time_micros: <int>
+            Integration time of this device, None for `self.int_time_micros`.
+        '''
+        request = {"cmd": "subscribe",
+                   "trig_val": self.trig_val if trig_val is None else trig_val,
+                   "int_time_micros": self.int_time_micros if int_time_micros is None else int_time_micros,
+                   "port": data_port, "codec": self.codec, "zlib_level": self.zlib_level,
+                   "max_datagram": MAX_DATAGRAM, "reduction": self.reduction, "products": self.products,
+                   "fec": self.fec}
+        if self.shot_micros is not None:
+            request["shot_micros"] = self.shot_micros
+        if device is not None:
+            request["device"] = device
+        self.sock.sendto(encode_message(request), self.server_address)
+        self.last_keepalive = time.monotonic()
+
+    def keepalive(self, interval=1.0):
+        '''Tells the server the client is still listening, at most once every `interval` seconds.
+
+        Sent as a `"keepalive"` request rather than zero bytes, which a server that already dropped
+        the subscription would answer with a single frame.
+        '''
+        now = time.monotonic()
+        if now - self.last_keepalive >= interval:
+            self.sock.sendto(encode_message({"cmd": "keepalive"}), self.server_address)
+            self.last_keepalive = now
+
+    def unsubscribe(self):
+        '''Stops the streams started with `subscribe`, from every device.'''
+        self.sock.sendto(encode_message({"cmd": "unsubscribe"}), self.server_address)
+
+    def request(self, cmd, timeout=0.5, retries=3, **fields):
+        '''Sends a request and waits until the server acknowledges it.
+
+        The request is sent again if no acknowledgement arrives within `timeout`, so requests
+        must be safe to repeat (setting the same settings twice does not touch the device again).
+
+        Parameters
+        ----------
+        cmd: <str>
+            Command, see `control.parse_request`.
+        timeout: <float>
+            Seconds to wait for the acknowledgement of each try.
+        retries: <int>
+            How many more times the request is sent before giving up.
+        fields:
+            Everything else the request contains.
+
+        Returns
+        -------
+        reply: <dict>
+            The acknowledgement, see `control.py`.
+        '''
+        self.seq = (self.seq + 1) & 0xffffffff
+        data = encode_message(dict(fields, cmd=cmd, seq=self.seq))
+        previous = self.sock.gettimeout()
+        try:
+            for attempt in range(retries + 1):
+                self.sock.sendto(data, self.server_address)
+                deadline = time.monotonic() + timeout
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.sock.settimeout(remaining)
+                    try:
+                        data_received, address = self.sock.recvfrom(MAX_DATAGRAM)
+                    except socket.timeout:
+                        break
+                    if address != self.server_address:
+                        continue
+                    reply = json.loads(data_received)
+                    # Acknowledgements of earlier requests can still be in the buffer
+                    if isinstance(reply, dict) and reply.get("ack") == self.seq:
+                        if not reply.get("ok", False):
+                            raise ControlError(reply.get("error", "{} failed".format(cmd)))
+                        return reply
+        finally:
+            self.sock.settimeout(previous)
+        raise TimeoutError("No acknowledgement of {!r} from {} after {} tries".format(
+            cmd, self.server_address, retries + 1))
+
+    def set_settings(self, trig_val=None, int_time_micros=None, device=None, reduction=None, shot_micros=None,
+                     **kwargs):
+        '''Changes spectrometer settings and waits until they are on the device.
+
+        Parameters
+        ----------
+        trig_val: <int>
+            New trigger mode, None keeps the current one.
+        int_time_micros: <int>
+            New integration time in microseconds, None keeps the current one.
+        device: <str> or <int>
+            Serial number or index of the spectrometer, None for the server's first one.
+        reduction: <dict>
+            New reduction of this client's spectra, see `__init__`. None keeps the current one.
+        shot_micros: <int>
+            New shot duration for trigger mode 3, see `__init__`. 0 turns bursts off, None keeps the current one.
+        kwargs:
+            `timeout` and `retries`, see `request`.
+
+        Returns
+        -------
+        reply: <dict>
+            Acknowledgement with the `"settings"` now on the device and whether they `"changed"`.
+        '''
+        fields = {}
+        if trig_val is not None:
+            fields["trig_val"] = trig_val
+        if int_time_micros is not None:
+            fields["int_time_micros"] = int_time_micros
+        if device is not None:
+            fields["device"] = device
+        if reduction is not None:
+            fields["reduction"] = reduction
+        if shot_micros is not None:
+            fields["shot_micros"] = shot_micros
+        return self.request("set", **fields, **kwargs)
+
+    def get_devices(self, timeout=1.0):
+        '''Asks the server which spectrometers it serves.
+
+        Parameters
+        ----------
+        timeout: <float>
+            Seconds to wait for the answer.
+
+        Returns
+        -------
+        devices: <list>
+            Serial numbers, in the order of the device index in the frame headers.
+        '''
+        return self.request("devices", timeout=timeout, retries=0)["devices"]
         
 # Receives spectrometer data
 class ReceiveSpecData:
-    '''Receives spectrometer data from server side.'''
-    def __init__(self):
-        '''Constructor for Receive class.'''
+    '''Receives spectrometer data from server side.
+
+    The wavelength axis is only sent at the start of a session (and when the calibration changes),
+    so it is cached here and combined with the intensities of every frame in `prepare_data`. On a
+    server with several spectrometers, axes and decoders are kept per device (see `Frame.device`).
+
+    Attributes
+    ----------
+    devices (set): Device indices whose frames are handed out, None for every device.
+    wavelengths (numpy.ndarray): Wavelength axis of the last frame's device.
+    products (tuple): `(peaks, bands)` of the last products frame, see `products.unpack_products`.
+    '''
+    def __init__(self, server_address=None):
+        '''Constructor for Receive class.
+
+        Parameters
+        ----------
+        server_address: <tuple>
+            Server address in the form (IP, port). If given, a missing wavelength axis is requested again.
+        '''
+        self.server_address = server_address
         self.spectrum_bytes = b""
-        self.shape_bytes = b""
+        self.frame = None
+        self.intensities = None
+        # Lost chunks are only asked for again if the server can be reached
+        self.assembler = FrameAssembler(RECOVERY_WINDOW if server_address is not None else 0.0)
+        watch(self.assembler, ('datagrams_received', 'frames_received', 'frames_lost', 'datagrams_dropped',
+                               'nacks_sent', 'frames_recovered', 'chunks_rebuilt'), 'client')
+        self.devices = None
+        # Per device: decoder, (axis_id, wavelengths) and a frame waiting for its axis
+        self.decoders = {}
+        self.axes = {}
+        self.waiting_frames = {}
+        self.wavelengths = None
+        self.axis_id = None
+        self.products = None
+        # Seconds to wait for a datagram, and whether the socket waits less while frames are missing chunks
+        self.timeout = None
+        self.polling = False
+        # Spectra of the last burst that were not handed out yet, as (frame, intensities)
+        self.burst_spectra = deque()
+        self.last_axis_requests = {}
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 
     def create_socket(self):
@@ -94,47 +322,230 @@ class ReceiveSpecData:
         '''
         # self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 2)
         self.sock.bind((server_address[0], client_port))
+
+    def bind_stream_socket(self, port=0, receive_buffer=4 * 1024 * 1024):
+        '''Binds a socket that stays open for a whole stream of spectra.
+
+        Parameters
+        ----------
+        port: <int>
+            Port to receive on, 0 lets the operating system pick one.
+        receive_buffer: <int>
+            Size of the kernel receive buffer, large enough to absorb bursts of frames.
+
+        Returns
+        -------
+        client_port: <int>
+            Port to pass to `SendSettings.subscribe`.
+        '''
+        self.create_socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.sock.bind(('', port))
+        return self.get_port()
+
+    def join_multicast(self, multicast_group, interface='0.0.0.0', receive_buffer=4 * 1024 * 1024):
+        '''Binds a socket to the server's multicast group, so frames are received passively.
+
+        Any number of clients, also on the same host, can join. Subscribe with
+        `SendSettings.subscribe(None)` so the server knows someone is listening.
+
+        Parameters
+        ----------
+        multicast_group: <tuple>
+            (group, port) the server publishes frames to.
+        interface: <str>
+            IP address of the local interface to join on, 0.0.0.0 lets the operating system choose.
+        receive_buffer: <int>
+            Size of the kernel receive buffer, large enough to absorb bursts of frames.
+        '''
+        self.create_socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.sock.bind(('', multicast_group[1]))
+        membership = struct.pack('4s4s', socket.inet_aton(multicast_group[0]), socket.inet_aton(interface))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
     
+    @timed('receive')
     def receive_data(self):
-        '''Receives spectrum and shape of spectrum.
-        
-        Receives spectrum data in form of bytes, then receives 0 bytes to break from loop,
-        and finally it receives data about the shape of the spectrum array.
+        '''Receives datagrams until a whole frame has been reassembled.
+
+        Every datagram has a header (see `protocol.py`), so chunks can arrive in any order.
+        Duplicates and chunks of frames older than the last complete one are dropped. Lost chunks
+        are asked for again with NACKs (see `send_nacks`), and frames are handed out in order, so a
+        frame that is being recovered holds back the ones after it for up to `RECOVERY_WINDOW`
+        seconds per NACK, see `receive_datagram`. Frames are decoded right away, since delta frames need
+        every frame before them. Bursts (see `server.SendSpecData.bursting`) are split up and their spectra handed out one per call,
+        each with its own timestamp in a frame of shape (1, pixels).
+
+        Datagrams are received straight into reusable buffers of the assembler, so the payload of
+        the returned frame is only valid until the next call. Products frames (see `products.py`)
+        need neither an axis nor decoding, they are unpacked into `products`.
+
+        Its `receive` stage in `metrics.py` includes the time spent waiting for the frame, the
+        `decode` stage is the part that is work.
+
+        Returns
+        -------
+        frame: <class 'protocol.Frame'>
         '''
-        tf = True
-        z = b""
-        self.spectrum_bytes = b""
-        self.shape_bytes = b""
-        while tf == True:
-            z = self.sock.recv(1024)
-            self.spectrum_bytes += z
-            if len(z) == 0:
-                tf = False
+        if self.burst_spectra:
+            frame, self.intensities = self.burst_spectra.popleft()
+            return self.set_frame(frame)
+        frame = None
+        while frame is None:
+            received = self.receive_datagram()
+            if self.assembler.nacks:
+                self.send_nacks()
+            if received is None or (self.devices is not None and received.device not in self.devices):
+                continue
+            device = received.device
+            axis_id = self.axes.get(device, (None, None))[0]
+            if received.msg_type == MSG_PRODUCTS:
+                self.products = unpack_products(np.frombuffer(received.payload, dtype=received.dtype).copy(),
+                                                received.shape)
+                self.frame = received
+                return received
+            if received.msg_type == MSG_AXIS:
+                self.set_axis(received)
+                # A frame that arrived before its axis can be handed out now
+                waiting = self.waiting_frames.get(device)
+                if waiting is not None and waiting.axis_id == received.axis_id:
+                    frame = self.waiting_frames.pop(device)
+            elif received.axis_id == axis_id:
+                frame = received
+            else:
+                # The wavelengths for this frame were lost or the calibration changed
+                self.waiting_frames[device] = received.detach()
+                self.request_axis(device)
+            if frame is not None and frame.msg_type == MSG_BURST:
+                frame = self.unpack_burst(frame)
+            elif frame is not None:
+                decoder = self.decoders.get(device)
+                if decoder is None:
+                    decoder = self.decoders[device] = SpecDecoder()
+                self.intensities = decoder.decode(frame)
+                if self.intensities is None:
+                    # Delta frame without its reference, wait for the next keyframe
+                    frame = None
+        return self.set_frame(frame)
+
+    def receive_datagram(self):
+        '''Receives one datagram into the assembler, see `protocol.FrameAssembler.receive`.
+
+        While frames are missing chunks, the socket is only waited on for `recovery_window` seconds at a
+        time and the assembler's deadlines are checked in between (see `protocol.FrameAssembler.expire`),
+        so a frame that lost its tail right before a pause is still asked for again or given up on.
+        `timeout` still applies to the whole wait. The socket's timeout is only changed when frames start
+        or stop missing chunks, since every change is a system call.
+
+        Returns
+        -------
+        frame: <class 'protocol.Frame'> or None
+        '''
+        assembler = self.assembler
+        polling = bool(assembler.recovery_window) and bool(assembler.pending or assembler.gaps)
+        if polling != self.polling:
+            self.sock.settimeout(assembler.recovery_window if polling else self.timeout)
+            self.polling = polling
+        if not polling:
+            return assembler.receive(self.sock)
+        waited = 0.0
+        while True:
+            try:
+                return assembler.receive(self.sock)
+            except socket.timeout:
+                waited += assembler.recovery_window
+                assembler.expire()
+                if assembler.nacks:
+                    self.send_nacks()
+                if assembler.ready:
+                    return assembler.receive(self.sock)
+                if self.timeout is not None and waited >= self.timeout:
+                    raise
 
-        # receives shape data
-        self.shape_bytes = self.sock.recv(1024)
+    def set_timeout(self, timeout):
+        '''Sets how many seconds `receive_data` waits for a datagram, None waits forever.'''
+        self.timeout = timeout
+        if not self.polling:
+            self.sock.settimeout(timeout)
 
-        #self.sock.close()
+    def set_frame(self, frame):
+        '''Makes `frame` the last received frame, with the axis of its device.'''
+        self.frame = frame
+        self.axis_id, self.wavelengths = self.axes[frame.device]
+        self.spectrum_bytes = frame.payload
+        return frame
 
-        print("The data has been received.")
+    def unpack_burst(self, frame):
+        '''Splits a `protocol.MSG_BURST` frame into one frame per spectrum.
+
+        The first spectrum is returned with its intensities in `intensities`, the others wait in
+        `burst_spectra` for the next calls of `receive_data`.
+
+        Parameters
+        ----------
+        frame: <class 'protocol.Frame'>
+
+        Returns
+        -------
+        frame: <class 'protocol.Frame'>
+            Frame of the first spectrum of the burst.
+        '''
+        timestamps, spectra = decode_burst(frame)
+        shape = (1, spectra.shape[1])
+        for timestamp, intensities in zip(timestamps, spectra):
+            self.burst_spectra.append((Frame(MSG_BURST, frame.frame_id, frame.dtype, frame.codec, frame.flags, shape,
+                                             float(timestamp), frame.axis_id, b'', frame.device), intensities))
+        first, self.intensities = self.burst_spectra.popleft()
+        return first
+
+    def set_axis(self, frame):
+        '''Caches the wavelength axis sent by the server.
+
+        Parameters
+        ----------
+        frame: <class 'protocol.Frame'>
+            Frame of type `MSG_AXIS`.
+        '''
+        self.axes[frame.device] = (frame.axis_id, np.frombuffer(frame.payload, dtype=frame.dtype).copy())
+
+    def request_axis(self, device=0, interval=0.5):
+        '''Asks the server to send the wavelength axis of `device` to this socket, at most once every `interval` seconds.'''
+        now = time.monotonic()
+        if self.server_address is None or now - self.last_axis_requests.get(device, 0.0) < interval:
+            return
+        self.sock.sendto(encode_message({"cmd": "axis", "device": device}), tuple(self.server_address))
+        self.last_axis_requests[device] = now
+
+    def send_nacks(self):
+        '''Asks the server to send the chunks the assembler is missing again, see `protocol.FrameAssembler`.
+
+        NACKs go out of the data socket, so the server sends the chunks where the frame went.
+        '''
+        nacks, self.assembler.nacks = self.assembler.nacks, []
+        for device, msg_type, frame_id, missing in nacks:
+            request = {"cmd": "nack", "device": device, "type": msg_type, "frame": frame_id}
+            if missing is not None:
+                request["missing"] = format(missing, 'x')
+            self.sock.sendto(encode_message(request), tuple(self.server_address))
 
     def get_shape(self):
-        shape = tuple(json.loads(self.shape_bytes))
-        return shape
+        '''Shape of the last received spectrum, taken from the frame header.'''
+        return self.frame.shape
     
+    @timed('prepare')
     def prepare_data(self):
-        '''Converts spectrum data and shape from bytes to a numpy array and tuple, respectively.
+        '''Combines the decoded intensities of the last frame with the cached wavelength axis.
         
-        Sometimes, some bytes are lost in the process of sending but it's very minimal
+        Frames with lost datagrams are never handed out, see `receive_data`. Only the intensities
+        are sent for every frame, the wavelengths come from the cached axis.
         
         Returns
         -------
         spectrum: <numpy.ndarray>
             In the form `np.array([[wavelengths], [intensities]])`.
         '''
-        spec_decompressed = zlib.decompress(self.spectrum_bytes)
-        shape = self.get_shape()
-        spectrum = np.frombuffer(spec_decompressed).reshape(shape)
+        spectrum = np.vstack((self.wavelengths, self.intensities))
         return spectrum
 
     def open_data_csv(self):
@@ -151,4 +562,295 @@ class ReceiveSpecData:
             thewriter = csv.DictWriter(f, fieldnames=fieldnames)
             i = 0
             for i in range(len(spectrum[0])):
-                thewriter.writerow({'wavelengths' : spectrum[0][i], 'intensities' : spectrum[1][i]})
\ No newline at end of file
+                thewriter.writerow({'wavelengths' : spectrum[0][i], 'intensities' : spectrum[1][i]})
+
+class SpecSession:
+    '''Long-lived connection to the server that streams spectra.
+
+    Owns one control socket (`SendSettings`) and one data socket (`ReceiveSpecData`) for the whole
+    session, so nothing is created or bound per frame. Use it as a context manager:
+
+        with SpecSession(('127.0.0.1', 5004), int_time_micros=4000) as session:
+            for spectrum in session:
+                ...
+
+    Attributes
+    ----------
+    control (class 'SendSettings'): Sends settings, keepalives and (un)subscribes.
+    data (class 'ReceiveSpecData'): Receives and decodes frames.
+    timeout (float): Seconds `next_frame` waits for a datagram before giving up, None waits forever.
+    keepalive_interval (float): Seconds between keepalives.
+    devices (list): Serial numbers of the spectrometers the server has, filled in by `open`.
+    '''
+    def __init__(self, server_address, trig_val=0, int_time_micros=4000, codec='raw', zlib_level=None,
+                 multicast_group=None, timeout=2.0, keepalive_interval=1.0, devices=None, reduction=None,
+                 products=None, fec=None, shot_micros=None):
+        '''Constructor for SpecSession class.
+
+        Parameters
+        ----------
+        server_address: <tuple>
+            Server address in the form (IP, port).
+        trig_val: <int>
+            Trigger mode, see `SendSettings`.
+        int_time_micros: <int>
+            Integration time in microseconds.
+        codec: <str>
+            raw, float32, uint16 or delta, see `spec_codecs.SpecEncoder`.
+        zlib_level: <int>
+            zlib level (0-9) the server compresses spectra with, None for no compression.
+        multicast_group: <tuple>
+            (group, port) to receive the server's multicast stream on, None to get frames unicast.
+        timeout: <float>
+            Seconds `next_frame` waits for a datagram before raising `TimeoutError`.
+        keepalive_interval: <float>
+            Seconds between keepalives, well below the server's keepalive timeout.
+        devices: <list> or <dict>
+            Serial numbers of the spectrometers to stream from, or a dictionary of serial number to
+            `(trig_val, int_time_micros)` to give each its own settings. None streams from the server's
+            first spectrometer only.
+        reduction: <dict>
+            ROI, binning, smoothing and averaging the server applies to every spectrometer, see `SendSettings`.
+        products: <dict>
+            Peaks and bands to get instead of spectra, see `SendSettings`. `next_frame` then returns
+            `(peaks, bands)`, see `products.unpack_products`.
+        fec: <dict>
+            Parity for lossy networks, e.g. `{"k": 8, "m": 1}` for 12.5% more datagrams, see `SendSettings`.
+            Only for unicast, the multicast group gets no parity.
+        shot_micros: <int>
+            Microseconds of spectra every hardware trigger captures in trigger mode 3, see `SendSettings`.
+            `next_frame` hands them out one at a time, each with its own timestamp.
+        '''
+        server_address = (server_address[0], int(server_address[1]))
+        self.control = SendSettings(server_address, trig_val, int_time_micros, codec, zlib_level, reduction, products,
+                                    None if multicast_group is not None else fec, shot_micros)
+        self.data = ReceiveSpecData(server_address)
+        self.data.assembler.fec = fec_from_request(self.control.fec)
+        self.multicast_group = multicast_group
+        self.timeout = timeout
+        self.keepalive_interval = keepalive_interval
+        self.requested_devices = devices
+        self.devices = None
+        self.is_open = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        '''Yields spectra for as long as the session is open.'''
+        while self.is_open:
+            yield self.next_frame()
+
+    def open(self):
+        '''Binds the data socket (or joins the multicast group) and subscribes.'''
+        if self.multicast_group is None:
+            self.data_port = self.data.bind_stream_socket()
+        else:
+            self.data.join_multicast(self.multicast_group)
+            self.data_port = None
+        self.data.set_timeout(self.timeout)
+        if self.requested_devices is not None:
+            self.devices = self.control.get_devices()
+            missing = [serial for serial in self.requested_devices if serial not in self.devices]
+            if missing:
+                raise KeyError("Server has no device {}".format(", ".join(map(str, missing))))
+            self.data.devices = {self.devices.index(serial) for serial in self.requested_devices}
+        self.subscribe()
+        self.is_open = True
+
+    def subscribe(self):
+        '''Subscribes to every requested device, or to the server's first one.'''
+        if self.requested_devices is None:
+            self.control.subscribe(self.data_port)
+            return
+        for serial in self.requested_devices:
+            settings = self.requested_devices[serial] if isinstance(self.requested_devices, dict) else (None, None)
+            self.control.subscribe(self.data_port, serial, *settings)
+
+    def close(self):
+        '''Unsubscribes and closes both sockets.'''
+        if not self.is_open:
+            return
+        self.is_open = False
+        try:
+            self.control.unsubscribe()
+        finally:
+            self.control.sock.close()
+            self.data.sock.close()
+
+    def update_settings(self, trig_val=None, int_time_micros=None, device=None, reduction=None, shot_micros=None):
+        '''Changes spectrometer settings without interrupting the stream.
+
+        Waits until the server acknowledges that the settings are on the device; settings that
+        did not change are not sent to the device again.
+
+        Parameters
+        ----------
+        trig_val: <int>
+            New trigger mode, None keeps the current one.
+        int_time_micros: <int>
+            New integration time in microseconds, None keeps the current one.
+        device: <str>
+            Serial number of the spectrometer to change, None for the session's default settings
+            (which go to the server's first spectrometer).
+        reduction: <dict>
+            New reduction for every spectrometer of the session (see `SendSettings`), {} for full
+            spectra and None to keep the current one.
+        shot_micros: <int>
+            New shot duration for trigger mode 3, 0 for one spectrum per trigger and None to keep the current one.
+
+        Returns
+        -------
+        replies: <list>
+            Acknowledgements from the server, one per spectrometer, see `SendSettings.set_settings`.
+        '''
+        # A new reduction goes to every device the session streams from
+        devices = [device]
+        if device is None and reduction is not None and self.requested_devices is not None:
+            devices = list(self.requested_devices)
+        replies = [self.control.set_settings(trig_val, int_time_micros, serial, reduction, shot_micros)
+                   for serial in devices]
+
+        # Only settings the server accepted are kept for subscribing again after a timeout
+        if reduction is not None:
+            self.control.reduction = reduction
+        if device is None:
+            if shot_micros is not None:
+                self.control.shot_micros = shot_micros or None
+            if trig_val is not None:
+                self.control.trig_val = trig_val
+            if int_time_micros is not None:
+                self.control.int_time_micros = int_time_micros
+        elif isinstance(self.requested_devices, dict):
+            settings = self.requested_devices.get(device, (self.control.trig_val, self.control.int_time_micros))
+            self.requested_devices[device] = (settings[0] if trig_val is None else trig_val,
+                                              settings[1] if int_time_micros is None else int_time_micros)
+        return replies
+
+    def set_timeout(self, timeout):
+        '''Sets how many seconds `next_frame` waits for a datagram, None waits forever.'''
+        self.timeout = timeout
+        self.data.set_timeout(timeout)
+
+    def next_frame(self):
+        '''Waits for the next complete frame.
+
+        Keepalives are sent as needed. If nothing arrives within `timeout`, the client
+        subscribes again (the server may have restarted or dropped us) and `TimeoutError` is raised.
+
+        Returns
+        -------
+        spectrum: <numpy.ndarray>
+            In the form `np.array([[wavelengths], [intensities]])`. Sessions that subscribed to
+            products get `(peaks, bands)` instead, see `products.unpack_products`.
+        '''
+        self.control.keepalive(self.keepalive_interval)
+        try:
+            frame = self.data.receive_data()
+        except socket.timeout:
+            self.subscribe()
+            raise TimeoutError("No frame from {} within {} s".format(self.control.server_address, self.timeout))
+        if frame.msg_type == MSG_PRODUCTS:
+            return self.data.products
+        return self.data.prepare_data()
+
+    @property
+    def frame(self):
+        '''Header information (`protocol.Frame`) of the last received frame, e.g. its timestamp.'''
+        return self.data.frame
+
+    @property
+    def device(self):
+        '''Serial number of the spectrometer the last frame came from, its index if the device list is unknown.'''
+        index = self.data.frame.device
+        return index if self.devices is None else self.devices[index]
+
+
+class SpecStream:
+    '''Receives the frames of a `SpecSession` on a worker thread.
+
+    The worker keeps receiving at the server's rate however slow the consumer is. Every spectrum
+    is handed to `on_frame` (e.g. a recorder) on the worker thread, and put into a bounded queue
+    for display. When the queue is full the oldest spectrum is dropped from it, since a display
+    only needs the newest one (see `latest`).
+
+    Attributes
+    ----------
+    session (class 'SpecSession'): Open session the frames come from.
+    frames_received (int): Spectra received by the worker.
+    frames_dropped (int): Spectra dropped from the display queue before anyone took them.
+    '''
+    def __init__(self, session, on_frame=None, maxsize=4):
+        '''Constructor for SpecStream class.
+
+        Parameters
+        ----------
+        session: <class 'SpecSession'>
+            Open session, its timeout decides how quickly `stop` returns.
+        on_frame: <function>
+            Called on the worker thread with every spectrum and its `protocol.Frame` header.
+        maxsize: <int>
+            Spectra the display queue holds.
+        '''
+        self.session = session
+        self.on_frame = on_frame
+        self.frames = queue.Queue(maxsize)
+        self.frames_received = 0
+        self.frames_dropped = 0
+        watch(self, ('frames_received', 'frames_dropped'), 'stream')
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        '''Starts the worker thread.'''
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="SpecStream", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stops the worker thread and waits for it, at most about one session timeout.'''
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        '''Receives frames until `stop` is called.'''
+        while not self.stopped.is_set():
+            try:
+                spectrum = self.session.next_frame()
+            except TimeoutError as e:
+                print(e)
+                continue
+            self.frames_received += 1
+            if self.on_frame is not None:
+                self.on_frame(spectrum, self.session.frame)
+            while True:
+                try:
+                    self.frames.put_nowait(spectrum)
+                    break
+                except queue.Full:
+                    try:
+                        self.frames.get_nowait()
+                        self.frames_dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def latest(self):
+        '''Takes every queued spectrum and returns the newest.
+
+        Returns
+        -------
+        spectrum: <numpy.ndarray> or None
+            In the form `np.array([[wavelengths], [intensities]])`, None if nothing arrived since the last call.
+        '''
+        spectrum = None
+        while True:
+            try:
+                spectrum = self.frames.get_nowait()
+            except queue.Empty:
+                return spectrum
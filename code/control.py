@@ -0,0 +1,108 @@
+#
+# Control messages between clients and the server. They only travel on the control socket, never
+# with the frames of `protocol.py`.
+#
+# Requests are json dictionaries with the control protocol version "v", a "cmd" and, if the client
+# wants to know the outcome, a sequence number "seq". Every request with a "seq" is answered with
+#   {"v": 1, "ack": seq, "ok": true, ...}  or  {"v": 1, "ack": seq, "ok": false, "error": "..."}
+# "set" is only acknowledged once the settings are on the device, and says whether they changed.
+# Zero bytes and the settings list [trig_val, int_time_micros] of older clients are still understood,
+# but never answered.
+#
+
+import json
+
+CONTROL_VERSION = 1
+
+# Commands that change spectrometer settings, "settings" is the name older clients use for "set"
+SETTINGS_COMMANDS = ("set", "settings", "subscribe")
+
+
+class ControlError(ValueError):
+    '''A request that can not be applied, or a negative acknowledgement of one.
+
+    Attributes
+    ----------
+    request (dict): The request, if it could be read, so it can still be answered.
+    '''
+    def __init__(self, message, request=None):
+        ValueError.__init__(self, message)
+        self.request = request
+
+
+def parse_request(received_data):
+    '''Converts a datagram from the client into a request dictionary.
+
+    Parameters
+    ----------
+    received_data: <bytes>
+        Zero bytes, the legacy settings list `[trig_val, int_time_micros]`, or a json dictionary
+        with a `"cmd"` key (`"subscribe"`, `"set"`, `"settings"`, `"keepalive"`, `"unsubscribe"`, `"axis"`,
+        `"nack"` or `"devices"`). A `"device"` key (serial number or index) picks one of the server's spectrometers.
+        Subscribe requests can also ask for a `"codec"` (see `spec_codecs.CODECS`) and a `"zlib_level"`,
+        and say how large a datagram they can receive with `"max_datagram"`. Subscribe and settings
+        requests can ask for a `"reduction"` of their spectra, see `reduction.Reduction`, and
+        subscribe requests can ask for `"products"` instead of spectra, see `products.Products`, and
+        for `"fec"` parity datagrams, see `protocol.add_parity`. Subscribe and settings requests can set
+        the `"shot_micros"` that every trigger captures in trigger mode 3, see `server.SendSpecData.bursting`.
+        Subscribe requests without a `"port"` are from clients that joined the multicast group.
+
+    Returns
+    -------
+    request: <dict>
+        Always contains `"cmd"`. Zero bytes become `"next"`, which is a keepalive for
+        subscribed clients and a single frame request for everyone else.
+    '''
+    if len(received_data) == 0:
+        return {"cmd": "next"}
+    message = json.loads(received_data)
+    if isinstance(message, list):
+        if len(message) != 2:
+            raise ControlError("Legacy settings must be [trig_val, int_time_micros], got {!r}".format(message))
+        return {"cmd": "settings", "trig_val": message[0], "int_time_micros": message[1]}
+    if not isinstance(message, dict) or "cmd" not in message:
+        raise ControlError("Not a control request: {!r}".format(message))
+    version = message.get("v", CONTROL_VERSION)
+    if version != CONTROL_VERSION:
+        raise ControlError("Control protocol version {} is not supported, the server speaks version {}".format(
+            version, CONTROL_VERSION), message)
+    return message
+
+
+def encode_message(message):
+    '''Adds the control protocol version to a request or reply and encodes it.
+
+    Parameters
+    ----------
+    message: <dict>
+
+    Returns
+    -------
+    data: <bytes>
+    '''
+    return json.dumps(dict(message, v=CONTROL_VERSION)).encode()
+
+
+def make_ack(request, ok=True, error=None, **fields):
+    '''Encodes the answer to a request.
+
+    Parameters
+    ----------
+    request: <dict>
+        Request that is answered, its `"seq"` is sent back.
+    ok: <bool>
+        False if the request could not be applied.
+    error: <str>
+        Why the request could not be applied.
+    fields:
+        Anything else the client should know, e.g. the settings now on the device.
+
+    Returns
+    -------
+    data: <bytes>
+    '''
+    reply = {"ack": request.get("seq"), "ok": ok}
+    if error is not None:
+        reply["error"] = error
+    reply.update(fields)
+    return encode_message(reply)
@@ -0,0 +1,158 @@
+#
+# Exports a recorded run to .mp4: frames are rendered in parallel on off-screen Agg canvases and piped
+# to ffmpeg in order.
+#
+
+from recorder import RunReader
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import matplotlib
+import multiprocessing
+import subprocess
+import numpy as np
+import os
+
+# Fraction of the data range left free above and below the spectra, so noise does not
+# push them out of the axes (and force a full redraw in the GUI) on every frame
+Y_MARGIN = 0.1
+
+# Set in every worker process by `start_worker`
+renderer = None
+
+
+class FrameRenderer:
+    '''Renders the frames of one run on an off-screen Agg canvas.
+
+    The axes, ticks and labels are drawn once. Every frame only restores that background and
+    rasterizes the trace and the title on top of it.
+    '''
+    def __init__(self, run_path, xlim, ylim, figsize=(6.4, 4.8), dpi=100):
+        '''Constructor for FrameRenderer class.
+
+        Parameters
+        ----------
+        run_path: <str>
+            Directory of the run.
+        xlim: <tuple>
+            Wavelength range of the axes.
+        ylim: <tuple>
+            Intensity range of the axes.
+        figsize: <tuple>
+            Size of the video in inches.
+        dpi: <int>
+            Pixels per inch.
+        '''
+        self.run = RunReader(run_path)
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(111)
+        self.ax.set_xlabel("Wavelengths")
+        self.ax.set_ylabel("Intensities")
+        self.ax.set_xlim(*xlim)
+        self.ax.set_ylim(*ylim)
+        self.line, = self.ax.plot([], [], animated=True)
+        self.title = self.ax.set_title(" ", animated=True)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    @property
+    def size(self):
+        '''(width, height) of the frames in pixels.'''
+        return self.canvas.get_width_height()
+
+    def render(self, i):
+        '''Renders frame `i`.
+
+        Returns
+        -------
+        image: <bytes>
+            RGBA pixels of the frame.
+        '''
+        self.canvas.restore_region(self.background)
+        self.line.set_data(self.run.wavelengths_of(i), self.run[i])
+        self.title.set_text("Spectrum {} / {}".format(i + 1, len(self.run)))
+        self.ax.draw_artist(self.line)
+        self.ax.draw_artist(self.title)
+        return bytes(self.canvas.buffer_rgba())
+
+
+def start_worker(*args):
+    '''Initializer of the worker processes, makes their `FrameRenderer`.'''
+    global renderer
+    renderer = FrameRenderer(*args)
+
+
+def render_frame(i):
+    '''Renders frame `i` in a worker process.'''
+    return renderer.render(i)
+
+
+def run_limits(run, chunk=1024):
+    '''Axis limits that fit every frame of `run`, read one block of frames (with one pixel count) at a time.'''
+    low, high = np.inf, -np.inf
+    for frames in run.uniform_slices(chunk):
+        block = run[frames]
+        low, high = min(low, block.min()), max(high, block.max())
+    margin = max(high - low, 1) * Y_MARGIN
+    axes = [run.wavelengths_of(i) for i in np.unique(run.axis_ids, return_index=True)[1]]
+    xlim = (min(axis[0] for axis in axes), max(axis[-1] for axis in axes))
+    return xlim, (low - margin, high + margin)
+
+
+def export_run(run_path, output_path, fps=30, figsize=(6.4, 4.8), dpi=100, processes=None, progress=None):
+    '''Renders every frame of a recorded run into an .mp4 file.
+
+    Parameters
+    ----------
+    run_path: <str>
+        Directory of the run, see `recorder.RunRecorder`.
+    output_path: <str>
+        .mp4 file to write.
+    fps: <int>
+        Frames per second of the video.
+    figsize: <tuple>
+        Size of the video in inches.
+    dpi: <int>
+        Pixels per inch.
+    processes: <int>
+        Rendering processes, one per CPU if None.
+    progress: <function>
+        Called with `(frames written, total frames)` after every frame.
+
+    Notes
+    -----
+    ffmpeg is found the same way matplotlib finds it, through `rcParams['animation.ffmpeg_path']`.
+    The workers are spawned, so callers must guard their entry point with `if __name__ == '__main__':`.
+    '''
+    run = RunReader(run_path)
+    total = len(run)
+    if total == 0:
+        return
+    xlim, ylim = run_limits(run)
+    width, height = FrameRenderer(run_path, xlim, ylim, figsize, dpi).size
+
+    command = [matplotlib.rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', '{}x{}'.format(width, height), '-r', str(fps),
+               '-i', '-', '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', output_path]
+    encoder = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Spawned, not forked: the GUI exports from a worker thread while its other threads keep running
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(processes or os.cpu_count(), start_worker, (run_path, xlim, ylim, figsize, dpi))
+    try:
+        # imap hands the frames back in order while the workers render ahead
+        for written, image in enumerate(pool.imap(render_frame, range(total), chunksize=8), 1):
+            encoder.stdin.write(image)
+            if progress is not None:
+                progress(written, total)
+    except BrokenPipeError:
+        # ffmpeg quit, its error is raised below
+        pass
+    finally:
+        pool.terminate()
+        try:
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass
+        error = encoder.stderr.read()
+        if encoder.wait() != 0:
+            raise RuntimeError("ffmpeg failed: {}".format(error.decode(errors='replace').strip()))
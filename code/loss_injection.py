@@ -0,0 +1,183 @@
+#
+# Loss injection: SendSpecData with a simulated spectrometer streams to a SpecSession over 127.0.0.1 while
+# the server's socket drops datagrams at random, alone or in bursts like a congested network. Reports how
+# many frames arrive without recovery, with NACKs, with FEC parity and with both, and what it costs in datagrams.
+# Run with: python loss_injection.py --loss 0.01 0.05 --burst 1 3 --fec 8/1 4/2
+#
+
+from server import SendSpecData
+from client import SpecSession
+from spec_simulator import SimulatedSpectrometer
+from benchmark_loopback import free_port
+import numpy as np
+import contextlib
+import argparse
+import platform
+import threading
+import asyncio
+import random
+import json
+import time
+import os
+
+
+class LossySocket:
+    '''Wraps the server's send socket and drops datagrams like a lossy network would.
+
+    Losses follow a two state (Gilbert) model: after a lost datagram the next one is lost with
+    probability 1 - 1 / `burst`, so bursts are `burst` datagrams long on average and the overall loss is `loss`.
+
+    Attributes
+    ----------
+    dropped (int): Datagrams dropped.
+    '''
+    def __init__(self, sock, loss, burst=1.0, seed=0):
+        self.sock = sock
+        self.burst = max(1.0, burst)
+        self.stay_lost = 1 - 1 / self.burst
+        self.start_loss = min(1.0, loss / (self.burst * (1 - loss))) if loss < 1 else 1.0
+        self.random = random.Random(seed)
+        self.lost = False
+        self.dropped = 0
+
+    def drop(self):
+        '''Decides whether the next datagram is lost.'''
+        self.lost = self.random.random() < (self.stay_lost if self.lost else self.start_loss)
+        self.dropped += self.lost
+        return self.lost
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        if self.drop():
+            return sum(len(buffer) for buffer in buffers)
+        return self.sock.sendmsg(buffers, ancdata, flags, address)
+
+    def sendto(self, data, address):
+        if self.drop():
+            return len(data)
+        return self.sock.sendto(data, address)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def run(loss, burst, fec, nack, pixels=2048, chunk_size=1400, int_time_micros=4000, duration=2.0, warmup=0.5):
+    '''Streams for `duration` seconds (after `warmup`) through a `LossySocket` and counts what arrives.
+
+    Parameters
+    ----------
+    loss: <float>
+        Fraction of datagrams dropped.
+    burst: <float>
+        Mean length of a burst of lost datagrams.
+    fec: <dict>
+        `{"k": k, "m": m}` parity, None for none.
+    nack: <bool>
+        False turns off asking for lost chunks again.
+
+    Returns
+    -------
+    result: <dict>
+        The settings and their measurements.
+    '''
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return measure(loss, burst, fec, nack, pixels, chunk_size, int_time_micros, duration, warmup)
+
+
+def measure(loss, burst, fec, nack, pixels, chunk_size, int_time_micros, duration, warmup):
+    '''`run` without the server's and client's log lines.'''
+    port = free_port()
+    server = SendSpecData(chunk_size, ('127.0.0.1', port), 2, device=SimulatedSpectrometer(pixels, seed=0))
+    server.set_socket_send()
+    # One sendmsg per datagram, so every datagram is dropped on its own
+    server.use_gso = False
+    server.sock = LossySocket(server.sock, loss, burst)
+    loop = asyncio.new_event_loop()
+    serving = loop.create_task(server.serve())
+
+    def serve():
+        try:
+            loop.run_until_complete(serving)
+        except asyncio.CancelledError:
+            pass
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    try:
+        with SpecSession(('127.0.0.1', port), int_time_micros=int_time_micros, timeout=0.2, fec=fec) as session:
+            assembler = session.data.assembler
+            if not nack:
+                assembler.recovery_window = 0.0
+            start = time.monotonic()
+            while time.monotonic() - start < warmup:
+                try:
+                    session.next_frame()
+                except TimeoutError:
+                    pass
+            counters = ('frames_received', 'frames_lost', 'chunks_rebuilt', 'nacks_sent', 'frames_recovered')
+            client_start = {name: getattr(assembler, name) for name in counters}
+            server_start = (server.frames_acquired, server.datagrams_sent, server.datagrams_retransmitted)
+            start = time.monotonic()
+            while time.monotonic() - start < duration:
+                try:
+                    session.next_frame()
+                except TimeoutError:
+                    pass
+            elapsed = time.monotonic() - start
+            client = {name: getattr(assembler, name) - client_start[name] for name in counters}
+            acquired, datagrams_sent, retransmitted = (end - begin for end, begin in zip(
+                (server.frames_acquired, server.datagrams_sent, server.datagrams_retransmitted), server_start))
+    finally:
+        loop.call_soon_threadsafe(serving.cancel)
+        thread.join(5)
+
+    frames = client['frames_received']
+    return {
+        "loss": loss,
+        "burst": burst,
+        "fec": None if fec is None else "{}/{}".format(fec["k"], fec.get("m", 1)),
+        "nack": nack,
+        "fps": frames / elapsed,
+        "frames_received": frames,
+        "frame_loss": client['frames_lost'] / max(1, frames + client['frames_lost']),
+        "chunks_rebuilt": client['chunks_rebuilt'],
+        "nacks_sent": client['nacks_sent'],
+        "frames_recovered": client['frames_recovered'],
+        "datagrams_retransmitted": retransmitted,
+        "datagrams_per_frame": datagrams_sent / max(1, acquired),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures how many frames survive injected datagram loss.")
+    parser.add_argument('--loss', type=float, nargs='+', default=[0.01, 0.05], help="fractions of datagrams dropped")
+    parser.add_argument('--burst', type=float, nargs='+', default=[1.0, 3.0],
+                        help="mean lengths of bursts of lost datagrams")
+    parser.add_argument('--fec', nargs='+', default=['8/1', '4/2'], help="k/m parity settings to compare")
+    parser.add_argument('--pixels', type=int, default=2048)
+    parser.add_argument('--chunk-size', type=int, default=1400, help="payload bytes per datagram")
+    parser.add_argument('--int-time', type=int, default=4000, help="integration time in microseconds")
+    parser.add_argument('--duration', type=float, default=2.0, help="seconds measured per combination")
+    parser.add_argument('--output', default='loss_injection.json', help="json file the results are written to")
+    args = parser.parse_args()
+
+    modes = [(None, False), (None, True)]
+    for setting in args.fec:
+        k, m = (int(value) for value in setting.split('/'))
+        modes += [({"k": k, "m": m}, False), ({"k": k, "m": m}, True)]
+
+    results = []
+    print("{:>6}{:>7}{:>6}{:>6}{:>8}{:>12}{:>9}{:>7}{:>9}{:>13}".format(
+        "loss", "burst", "fec", "nack", "fps", "frame loss", "rebuilt", "nacks", "resent", "dgrams/frame"))
+    for loss in args.loss:
+        for burst in args.burst:
+            for fec, nack in modes:
+                result = run(loss, burst, fec, nack, args.pixels, args.chunk_size, args.int_time, args.duration)
+                results.append(result)
+                print("{:>6.1%}{:>7.1f}{:>6}{:>6}{:>8.1f}{:>12.2%}{:>9}{:>7}{:>9}{:>13.2f}".format(
+                    loss, burst, result["fec"] or "-", "yes" if nack else "no", result["fps"], result["frame_loss"],
+                    result["chunks_rebuilt"], result["nacks_sent"], result["datagrams_retransmitted"],
+                    result["datagrams_per_frame"]))
+
+    with open(args.output, 'w') as f:
+        json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "platform": platform.platform(),
+                   "python": platform.python_version(), "numpy": np.__version__, "results": results}, f, indent=2)
+    print("Results written to {}.".format(args.output))
@@ -1,9 +1,14 @@
 from GUI_client import SpecApp, SaveData
 import tkinter as tk
+import metrics
 
-root = tk.Tk()
-myapp = SpecApp(root)
-root.geometry("900x550")
-root.title("Spectrometer GUI")
-root.config(bg='#345')
-myapp.mainloop()
\ No newline at end of file
+# The mp4 export starts worker processes, which import this file again on Windows
+if __name__ == '__main__':
+    # Stage timings and counters on http://127.0.0.1:9109/metrics, SPEC_METRICS=0 turns them off
+    metrics.start(9109)
+    root = tk.Tk()
+    myapp = SpecApp(root)
+    root.geometry("900x550")
+    root.title("Spectrometer GUI")
+    root.config(bg='#345')
+    myapp.mainloop()
\ No newline at end of file
@@ -1,5 +1,7 @@
-from client import ReceiveSpecData, SendSettings
+from client import SpecSession
 from GUI_client import SaveData
+from recorder import RunRecorder
+import metrics
 import sys
 
 try:
@@ -10,30 +12,36 @@ try:
 
 except IndexError:
     print(
-    "Terminal args should be ip:port trigger_mode integration_time\n" +
-    "For example: 127.0.0.1:5004 4000 0"
+    "Terminal args should be ip:port trigger_mode integration_time [multicast_group:port]\n" +
+    "For example: 127.0.0.1:5004 4000 0 224.1.1.1:5007"
     )
 
-r = ReceiveSpecData()
-s = SendSettings((server_address[0], int(server_address[1])), int(trig_val), int(int_time_micros))
-sd = SaveData(file_number=0)
-spec_list = []
-try:
-    while True:
-        # Sending data
-        s.send_settings()
-        client_port = s.get_port()
+# Optional multicast group, many clients can then share one stream
+multicast_group = None
+if len(sys.argv) > 4:
+    group, group_port = sys.argv[4].split(':')
+    multicast_group = (group, int(group_port))
 
-        s.send_zero_bytes()
-        r.create_socket()
+# Stage timings and counters on http://127.0.0.1:9109/metrics, SPEC_METRICS=0 turns them off
+metrics.start(9109)
 
-        # Receiving data
-        r.set_socket_receive()
-        r.bind_socket(client_port, server_address)
-        r.receive_data()
-        spec = r.prepare_data()
-        spec_list.append(spec)
+sd = SaveData(file_number=0)
+# Every spectrum is streamed to disk as it arrives, so memory stays constant however long the run is
+recorder = RunRecorder(sd.file_name)
+recorder.set_settings(int(trig_val), int(int_time_micros))
+# One session for the whole run, the server keeps streaming until it is closed
+session = SpecSession(server_address, int(trig_val), int(int_time_micros), multicast_group=multicast_group)
+try:
+    with session:
+        while True:
+            try:
+                spec = session.next_frame()
+            except TimeoutError as e:
+                # Nothing came within the timeout, e.g. while waiting for a hardware trigger
+                print(e)
+                continue
+            recorder.record(spec, session.frame)
 
 finally:
-    sd.save_data(spec)
+    recorder.close()
     print("done")
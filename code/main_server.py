@@ -1,38 +1,53 @@
-from server import SendSpecData, ReceiveSettings
-import json
+from server import SendSpecData, SpecServer
+from specDataClass import open_devices
+from spec_simulator import SimulatedSpectrometer
+import argparse
+import asyncio
+import metrics
 
 # Server class parameters
 ip = '127.0.0.1'
 port = 5004
 server_address = (ip, port)
 ttl = 2
-chunk_size = 500
+# Payload bytes per datagram, None sizes datagrams to the path MTU of each client
+chunk_size = None
+# Frames are published once to this group for every client that joined it, None turns it off
+multicast_group = ('224.1.1.1', 5007)
 
-# Initializing SendSpecData and ReceiveSettings classes
-s = SendSpecData(chunk_size, server_address, ttl)
-r = ReceiveSettings()
-while True:
-    
-    # Setting up address and socket, which is then set to receive
-    r.set_server_address(server_address)
-    r.set_sock()
-    r.set_socket_receive()
+# Runs on a simulated spectrometer with --simulate, e.g. `python main_server.py --simulate --pixels 3648`
+parser = argparse.ArgumentParser(description="Streams spectra to clients.")
+parser.add_argument('--simulate', action='store_true', help="use a simulated spectrometer instead of seabreeze")
+parser.add_argument('--devices', type=int, default=1, help="number of simulated spectrometers")
+parser.add_argument('--pixels', type=int, default=2048, help="pixels of the simulated spectrometers")
+parser.add_argument('--no-noise', action='store_true', help="simulated spectra without shot and read noise")
+parser.add_argument('--trigger-period', type=float, default=0.1,
+                    help="seconds between simulated hardware triggers in trigger mode 3")
+parser.add_argument('--seed', type=int, default=None, help="seed of the simulated noise")
+args = parser.parse_args()
 
-    # Receiving data and deciding what to do with it
-    received_data = r.receive_settings()
-    if len(received_data[0]) == 0:
-        client_address = received_data[1]
-    else:
-        settings = json.loads(received_data[0])
-        client_address = received_data[1]
+# Every spectrometer on the host is served, each one acquires on its own thread
+if args.simulate:
+    devices = [SimulatedSpectrometer(args.pixels, noise=not args.no_noise, trigger_period=args.trigger_period,
+                                     seed=None if args.seed is None else args.seed + i,
+                                     serial_number="SIM{:05d}".format(i + 1)) for i in range(args.devices)]
+else:
+    devices = open_devices()
 
-    # Settings for spectrometer
-    trig_val = settings[0]
-    int_time_micros = settings[1]
+# Initializing SendSpecData class for every device
+senders = []
+for device in devices:
+    sender = SendSpecData(chunk_size, server_address, ttl, multicast_group, device=device)
+    sender.set_socket_send()
+    senders.append(sender)
+s = SpecServer(senders, server_address)
 
-    # Initializing Server methods
-    s.setup_spec(trig_val, int_time_micros)
-    s.set_socket_send()
-    s.get_data()
+# Stage timings and counters on http://127.0.0.1:9108/metrics, SPEC_METRICS=0 turns them off
+metrics.start(9108)
 
-    s.send_data(client_address)
+# Control messages from all clients are handled on one persistent socket, while
+# acquisition runs in an executor so it never blocks them
+try:
+    asyncio.run(s.serve())
+except KeyboardInterrupt:
+    print("Server stopped.")
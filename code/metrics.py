@@ -0,0 +1,233 @@
+#
+# Low-overhead instrumentation of the hot path on the server and the client.
+#
+# Stages are timed with the `timed` decorator into histograms, and counters that the code keeps
+# anyway (datagrams sent, frames lost, ...) are read only when the metrics are collected. Both are
+# served in the Prometheus text format on http://127.0.0.1:<port>/metrics and printed as one log line
+# every few seconds.
+#
+# Environment variables:
+#   SPEC_METRICS=0                  turns everything off, `timed` then hands back the undecorated function
+#   SPEC_METRICS_PORT=9108          port of the endpoint, 0 for no endpoint
+#   SPEC_METRICS_LOG_INTERVAL=10    seconds between log lines, 0 for no log line
+#
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import functools
+import threading
+import weakref
+import bisect
+import time
+import os
+
+ENABLED = os.environ.get('SPEC_METRICS', '1').lower() not in ('0', 'off', 'false', 'no')
+
+# Upper bounds of the histogram buckets in seconds, from 10 us to 10 s
+BUCKETS = tuple(round(mantissa * 10.0 ** exponent, 9) for exponent in range(-5, 1)
+                for mantissa in (1, 2.5, 5)) + (10.0,)
+
+
+class Histogram:
+    '''Counts how long one stage takes, in the fixed `BUCKETS`.
+
+    Recording is a bisect and three additions. Updates from different threads are not locked,
+    so under heavy contention a few observations can be lost, which is fine for monitoring.
+
+    Attributes
+    ----------
+    stage (str): Name of the stage.
+    counts (list): Observations per bucket, the last one is above the largest bound.
+    total (float): Sum of all observations in seconds.
+    count (int): Number of observations.
+    '''
+    __slots__ = ('stage', 'counts', 'total', 'count')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        '''Records one duration.'''
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        '''Upper bound of the bucket that holds quantile `q` (0 to 1), None without observations.'''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    '''Holds the histograms of every stage and the objects whose counters are reported.'''
+    def __init__(self):
+        self.histograms = {}
+        # (weak reference, prefix, attribute names) of every watched object
+        self.watched = []
+        self.lock = threading.Lock()
+
+    def histogram(self, stage):
+        '''The histogram of `stage`, created the first time.'''
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(stage)
+            return histogram
+
+    def watch(self, obj, attributes, prefix):
+        '''Reports integer attributes of `obj` as counters named `<prefix>_<attribute>`.
+
+        The attributes are only read when the metrics are collected, so the hot path just keeps
+        counting as it does anyway. Counters of several objects with the same prefix are summed,
+        and objects are forgotten once they are garbage collected.
+        '''
+        with self.lock:
+            self.watched.append((weakref.ref(obj), prefix, tuple(attributes)))
+
+    def counters(self):
+        '''Current value of every counter, as a dictionary of name to value.'''
+        totals = {}
+        with self.lock:
+            self.watched = [entry for entry in self.watched if entry[0]() is not None]
+            watched = list(self.watched)
+        for reference, prefix, attributes in watched:
+            obj = reference()
+            if obj is None:
+                continue
+            for attribute in attributes:
+                name = "{}_{}".format(prefix, attribute)
+                totals[name] = totals.get(name, 0) + getattr(obj, attribute, 0)
+        return totals
+
+    def render(self):
+        '''All metrics in the Prometheus text format.'''
+        lines = ["# HELP spec_stage_seconds Time spent in each stage of the hot path.",
+                 "# TYPE spec_stage_seconds histogram"]
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append('spec_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, bound, cumulative))
+            lines.append('spec_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(stage, histogram.count))
+            lines.append('spec_stage_seconds_sum{{stage="{}"}} {!r}'.format(stage, histogram.total))
+            lines.append('spec_stage_seconds_count{{stage="{}"}} {}'.format(stage, histogram.count))
+        for name, value in sorted(self.counters().items()):
+            lines.append("# TYPE spec_{}_total counter".format(name))
+            lines.append("spec_{}_total {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        '''One line with the mean and p99 of every stage and every counter.'''
+        parts = []
+        for stage, histogram in sorted(self.histograms.items()):
+            if histogram.count:
+                parts.append("{} {:.0f}/{:.0f} us".format(stage, histogram.total / histogram.count * 1e6,
+                                                          histogram.quantile(0.99) * 1e6))
+        parts.extend("{} {}".format(name, value) for name, value in sorted(self.counters().items()))
+        return "metrics (mean/p99): " + ", ".join(parts)
+
+
+REGISTRY = Registry()
+
+
+def timed(stage):
+    '''Decorator that records how long every call of a function takes in the histogram of `stage`.
+
+    With `SPEC_METRICS=0` the function is returned as it is, so the instrumentation costs nothing.
+    '''
+    def decorate(func):
+        if not ENABLED:
+            return func
+        histogram = REGISTRY.histogram(stage)
+        perf_counter = time.perf_counter
+
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - start)
+        return timed_func
+    return decorate
+
+
+def watch(obj, attributes, prefix):
+    '''Reports counters of `obj`, see `Registry.watch`. Does nothing with `SPEC_METRICS=0`.'''
+    if ENABLED:
+        REGISTRY.watch(obj, attributes, prefix)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''Answers GET /metrics with `REGISTRY.render()`.'''
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the console
+        pass
+
+
+def start_http_server(port, host='127.0.0.1'):
+    '''Serves the metrics on http://host:port/metrics from a daemon thread.
+
+    Returns
+    -------
+    server: <class 'http.server.ThreadingHTTPServer'>
+    '''
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def start_log(interval):
+    '''Prints `REGISTRY.summary()` every `interval` seconds from a daemon thread.'''
+    def log():
+        while True:
+            time.sleep(interval)
+            print(REGISTRY.summary())
+    thread = threading.Thread(target=log, name="metrics-log", daemon=True)
+    thread.start()
+    return thread
+
+
+def start(port, log_interval=10.0):
+    '''Starts the endpoint and the log line, unless the metrics are off.
+
+    Parameters
+    ----------
+    port: <int>
+        Default port of the endpoint, `SPEC_METRICS_PORT` overrides it. 0 for no endpoint.
+    log_interval: <float>
+        Default seconds between log lines, `SPEC_METRICS_LOG_INTERVAL` overrides it. 0 for no log line.
+    '''
+    if not ENABLED:
+        return
+    port = int(os.environ.get('SPEC_METRICS_PORT', port))
+    log_interval = float(os.environ.get('SPEC_METRICS_LOG_INTERVAL', log_interval))
+    if port:
+        try:
+            start_http_server(port)
+            print("Metrics on http://127.0.0.1:{}/metrics.".format(port))
+        except OSError as e:
+            print("No metrics endpoint on port {}: {}".format(port, e))
+    if log_interval > 0:
+        start_log(log_interval)
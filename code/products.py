@@ -0,0 +1,165 @@
+#
+# Products the server derives from every spectrum, for clients that only need a few numbers per frame:
+# the strongest peaks (wavelength and height) and the integrated intensity of wavelength bands.
+# Clients ask for them when subscribing, e.g.
+#   {"cmd": "subscribe", ..., "products": {"peaks": 3, "threshold": 2000, "bands": [[540, 550], [575, 580]]}}
+#
+# They are sent as `protocol.MSG_PRODUCTS` frames: float32 values, the shape in the header is
+# (peaks, bands) and the payload is the peak wavelengths, then the peak heights, then the band integrals.
+#
+
+import json
+import zlib
+import numpy as np
+
+# Keys of the "products" dictionary of subscribe requests
+PRODUCT_KEYS = ('peaks', 'threshold', 'bands')
+
+# dtype the products are sent as
+PRODUCTS_DTYPE = np.dtype('<f4')
+
+
+def unpack_products(values, shape):
+    '''Splits the values of a products frame.
+
+    Parameters
+    ----------
+    values: <numpy.ndarray>
+        1D array of the payload.
+    shape: <tuple>
+        (peaks, bands) from the frame header.
+
+    Returns
+    -------
+    peaks: <numpy.ndarray>
+        (peaks, 2) array of wavelength and height, strongest peak first. Rows are NaN when
+        fewer peaks were found.
+    bands: <numpy.ndarray>
+        Integrated intensity of every band, in the order they were asked for.
+    '''
+    peaks = shape[0]
+    return np.column_stack((values[:peaks], values[peaks:2 * peaks])), values[2 * peaks:]
+
+
+class Products:
+    '''Computes the products one group of clients asked for, once per spectrum.
+
+    Peaks are the highest local maxima above `threshold`, located between pixels by fitting a parabola
+    through the maximum and its neighbours. Band integrals use the trapezoidal rule; the weights of
+    every pixel in every band are computed once per wavelength axis, so integrating all bands is one
+    matrix-vector product.
+
+    Attributes
+    ----------
+    peaks (int): Number of peaks reported.
+    threshold (float): Local maxima at or below this many counts are not peaks, None for no limit.
+    bands (tuple): (first, last) wavelength in nm of every band.
+    products_id (int): crc32 of the settings, sent in the `axis_id` field of the header.
+    '''
+    def __init__(self, peaks=0, threshold=None, bands=()):
+        '''Constructor for Products class.
+
+        Parameters
+        ----------
+        peaks: <int>
+            Number of peaks to report.
+        threshold: <float>
+            Local maxima at or below this many counts are not peaks, None for no limit.
+        bands: <list>
+            (first, last) wavelength in nm of every band to integrate.
+        '''
+        peaks = int(peaks)
+        if peaks < 0:
+            raise ValueError("peaks must not be negative")
+        self.peaks = peaks
+        self.threshold = None if threshold is None else float(threshold)
+        self.bands = tuple((float(min(band)), float(max(band))) for band in bands)
+        if not self.peaks and not self.bands:
+            raise ValueError("Ask for at least one peak or band")
+        self.products_id = zlib.crc32(json.dumps(self.key).encode())
+        self.wavelengths = None
+        self.weights = None
+        self.source_axis_id = None
+
+    @classmethod
+    def from_request(cls, products):
+        '''Makes the products of the `"products"` dictionary of a request, None if it is empty.'''
+        if not products:
+            return None
+        unknown = set(products) - set(PRODUCT_KEYS)
+        if unknown:
+            raise ValueError("Unknown products {}".format(", ".join(sorted(unknown))))
+        return cls(**products)
+
+    @property
+    def key(self):
+        '''Hashable settings, clients with the same key share one products stream.'''
+        return (self.peaks, self.threshold, self.bands)
+
+    @property
+    def shape(self):
+        '''(peaks, bands), written to the header of every products frame.'''
+        return (self.peaks, len(self.bands))
+
+    def set_axis(self, wavelengths, axis_id):
+        '''Computes the trapezoid weights of the bands on a (new) wavelength axis.
+
+        Parameters
+        ----------
+        wavelengths: <numpy.ndarray>
+            Full wavelength axis of the spectrometer, ascending.
+        axis_id: <int>
+            Axis id of `wavelengths`, the weights are only computed again when it changes.
+        '''
+        if axis_id == self.source_axis_id:
+            return
+        self.wavelengths = wavelengths
+        self.weights = np.zeros((len(self.bands), len(wavelengths)))
+        for row, (first, last) in enumerate(self.bands):
+            start = np.searchsorted(wavelengths, first)
+            stop = np.searchsorted(wavelengths, last, 'right')
+            steps = np.diff(wavelengths[start:stop]) / 2
+            # Every interval between two pixels adds half its width to both of them
+            self.weights[row, start:stop - 1] += steps
+            self.weights[row, start + 1:stop] += steps
+        self.source_axis_id = axis_id
+
+    def compute(self, intensities):
+        '''Computes the products of one spectrum.
+
+        Parameters
+        ----------
+        intensities: <numpy.ndarray>
+            1D array of intensities on the axis given to `set_axis`.
+
+        Returns
+        -------
+        values: <numpy.ndarray>
+            float32 payload, see `unpack_products`.
+        '''
+        values = np.full(2 * self.peaks + len(self.bands), np.nan, dtype=PRODUCTS_DTYPE)
+        if self.peaks:
+            self.find_peaks(intensities, values)
+        if self.bands:
+            values[2 * self.peaks:] = self.weights @ intensities
+        return values
+
+    def find_peaks(self, intensities, values):
+        '''Writes the wavelength and height of the `peaks` highest local maxima into `values`.'''
+        left, middle, right = intensities[:-2], intensities[1:-1], intensities[2:]
+        is_peak = (middle > left) & (middle >= right)
+        if self.threshold is not None:
+            is_peak &= middle > self.threshold
+        candidates = np.flatnonzero(is_peak)
+        if len(candidates) > self.peaks:
+            candidates = candidates[np.argpartition(middle[candidates], -self.peaks)[-self.peaks:]]
+        candidates = candidates[np.argsort(middle[candidates])[::-1]]
+        # Vertex of the parabola through each maximum and its neighbours
+        a, b, c = left[candidates], middle[candidates], right[candidates]
+        curvature = a - 2 * b + c
+        offsets = np.divide(0.5 * (a - c), curvature, out=np.zeros(len(candidates)), where=curvature != 0)
+        pixels = candidates + 1
+        spacing = (self.wavelengths[pixels + 1] - self.wavelengths[pixels - 1]) / 2
+        found = len(candidates)
+        values[:found] = self.wavelengths[pixels] + offsets * spacing
+        values[self.peaks:self.peaks + found] = b - 0.25 * (a - c) * offsets
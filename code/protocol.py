@@ -0,0 +1,735 @@
+import socket
+import struct
+import sys
+import time
+import numpy as np
+
+# Every datagram starts with this header, all in network byte order:
+#   magic, version, message type, stream id, device, frame id, chunk index, chunk count,
+#   chunk size, dtype code, codec, flags, rows, columns, acquisition timestamp, payload size
+#   of the whole frame, id of the wavelength axis the frame belongs to
+# The device is the index of the spectrometer in the server's device list.
+# The codec and flags fields are explained in `spec_codecs.py`. Every chunk but the last
+# one is `chunk size` bytes long, so chunk i always starts at i * chunk size in the frame.
+HEADER = struct.Struct('!2sBBHBIHHHBBBIIdII')
+HEADER_SIZE = HEADER.size
+MAGIC = b'SP'
+PROTOCOL_VERSION = 5
+
+# Largest possible UDP payload
+MAX_DATAGRAM = 65507
+# Smallest datagram a receiver may say it can take: every IPv4 host accepts 576 byte packets
+MIN_DATAGRAM = 548
+
+# MTU assumed when the path MTU can not be read, and the IPv4 + UDP headers that come out of it
+DEFAULT_MTU = 1500
+IP_UDP_OVERHEAD = 28
+# socket.IP_MTU is missing from some Python builds, this is its value on Linux
+IP_MTU = getattr(socket, 'IP_MTU', 14)
+
+# recvmsg_into is not available on Windows, where datagrams are received into a scratch buffer
+HAS_RECVMSG_INTO = hasattr(socket.socket, 'recvmsg_into')
+
+# Message types, each type (of each device) has its own sequence of frame ids
+MSG_FRAME = 1  # intensities of one spectrum
+MSG_AXIS = 2   # wavelength axis, sent once per session and whenever the calibration changes
+MSG_PRODUCTS = 3  # peaks and band integrals of one spectrum, see `products.py`
+MSG_BURST = 4  # every spectrum of one triggered shot, see `spec_codecs.encode_burst`
+
+# dtype <-> code used in the header
+DTYPES = {0: np.dtype('<f8'), 1: np.dtype('<f4'), 2: np.dtype('<u2'), 3: np.dtype('<i2'), 4: np.dtype('<i4')}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+# How many frames can be in flight at once before the oldest one is given up on, including
+# complete frames that wait for an older one to be retransmitted
+MAX_PENDING_FRAMES = 8
+
+# Message types whose lost chunks are asked for again, see `FrameAssembler`. Axes are requested again as a whole.
+NACK_TYPES = (MSG_FRAME, MSG_PRODUCTS, MSG_BURST)
+# How often the chunks of a frame are asked for before it is given up on
+MAX_NACKS = 2
+
+# Used to clear the chunk bitmap of a reused frame buffer without allocating
+ZEROS = memoryview(bytes(65536))
+
+
+def newer(a, b):
+    '''True if frame id `a` comes after `b`, allowing the 32 bit counter to wrap around.'''
+    return a != b and (a - b) & 0xffffffff < 0x80000000
+
+
+def path_chunk_size(address, mtu=None):
+    '''Largest payload per datagram that reaches `address` without IP fragmentation.
+
+    Parameters
+    ----------
+    address: <tuple>
+        (IP, port) the datagrams are sent to, unicast or multicast.
+    mtu: <int>
+        MTU to use, e.g. 9000 on a LAN with jumbo frames. None reads the MTU of the route to
+        `address` from the kernel (Linux only), falling back to `DEFAULT_MTU`.
+
+    Returns
+    -------
+    chunk_size: <int>
+    '''
+    if mtu is None:
+        mtu = DEFAULT_MTU
+        if sys.platform.startswith('linux'):
+            probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                probe.connect(tuple(address))
+                mtu = probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+            except OSError:
+                pass
+            finally:
+                probe.close()
+    return max(1, min(mtu - IP_UDP_OVERHEAD, MAX_DATAGRAM) - HEADER_SIZE)
+
+
+def pack_frame(payload, frame_id, dtype, shape, timestamp, chunk_size, stream_id=0,
+               msg_type=MSG_FRAME, axis_id=0, codec=0, flags=0, device=0):
+    '''Splits a frame into datagrams that each carry a header.
+
+    The payload is not copied: every datagram is a header plus a memoryview of its slice of the
+    payload, ready for scatter/gather sends with `socket.sendmsg`.
+
+    Parameters
+    ----------
+    payload: <bytes>
+        Encoded (possibly compressed) frame.
+    frame_id: <int>
+        Sequence number of the frame.
+    dtype: <numpy.dtype>
+        dtype of the array the payload decodes into.
+    shape: <tuple>
+        Shape of the array the payload decodes into, at most 2 dimensions.
+    timestamp: <float>
+        Acquisition time in seconds since the epoch.
+    chunk_size: <int>
+        Maximum number of payload bytes per datagram.
+    stream_id: <int>
+        Identifies the sender, so receivers can tell a restarted server from stale frames.
+    msg_type: <int>
+        One of the `MSG_*` message types.
+    axis_id: <int>
+        Id of the wavelength axis (crc32 of the axis), so receivers can tell if their cached axis is stale.
+    codec: <int>
+        How the values are stored, see `spec_codecs.py`.
+    flags: <int>
+        Codec flags such as `spec_codecs.FLAG_ZLIB`.
+    device: <int>
+        Index of the spectrometer the frame comes from.
+
+    Returns
+    -------
+    datagrams: <list>
+        List of `(header, payload slice)` pairs, one per datagram. An empty payload still
+        produces one datagram.
+    '''
+    rows, cols = shape if len(shape) == 2 else (1, shape[0])
+    view = memoryview(payload)
+    chunk_count = max(1, -(-len(view) // chunk_size))
+    dtype_code = DTYPE_CODES[np.dtype(dtype)]
+    datagrams = []
+    for i in range(chunk_count):
+        header = HEADER.pack(MAGIC, PROTOCOL_VERSION, msg_type, stream_id, device, frame_id & 0xffffffff,
+                             i, chunk_count, chunk_size, dtype_code, codec, flags, rows, cols,
+                             timestamp, len(view), axis_id)
+        datagrams.append((header, view[i * chunk_size:(i + 1) * chunk_size]))
+    return datagrams
+
+
+def fec_from_request(fec):
+    '''(k, m) of the `"fec"` dictionary of a subscribe request, e.g. `{"k": 8, "m": 1}`, None if it is empty.'''
+    if not fec:
+        return None
+    unknown = set(fec) - {'k', 'm'}
+    if unknown:
+        raise ValueError("Unknown FEC setting {}".format(", ".join(sorted(unknown))))
+    k, m = int(fec['k']), int(fec.get('m', 1))
+    if k < 1 or not 1 <= m <= k:
+        raise ValueError("FEC needs k >= 1 and 1 <= m <= k, got k={} m={}".format(k, m))
+    return k, m
+
+
+def add_parity(datagrams, k, m):
+    '''Adds forward error correction parity datagrams to the datagrams of one frame.
+
+    Chunks are taken in groups of `k`, and every group gets `m` parity datagrams: parity j is the XOR of
+    chunks j, j + m, j + 2m, ... of the group, the short last chunk padded with zeros. A receiver rebuilds
+    a chunk if it is the only one missing among the chunks of its parity, so up to `m` lost chunks per
+    group if they belong to different parities, e.g. any burst of up to `m` consecutive chunks.
+
+    Parity datagrams carry the header of the frame with chunk index `chunk_count + group * m + j`, so
+    receivers without FEC drop them. They are sent after the data chunks of their group.
+
+    Parameters
+    ----------
+    datagrams: <list>
+        `(header, payload slice)` pairs of one frame from `pack_frame`.
+    k: <int>
+        Data chunks per group.
+    m: <int>
+        Parity datagrams per group, the overhead is m / k.
+
+    Returns
+    -------
+    datagrams: <list>
+        The data and parity `(header, payload slice)` pairs, or `datagrams` as they are if the chunk
+        index would overflow.
+    '''
+    fields = list(HEADER.unpack(datagrams[0][0]))
+    count, chunk_size = fields[7], fields[8]
+    groups = -(-count // k)
+    if count + groups * m > 0xffff:
+        return datagrams
+    # XOR 8 bytes at a time, over every group at once
+    padded = -(-chunk_size // 8) * 8
+    chunks = np.zeros((groups * k, padded), dtype=np.uint8)
+    for index, (_, payload) in enumerate(datagrams):
+        chunks[index, :len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+    words = chunks.view('<u8').reshape(groups, k, padded // 8)
+    parity = np.empty((groups, m, padded // 8), dtype='<u8')
+    for j in range(m):
+        np.bitwise_xor.reduce(words[:, j::m], axis=1, out=parity[:, j])
+    parity = memoryview(np.ascontiguousarray(parity.view(np.uint8)[:, :, :chunk_size]).tobytes())
+    protected = []
+    for group in range(groups):
+        protected.extend(datagrams[group * k:(group + 1) * k])
+        for j in range(m):
+            index = group * m + j
+            fields[6] = count + index
+            protected.append((HEADER.pack(*fields), parity[index * chunk_size:(index + 1) * chunk_size]))
+    return protected
+
+
+def unpack_header(datagram):
+    '''Reads the header at the start of a datagram (any bytes-like object).
+
+    Returns
+    -------
+    header: <tuple>
+        `(msg_type, stream_id, device, frame_id, chunk_index, chunk_count, chunk_size, dtype, codec,
+        flags, shape, timestamp, frame_size, axis_id)` or None if the datagram is not part of this protocol.
+    '''
+    if len(datagram) < HEADER_SIZE:
+        return None
+    (magic, version, msg_type, stream_id, device, frame_id, chunk_index, chunk_count, chunk_size, dtype_code,
+     codec, flags, rows, cols, timestamp, frame_size, axis_id) = HEADER.unpack_from(datagram)
+    if magic != MAGIC or version != PROTOCOL_VERSION or dtype_code not in DTYPES:
+        return None
+    return (msg_type, stream_id, device, frame_id, chunk_index, chunk_count, chunk_size, DTYPES[dtype_code],
+            codec, flags, (rows, cols), timestamp, frame_size, axis_id)
+
+
+class Frame:
+    '''A reassembled frame.
+
+    Attributes
+    ----------
+    msg_type (int): One of the `MSG_*` message types.
+    frame_id (int): Sequence number given by the server.
+    dtype (numpy.dtype): dtype of the values in the payload.
+    codec (int): How the values are stored, see `spec_codecs.py`.
+    flags (int): Codec flags.
+    shape (tuple): Shape of the decoded array.
+    timestamp (float): Acquisition time in seconds since the epoch.
+    axis_id (int): Id of the wavelength axis the frame belongs to.
+    payload (memoryview): Encoded frame. Frames from `FrameAssembler` point into a reused buffer,
+        so the payload is only valid until the next datagram is added.
+    device (int): Index of the spectrometer the frame comes from.
+    '''
+    __slots__ = ('msg_type', 'frame_id', 'dtype', 'codec', 'flags', 'shape', 'timestamp', 'axis_id', 'payload',
+                 'device')
+
+    def __init__(self, msg_type, frame_id, dtype, codec, flags, shape, timestamp, axis_id, payload, device=0):
+        self.msg_type = msg_type
+        self.frame_id = frame_id
+        self.dtype = dtype
+        self.codec = codec
+        self.flags = flags
+        self.shape = shape
+        self.timestamp = timestamp
+        self.axis_id = axis_id
+        self.payload = payload
+        self.device = device
+
+    def detach(self):
+        '''Copies the payload out of the assembler's buffer so the frame can be kept around.'''
+        self.payload = bytes(self.payload)
+        return self
+
+
+class FrameBuffer:
+    '''Reusable buffer that the chunks of one frame are received into at their offsets.'''
+    __slots__ = ('buffer', 'view', 'key', 'header', 'chunk_size', 'received', 'count', 'size', 'nacks', 'last_nack',
+                 'parity', 'parity_view', 'parity_received', 'has_parity')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.view = memoryview(self.buffer)
+        self.received = bytearray()
+        self.parity = bytearray()
+        self.parity_view = memoryview(self.parity)
+        self.parity_received = bytearray()
+        self.has_parity = False
+
+    def start(self, key, header, chunk_count, chunk_size, frame_size):
+        '''Prepares the buffer for a new frame, growing it only if the frame does not fit.'''
+        capacity = chunk_count * chunk_size
+        if len(self.buffer) < capacity:
+            self.view.release()
+            self.buffer = bytearray(capacity)
+            self.view = memoryview(self.buffer)
+        if len(self.received) == chunk_count:
+            self.received[:] = ZEROS[:chunk_count]
+        else:
+            self.received = bytearray(chunk_count)
+        self.key = key
+        self.header = header
+        self.chunk_size = chunk_size
+        self.count = 0
+        self.size = 0
+        self.nacks = 0
+        self.last_nack = 0.0
+        self.has_parity = False
+
+    def start_parity(self, parity_count):
+        '''Prepares the parity buffer when the first parity datagram of the frame arrives, see `add_parity`.'''
+        if self.has_parity:
+            return
+        capacity = parity_count * self.chunk_size
+        if len(self.parity) < capacity:
+            self.parity_view.release()
+            self.parity = bytearray(capacity)
+            self.parity_view = memoryview(self.parity)
+        if len(self.parity_received) == parity_count:
+            self.parity_received[:] = ZEROS[:parity_count]
+        else:
+            self.parity_received = bytearray(parity_count)
+        self.has_parity = True
+
+    def missing(self):
+        '''Bitmask of the chunks that have not arrived yet, bit i stands for chunk i.'''
+        return sum(1 << index for index, received in enumerate(self.received) if not received)
+
+
+class FrameAssembler:
+    '''Reassembles frames from datagrams that may arrive lost, duplicated or out of order.
+
+    Frames older than the last delivered one of the same device and message type are dropped as stale.
+
+    Lost chunks are asked for again instead of giving up on their frame (selective retransmission):
+    when a newer frame of the same device and type starts while an older one is still missing chunks,
+    a NACK with the bitmap of the missing chunks is queued in `nacks`, and frame ids that were skipped
+    entirely are asked for as a whole. Complete frames behind a frame that is being recovered are held
+    back, so frames are still delivered in order and delta frames keep their reference. A frame is
+    given up on once it was asked for `MAX_NACKS` times and nothing came for `recovery_window` seconds
+    after the last NACK, or when `MAX_PENDING_FRAMES` are in flight. Deadlines are checked whenever a
+    frame starts, and by `expire` when nothing arrives. With a `recovery_window` of 0, frames that are
+    still missing chunks are given up on as soon as a newer frame completes and nothing is asked for again.
+
+    With `fec` set, lost chunks are first rebuilt from the parity datagrams of their group (see
+    `add_parity`) as soon as the parity arrives, without a round trip. NACKs are only sent for what
+    parity could not rebuild.
+
+    Datagrams are received straight into a small pool of reusable frame buffers (see `receive`),
+    so once the pool has grown to the frame size, reassembly allocates no new buffers.
+
+    Attributes
+    ----------
+    recovery_window (float): Seconds to wait for retransmitted chunks after each NACK, 0 turns NACKs off.
+    fec (tuple): (k, m) of the parity the sender adds, see `add_parity`. None drops parity datagrams.
+    nacks (list): `(device, msg_type, frame_id, missing)` of every NACK the owner should send, where missing
+        is the bitmask of the missing chunks or None for the whole frame. The owner empties the list.
+    datagrams_received (int): Datagrams received, including the ones that were dropped.
+    frames_received (int): Frames delivered.
+    frames_lost (int): Frame ids skipped between delivered frames, whether partly received or not at all.
+    datagrams_dropped (int): Duplicate, stale or malformed datagrams.
+    nacks_sent (int): NACKs queued.
+    frames_recovered (int): Frames completed after their missing chunks were asked for again.
+    chunks_rebuilt (int): Lost chunks rebuilt from parity datagrams.
+    '''
+    def __init__(self, recovery_window=0.0, fec=None):
+        '''Constructor for FrameAssembler class.
+
+        Parameters
+        ----------
+        recovery_window: <float>
+            Seconds to wait for retransmitted chunks after each NACK. 0 turns NACKs off, for
+            receivers that can not reach the sender's control socket.
+        fec: <tuple>
+            (k, m) of the parity the sender adds, None if it adds none.
+        '''
+        self.recovery_window = recovery_window
+        self.fec = fec
+        self.header_buffer = bytearray(HEADER_SIZE)
+        self.scratch = bytearray(MAX_DATAGRAM)
+        self.scratch_view = memoryview(self.scratch)
+        self.free = [FrameBuffer() for _ in range(MAX_PENDING_FRAMES + 1)]
+        self.pending = {}
+        self.held = {}
+        self.ready = []
+        self.delivered = None
+        self.reset()
+
+    def reset(self):
+        '''Forgets all state, e.g. after resubscribing.'''
+        self._clear()
+        self.stream_id = None
+        self.nacks = []
+        self.datagrams_received = 0
+        self.frames_received = 0
+        self.frames_lost = 0
+        self.datagrams_dropped = 0
+        self.nacks_sent = 0
+        self.frames_recovered = 0
+        self.chunks_rebuilt = 0
+
+    def _clear(self):
+        '''Gives up on every pending and held frame and forgets the last frame ids.'''
+        for entry in list(self.pending.values()) + list(self.held.values()) + [entry for entry, _ in self.ready]:
+            self.free.append(entry)
+        self.pending = {}
+        self.held = {}
+        self.ready = []
+        # Frame ids that were skipped entirely, with [NACKs sent, time of the last one]
+        self.gaps = {}
+        self.highest_frame_ids = {}
+        # Newest frame id given up on per sequence, late chunks of it must not start it over
+        self.given_up = {}
+        self.predicted = None
+        self.last_frame_ids = {}
+
+    def receive(self, sock):
+        '''Receives one datagram from `sock` and adds it.
+
+        Chunks of a frame usually arrive in order, so the payload is received with `recvmsg_into`
+        straight into the slot of the chunk expected next. If the guess was wrong, or on systems
+        without `recvmsg_into`, the payload is copied once from where it landed to its offset.
+
+        Parameters
+        ----------
+        sock: <socket.socket>
+
+        Returns
+        -------
+        frame: <class 'Frame'> or None
+            The next frame in order, if this datagram (or an earlier one) completed it. Frames that
+            were held back are handed out one per call without receiving a datagram.
+        '''
+        self._release_delivered()
+        if self.ready:
+            return self._next_ready()
+        if HAS_RECVMSG_INTO and self.predicted is not None:
+            entry, index = self.predicted
+            start = index * entry.chunk_size
+            slot = entry.view[start:start + entry.chunk_size]
+            nbytes = sock.recvmsg_into([self.header_buffer, slot, self.scratch_view])[0]
+            if nbytes < HEADER_SIZE:
+                self.datagrams_received += 1
+                self.datagrams_dropped += 1
+                return None
+            length = nbytes - HEADER_SIZE
+            in_slot = min(length, len(slot))
+            self._add(self.header_buffer, length, (slot[:in_slot], self.scratch_view[:length - in_slot]),
+                      landed=(entry, index))
+        else:
+            nbytes = sock.recv_into(self.scratch)
+            self._add(self.scratch_view, nbytes - HEADER_SIZE, (self.scratch_view[HEADER_SIZE:nbytes],))
+        return self._next_ready()
+
+    def add(self, datagram):
+        '''Adds one datagram that was already received.
+
+        Parameters
+        ----------
+        datagram: <bytes>
+
+        Returns
+        -------
+        frame: <class 'Frame'> or None
+            The next frame in order, if this datagram (or an earlier one) completed it.
+        '''
+        self._release_delivered()
+        view = memoryview(datagram)
+        self._add(view, len(view) - HEADER_SIZE, (view[HEADER_SIZE:],))
+        return self._next_ready()
+
+    def _release_delivered(self):
+        '''The buffer of the last delivered frame can be reused once the caller is done with it.'''
+        if self.delivered is not None:
+            self.free.append(self.delivered)
+            self.delivered = None
+
+    def _next_ready(self):
+        '''Hands out the oldest frame that is ready, None if there is none.'''
+        if not self.ready:
+            return None
+        self.delivered, frame = self.ready.pop(0)
+        return frame
+
+    def _add(self, header_source, length, pieces, landed=None):
+        '''Places a payload (given as one or more memoryview `pieces`) into its frame buffer.'''
+        self.datagrams_received += 1
+        header = unpack_header(header_source)
+        if header is None or length < 0:
+            self.datagrams_dropped += 1
+            return
+        (msg_type, stream_id, device, frame_id, chunk_index, chunk_count, chunk_size, dtype,
+         codec, flags, shape, timestamp, frame_size, axis_id) = header
+
+        if stream_id != self.stream_id:
+            # New or restarted server, frame ids start over
+            self._clear()
+            self.stream_id = stream_id
+        # Every device numbers its frames and axes on its own
+        sequence = (device, msg_type)
+        last_frame_id = self.last_frame_ids.get(sequence)
+        key = (sequence, frame_id)
+        if (last_frame_id is not None and not newer(frame_id, last_frame_id)) or key in self.held:
+            if chunk_index < chunk_count:
+                # Parity of a frame that arrived whole is expected, not dropped
+                self.datagrams_dropped += 1
+            return
+
+        entry = self.pending.get(key)
+        if entry is None:
+            given_up = self.given_up.get(sequence)
+            if given_up is not None and not newer(frame_id, given_up):
+                self.datagrams_dropped += 1
+                return
+            if self.recovery_window and msg_type in NACK_TYPES:
+                self._request_missing(sequence, frame_id)
+            while len(self.pending) + len(self.held) >= MAX_PENDING_FRAMES:
+                self._give_up_oldest()
+            # Both can deliver newer frames or give up on this one, which then comes too late.
+            # A skipped frame stays in `gaps` until it is pending, so newer frames wait for it
+            last_frame_id = self.last_frame_ids.get(sequence)
+            given_up = self.given_up.get(sequence)
+            if ((last_frame_id is not None and not newer(frame_id, last_frame_id))
+                    or (given_up is not None and not newer(frame_id, given_up))):
+                self.datagrams_dropped += 1
+                return
+            gap = self.gaps.pop(key, None)
+            entry = self.free.pop()
+            entry.start(key, header, chunk_count, chunk_size, frame_size)
+            if gap is not None:
+                # A frame that was asked for as a whole
+                entry.nacks, entry.last_nack = gap
+            self.pending[key] = entry
+        if chunk_index >= chunk_count and chunk_count == len(entry.received):
+            self._add_parity(entry, chunk_index - chunk_count, length, pieces)
+            return
+        if (chunk_index >= len(entry.received) or entry.received[chunk_index]
+                or length > entry.chunk_size or chunk_size != entry.chunk_size):
+            self.datagrams_dropped += 1
+            return
+
+        if landed != (entry, chunk_index):
+            # Not where recvmsg_into guessed, copy it to its offset
+            offset = chunk_index * chunk_size
+            for piece in pieces:
+                entry.view[offset:offset + len(piece)] = piece
+                offset += len(piece)
+        entry.received[chunk_index] = 1
+        entry.count += 1
+        entry.size += length
+        if entry.count < chunk_count:
+            # Guess that the next datagram is the next missing chunk of this frame
+            following = chunk_index + 1
+            self.predicted = (entry, following) if following < chunk_count and not entry.received[following] else None
+            return
+        self._complete(entry)
+
+    def _add_parity(self, entry, index, length, pieces):
+        '''Keeps parity datagram `index` of a frame and rebuilds the chunk it covers if that is the only one missing.'''
+        count = len(entry.received)
+        if self.fec is None or length != entry.chunk_size:
+            self.datagrams_dropped += 1
+            return
+        k, m = self.fec
+        group, j = divmod(index, m)
+        if group * k >= count:
+            self.datagrams_dropped += 1
+            return
+        entry.start_parity(-(-count // k) * m)
+        if entry.parity_received[index]:
+            self.datagrams_dropped += 1
+            return
+        offset = index * entry.chunk_size
+        for piece in pieces:
+            entry.parity_view[offset:offset + len(piece)] = piece
+            offset += len(piece)
+        entry.parity_received[index] = 1
+        # After the last parity of a group come the data chunks of the next one
+        following = (group + 1) * k
+        self.predicted = (entry, following) if j == m - 1 and following < count and not entry.received[following] else None
+        covered = range(group * k + j, min((group + 1) * k, count), m)
+        missing = [chunk for chunk in covered if not entry.received[chunk]]
+        if len(missing) != 1:
+            return
+        self._rebuild(entry, missing[0], covered, index)
+        if entry.count == count:
+            self._complete(entry)
+
+    def _rebuild(self, entry, lost, covered, index):
+        '''Rebuilds chunk `lost` as the XOR of parity `index` and the other chunks it covers.'''
+        chunk_size, frame_size = entry.chunk_size, entry.header[12]
+        chunk = np.frombuffer(entry.parity, dtype=np.uint8, count=chunk_size, offset=index * chunk_size).copy()
+        for other in covered:
+            if other != lost:
+                length = min(chunk_size, frame_size - other * chunk_size)
+                chunk[:length] ^= np.frombuffer(entry.buffer, dtype=np.uint8, count=length, offset=other * chunk_size)
+        length = max(0, min(chunk_size, frame_size - lost * chunk_size))
+        entry.view[lost * chunk_size:lost * chunk_size + length] = chunk[:length]
+        entry.received[lost] = 1
+        entry.count += 1
+        entry.size += length
+        self.chunks_rebuilt += 1
+
+    def _complete(self, entry):
+        '''Moves a frame whose chunks are all in to the held frames and delivers every frame that is ready.'''
+        key = entry.key
+        sequence, frame_id = key
+        del self.pending[key]
+        self.predicted = None
+        if entry.size != entry.header[12]:
+            self.datagrams_dropped += len(entry.received)
+            self.free.append(entry)
+            return
+        if entry.nacks:
+            self.frames_recovered += 1
+        self.held[key] = entry
+        if not self.recovery_window or sequence[1] not in NACK_TYPES:
+            # Nothing is asked for again, older frames that are still missing chunks are given up on
+            for older in [k for k in self.pending if k[0] == sequence and newer(frame_id, k[1])]:
+                self._discard(older)
+        self._flush(sequence)
+
+    def _request_missing(self, sequence, frame_id):
+        '''Queues NACKs for the frames of `sequence` before `frame_id` that are still missing chunks.
+
+        Called when frame `frame_id` starts. Frames are asked for again at most every `recovery_window`
+        seconds and given up on after `MAX_NACKS` NACKs.
+        '''
+        now = time.monotonic()
+        highest = self.highest_frame_ids.get(sequence)
+        if highest is None or newer(frame_id, highest):
+            skipped = (frame_id - highest - 1) & 0xffffffff if highest is not None else 0
+            # Larger jumps come from a new reduction or a settings change, not from lost frames
+            if skipped <= MAX_PENDING_FRAMES:
+                for offset in range(1, skipped + 1):
+                    self.gaps[sequence, (highest + offset) & 0xffffffff] = [0, 0.0]
+            self.highest_frame_ids[sequence] = frame_id
+        older = [k for k in list(self.pending) + list(self.gaps) if k[0] == sequence and newer(frame_id, k[1])]
+        self._nack_due(older, now)
+        self._flush(sequence)
+
+    def expire(self):
+        '''Asks for every frame that is still missing chunks, for when no newer frame arrives to notice them.
+
+        A frame that loses its last chunks right before a pause (between two hardware triggers, at the
+        end of a burst or when the stream stops) has no newer frame behind it, so `_request_missing` never
+        runs for it. The owner calls this once nothing arrived for `recovery_window` seconds; frames are
+        asked for again or given up on as usual, and the frames held behind them become ready.
+        '''
+        if not self.recovery_window:
+            return
+        keys = [k for k in self.pending if k[0][1] in NACK_TYPES] + list(self.gaps)
+        self._nack_due(keys, time.monotonic())
+        for sequence in {key[0] for key in keys}:
+            self._flush(sequence)
+
+    def _nack_due(self, keys, now):
+        '''Queues NACKs for the frames `keys` (pending or skipped) that were not asked for within `recovery_window`.
+
+        Frames that were asked for `MAX_NACKS` times already are given up on.
+        '''
+        for key in keys:
+            entry = self.pending.get(key)
+            if entry is not None:
+                nacks, last_nack = entry.nacks, entry.last_nack
+            elif key in self.gaps:
+                nacks, last_nack = self.gaps[key]
+            else:
+                continue
+            if now - last_nack < self.recovery_window:
+                continue
+            if nacks >= MAX_NACKS:
+                self._give_up(key)
+                continue
+            if entry is not None:
+                entry.nacks += 1
+                entry.last_nack = now
+                missing = entry.missing()
+            else:
+                self.gaps[key] = [nacks + 1, now]
+                missing = None
+            (device, msg_type), frame_id = key
+            self.nacks.append((device, msg_type, frame_id, missing))
+            self.nacks_sent += 1
+
+    def _give_up_oldest(self):
+        '''Makes room for a new frame by giving up on the oldest frame that others wait for.'''
+        if self.pending:
+            key = next(iter(self.pending))
+            self._give_up(key)
+        else:
+            # Only complete frames are in flight, they wait for frames that never arrived
+            key = next(iter(self.held))
+            for gap in [k for k in self.gaps if k[0] == key[0] and newer(key[1], k[1])]:
+                self._give_up(gap)
+        self._flush(key[0])
+
+    def _give_up(self, key):
+        '''Gives up on a frame that is missing chunks, or was skipped entirely, before a newer one is delivered.'''
+        if key in self.pending:
+            self._discard(key)
+        else:
+            del self.gaps[key]
+        sequence, frame_id = key
+        given_up = self.given_up.get(sequence)
+        if given_up is None or newer(frame_id, given_up):
+            self.given_up[sequence] = frame_id
+
+    def _flush(self, sequence):
+        '''Delivers the held frames of `sequence`, oldest first, until one has to wait for an older frame.'''
+        while True:
+            held = [k for k in self.held if k[0] == sequence]
+            if not held:
+                return
+            key = held[0]
+            for other in held[1:]:
+                if newer(key[1], other[1]):
+                    key = other
+            frame_id = key[1]
+            for waiting in (self.pending, self.gaps):
+                if any(k[0] == sequence and newer(frame_id, k[1]) for k in waiting):
+                    return
+            entry = self.held.pop(key)
+            self._deliver(sequence, frame_id)
+            (msg_type, _, device, _, _, _, _, dtype, codec, flags, shape, timestamp, frame_size,
+             axis_id) = entry.header
+            self.ready.append((entry, Frame(msg_type, frame_id, dtype, codec, flags, shape, timestamp, axis_id,
+                                            entry.view[:frame_size], device)))
+
+    def _discard(self, key):
+        '''Gives up on a pending frame and returns its buffer to the pool.'''
+        entry = self.pending.pop(key)
+        if self.predicted is not None and self.predicted[0] is entry:
+            self.predicted = None
+        self.free.append(entry)
+
+    def _deliver(self, sequence, frame_id):
+        '''Updates counters and drops pending frames of the same device and type that are now stale.'''
+        last_frame_id = self.last_frame_ids.get(sequence)
+        if last_frame_id is not None:
+            self.frames_lost += ((frame_id - last_frame_id) & 0xffffffff) - 1
+        for key in [k for k in self.pending if k[0] == sequence and newer(frame_id, k[1])]:
+            self._discard(key)
+        for key in [k for k in self.gaps if k[0] == sequence and not newer(k[1], frame_id)]:
+            del self.gaps[key]
+        self.last_frame_ids[sequence] = frame_id
+        self.frames_received += 1
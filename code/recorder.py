@@ -0,0 +1,264 @@
+#
+# Records streamed spectra to disk as they arrive.
+#
+# A run is a directory with:
+#   chunk_00000.npy, ...       intensities, one preallocated memory-mapped (frames, pixels) array per chunk
+#   wavelengths_<axis>.npy     every wavelength axis of the run, written once
+#   index.csv                  one row per frame: where it is stored, its timestamp and the settings
+#
+
+import csv
+import os
+import time
+import zlib
+import numpy as np
+
+CHUNK_NAME = 'chunk_{:05d}.npy'
+AXIS_NAME = 'wavelengths_{:08x}.npy'
+INDEX_NAME = 'index.csv'
+INDEX_FIELDS = ['frame', 'frame_id', 'timestamp', 'chunk', 'row', 'axis_id', 'trig_val', 'int_time_micros']
+
+
+def read_index(path):
+    '''Reads the index of a run.
+
+    Parameters
+    ----------
+    path: <str>
+        Directory of the run.
+
+    Returns
+    -------
+    rows: <list>
+        One dictionary per frame with the keys in `INDEX_FIELDS`, as strings.
+    '''
+    with open(os.path.join(path, INDEX_NAME), newline='') as f:
+        return list(csv.DictReader(f))
+
+
+class RunRecorder:
+    '''Streams spectra to a run directory in constant memory.
+
+    Intensities are written into preallocated memory-mapped `.npy` chunks, so the data is in the
+    page cache (and survives the process being killed) as soon as it is recorded. Index rows are
+    buffered and flushed every `flush_interval` seconds, so a kill loses at most the rows of that
+    last interval. A chunk is only unmapped once it is full.
+
+    Attributes
+    ----------
+    path (str): Directory of the run.
+    chunk_frames (int): Frames per chunk file.
+    flush_interval (float): Seconds between flushes of the index and the current chunk.
+    frames (int): Frames recorded so far.
+    '''
+    def __init__(self, path, chunk_frames=1024, flush_interval=1.0, dtype=np.float64):
+        '''Constructor for RunRecorder class.
+
+        Parameters
+        ----------
+        path: <str>
+            Directory of the run, created if it does not exist.
+        chunk_frames: <int>
+            Frames per chunk file. A chunk of 1024 frames of 3648 float64 pixels is 30 MB.
+        flush_interval: <float>
+            Seconds between flushes of the index and the current chunk.
+        dtype: <numpy.dtype>
+            dtype the intensities are stored with.
+        '''
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.flush_interval = flush_interval
+        self.dtype = dtype
+        self.frames = 0
+        self.chunk = None
+        self.chunk_number = -1
+        self.row = 0
+        self.axis = None
+        self.axis_id = None
+        self.trig_val = None
+        self.int_time_micros = None
+        self.index_file = open(os.path.join(path, INDEX_NAME), 'w', newline='')
+        self.index = csv.writer(self.index_file)
+        self.index.writerow(INDEX_FIELDS)
+        self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def set_settings(self, trig_val, int_time_micros):
+        '''Sets the settings written to the index with every following frame.'''
+        self.trig_val = trig_val
+        self.int_time_micros = int_time_micros
+
+    def record(self, spectrum, frame=None):
+        '''Appends one spectrum to the run.
+
+        Parameters
+        ----------
+        spectrum: <numpy.ndarray>
+            In the form `np.array([[wavelengths], [intensities]])`.
+        frame: <class 'protocol.Frame'>
+            Header of the spectrum for its frame id and timestamp. None uses the current time.
+        '''
+        wavelengths, intensities = spectrum[0], spectrum[1]
+        if self.axis is None or not np.array_equal(wavelengths, self.axis):
+            self.save_axis(wavelengths)
+        if self.chunk is None or self.row == len(self.chunk) or self.chunk.shape[1] != len(intensities):
+            self.next_chunk(len(intensities))
+        self.chunk[self.row] = intensities
+
+        frame_id, timestamp = ('', time.time()) if frame is None else (frame.frame_id, frame.timestamp)
+        self.index.writerow([self.frames, frame_id, repr(timestamp), self.chunk_number, self.row,
+                             self.axis_id, self.trig_val, self.int_time_micros])
+        self.row += 1
+        self.frames += 1
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def save_axis(self, wavelengths):
+        '''Writes a wavelength axis that the run has not seen yet.'''
+        self.axis = np.array(wavelengths, dtype=np.float64)
+        self.axis_id = zlib.crc32(self.axis.tobytes())
+        axis_path = os.path.join(self.path, AXIS_NAME.format(self.axis_id))
+        if not os.path.exists(axis_path):
+            np.save(axis_path, self.axis)
+
+    def next_chunk(self, pixels):
+        '''Closes the current chunk and maps a new, preallocated one.'''
+        if self.chunk is not None:
+            self.chunk.flush()
+        self.chunk_number += 1
+        self.chunk = np.lib.format.open_memmap(os.path.join(self.path, CHUNK_NAME.format(self.chunk_number)),
+                                               mode='w+', dtype=self.dtype, shape=(self.chunk_frames, pixels))
+        self.row = 0
+
+    def flush(self):
+        '''Writes the buffered index rows and the current chunk to disk.'''
+        if self.chunk is not None:
+            self.chunk.flush()
+        self.index_file.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        '''Flushes and closes the run. Rows of the last chunk after the last frame stay zero.'''
+        if self.index_file.closed:
+            return
+        self.flush()
+        self.chunk = None
+        self.index_file.close()
+
+
+class RunReader:
+    '''Random access to a run written by `RunRecorder`, without loading it.
+
+    The index is read once and the chunks are memory-mapped the first time a frame in them is
+    accessed, so getting frame i (or a slice of frames) only reads those frames from disk.
+
+    Attributes
+    ----------
+    path (str): Directory of the run.
+    timestamps (numpy.ndarray): Timestamp of every frame.
+    frame_ids (numpy.ndarray): Frame id of every frame, -1 where unknown.
+    trig_vals (list): Trigger mode of every frame.
+    int_times_micros (list): Integration time of every frame.
+    '''
+    def __init__(self, path):
+        '''Constructor for RunReader class.
+
+        Parameters
+        ----------
+        path: <str>
+            Directory of the run.
+        '''
+        self.path = path
+        # A killed recorder can leave a half written last row
+        rows = [row for row in read_index(path) if None not in row.values() and row['axis_id']]
+        self.chunk_numbers = np.array([int(row['chunk']) for row in rows], dtype=np.int64)
+        self.rows = np.array([int(row['row']) for row in rows], dtype=np.int64)
+        self.axis_ids = np.array([int(row['axis_id']) for row in rows], dtype=np.int64)
+        self.timestamps = np.array([float(row['timestamp']) for row in rows])
+        self.frame_ids = np.array([int(row['frame_id'] or -1) for row in rows], dtype=np.int64)
+        self.trig_vals = [row['trig_val'] for row in rows]
+        self.int_times_micros = [row['int_time_micros'] for row in rows]
+        self.chunks = {}
+        self.axes = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        '''Intensities of frame `index`, or a 2D array of them for a slice of frames.
+
+        A slice within one chunk is a read-only view of the memory map, a slice across chunks is a copy.
+        Frames with different pixel counts (the ROI or binning changed mid-run) can not be stacked, so
+        a slice across them raises `ValueError`; `uniform_slices` splits a run where the count changes.
+        '''
+        if isinstance(index, slice):
+            frames = np.arange(*index.indices(len(self)))
+            if len(frames) == 0:
+                return np.empty((0, 0))
+            step = frames[1] - frames[0] if len(frames) > 1 else 1
+            pieces = []
+            # Frames of one chunk are consecutive rows, so each chunk's part is a strided slice
+            for part in np.split(frames, np.flatnonzero(np.diff(self.chunk_numbers[frames])) + 1):
+                chunk, rows = self.chunk(self.chunk_numbers[part[0]]), self.rows[part]
+                pieces.append(chunk[rows[0]:rows[-1] + 1:step] if step > 0 else chunk[rows])
+            pixels = {piece.shape[1] for piece in pieces}
+            if len(pixels) > 1:
+                raise ValueError("Frames {} to {} have different pixel counts {}, read them with "
+                                 "uniform_slices".format(frames[0], frames[-1], sorted(pixels)))
+            return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+        if index < 0:
+            index += len(self)
+        return self.chunk(self.chunk_numbers[index])[self.rows[index]]
+
+    def uniform_slices(self, size=1024):
+        '''Slices of at most `size` consecutive frames that cover the run, each with one pixel count.
+
+        Every chunk holds frames with one pixel count, so a slice only has to end early where the
+        next chunk's count differs.
+        '''
+        start = 0
+        while start < len(self):
+            stop = min(start + size, len(self))
+            chunk_numbers = self.chunk_numbers[start:stop]
+            pixels = self.chunk(chunk_numbers[0]).shape[1]
+            for boundary in np.flatnonzero(np.diff(chunk_numbers)) + 1:
+                if self.chunk(chunk_numbers[boundary]).shape[1] != pixels:
+                    stop = start + int(boundary)
+                    break
+            yield slice(start, stop)
+            start = stop
+
+    def chunk(self, chunk_number):
+        '''Memory map of one chunk, opened the first time it is needed.'''
+        chunk = self.chunks.get(chunk_number)
+        if chunk is None:
+            chunk = self.chunks[chunk_number] = np.load(os.path.join(self.path, CHUNK_NAME.format(chunk_number)),
+                                                        mmap_mode='r')
+        return chunk
+
+    def wavelengths_of(self, index):
+        '''Wavelength axis of frame `index`, each axis is only read once.'''
+        axis_id = self.axis_ids[index]
+        axis = self.axes.get(axis_id)
+        if axis is None:
+            axis = self.axes[axis_id] = np.load(os.path.join(self.path, AXIS_NAME.format(axis_id)))
+        return axis
+
+    @property
+    def wavelengths(self):
+        '''Wavelength axis of the first frame, which is the axis of the whole run unless the calibration changed.'''
+        return self.wavelengths_of(0)
+
+    def spectrum(self, index):
+        '''Frame `index` in the form `np.array([[wavelengths], [intensities]])`.'''
+        return np.vstack((self.wavelengths_of(index), self[index]))
+
+    def close(self):
+        '''Drops the memory maps.'''
+        self.chunks = {}
@@ -0,0 +1,172 @@
+#
+# Server-side reduction of spectra before they are encoded: wavelength ROI, pixel binning, boxcar
+# smoothing and averaging of consecutive scans. Clients ask for one when subscribing, e.g.
+#   {"cmd": "subscribe", ..., "reduction": {"roi": [540, 560], "binning": 4, "smoothing": 5, "average": 10}}
+#
+
+import zlib
+import numpy as np
+
+# Keys of the "reduction" dictionary of subscribe and settings requests
+REDUCTION_KEYS = ('roi', 'binning', 'smoothing', 'average')
+
+
+class Reduction:
+    '''Reduces the intensities of consecutive scans for the clients that asked for it.
+
+    Scans are cropped to the ROI first, so the other steps only touch the pixels that are sent.
+    Then `average` scans are summed up, and their mean is smoothed with a boxcar of `smoothing`
+    pixels and binned into the mean of every `binning` pixels. The wavelength axis is cropped and
+    binned the same way and gets its own axis id, so clients cache it like the full axis.
+
+    An averaged stream only has a frame every `average` scans. Its frames are numbered on their own,
+    so clients neither count the skipped scans as lost nor miss the frame before a delta.
+
+    Attributes
+    ----------
+    roi (tuple): (first, last) wavelength in nm that is kept, None keeps every pixel.
+    binning (int): Pixels averaged into one.
+    smoothing (int): Width of the boxcar in pixels, 1 for none.
+    average (int): Consecutive scans averaged into one frame.
+    frame_id (int): Frame id of the last reduced frame.
+    axis_id (int): crc32 of the reduced wavelength axis.
+    '''
+    def __init__(self, roi=None, binning=1, smoothing=1, average=1):
+        '''Constructor for Reduction class.
+
+        Parameters
+        ----------
+        roi: <tuple>
+            (first, last) wavelength in nm that is kept, None keeps every pixel.
+        binning: <int>
+            Pixels averaged into one, the pixels left over at the end of the ROI are dropped.
+        smoothing: <int>
+            Width of the boxcar in pixels, 1 for none.
+        average: <int>
+            Consecutive scans averaged into one frame.
+        '''
+        if roi is not None:
+            roi = (float(min(roi)), float(max(roi)))
+        binning, smoothing, average = int(binning), int(smoothing), int(average)
+        if binning < 1 or smoothing < 1 or average < 1:
+            raise ValueError("binning, smoothing and average must be at least 1")
+        self.roi = roi
+        self.binning = binning
+        self.smoothing = smoothing
+        self.average = average
+        self.frame_id = 0
+        self.pixels = slice(None)
+        self.wavelengths = None
+        self.axis_id = 0
+        self.source_axis_id = None
+        self.total = None
+        self.scans = 0
+
+    @classmethod
+    def from_request(cls, reduction):
+        '''Makes a reduction from the `"reduction"` dictionary of a request.
+
+        Returns
+        -------
+        reduction: <class 'Reduction'> or None
+            None if `reduction` is empty or asks for nothing to be reduced.
+        '''
+        if not reduction:
+            return None
+        unknown = set(reduction) - set(REDUCTION_KEYS)
+        if unknown:
+            raise ValueError("Unknown reduction {}".format(", ".join(sorted(unknown))))
+        reduction = cls(**reduction)
+        return None if reduction.is_identity else reduction
+
+    @property
+    def key(self):
+        '''Hashable settings, clients with the same key share one reduced stream.'''
+        return (self.roi, self.binning, self.smoothing, self.average)
+
+    @property
+    def is_identity(self):
+        '''True if the reduction leaves spectra as they are.'''
+        return self.key == (None, 1, 1, 1)
+
+    def set_axis(self, wavelengths, axis_id):
+        '''Finds the pixels of the ROI on a (new) wavelength axis and reduces the axis.
+
+        Parameters
+        ----------
+        wavelengths: <numpy.ndarray>
+            Full wavelength axis of the spectrometer, ascending.
+        axis_id: <int>
+            Axis id of `wavelengths`, the reduced axis is only computed again when it changes.
+        '''
+        if axis_id == self.source_axis_id:
+            return
+        if self.roi is None:
+            self.pixels = slice(None)
+        else:
+            first, last = np.searchsorted(wavelengths, self.roi[0]), np.searchsorted(wavelengths, self.roi[1], 'right')
+            if last <= first:
+                # ROI between two pixels or outside the axis, keep the pixel closest to it
+                first = min(first, len(wavelengths) - 1)
+                last = first + 1
+            self.pixels = slice(first, last)
+        self.wavelengths = np.ascontiguousarray(self.bin(wavelengths[self.pixels]))
+        self.axis_id = zlib.crc32(self.wavelengths.tobytes())
+        self.source_axis_id = axis_id
+        self.reset()
+
+    def reset(self):
+        '''Drops the scans summed up so far, e.g. after the settings changed.'''
+        self.total = None
+        self.scans = 0
+
+    def bin(self, values):
+        '''Mean of every `binning` pixels of `values`.'''
+        if self.binning == 1:
+            return values
+        bins = len(values) // self.binning
+        if bins == 0:
+            return values.mean(keepdims=True)
+        return values[:bins * self.binning].reshape(bins, self.binning).mean(axis=1)
+
+    def smooth(self, values):
+        '''Boxcar average of `values` over `smoothing` pixels.
+
+        Near the ends of the ROI the boxcar only covers the pixels that exist, so the edges are not pulled down.
+        '''
+        if self.smoothing == 1 or len(values) < 2:
+            return values
+        width = min(self.smoothing, len(values))
+        sums = np.concatenate(([0.0], np.cumsum(values)))
+        pixels = np.arange(len(values))
+        low = np.clip(pixels - (width - 1) // 2, 0, len(values))
+        high = np.clip(pixels + width // 2 + 1, 0, len(values))
+        return (sums[high] - sums[low]) / (high - low)
+
+    def add(self, intensities):
+        '''Adds one scan.
+
+        Parameters
+        ----------
+        intensities: <numpy.ndarray>
+            1D array of intensities of the full spectrum.
+
+        Returns
+        -------
+        intensities: <numpy.ndarray> or None
+            The reduced frame once `average` scans are in, otherwise None. Its frame id is `frame_id`.
+        '''
+        scan = intensities[self.pixels]
+        if self.average > 1:
+            if self.total is None:
+                self.total = scan.astype(np.float64)
+            else:
+                self.total += scan
+            self.scans += 1
+            if self.scans < self.average:
+                return None
+            scan = self.total / self.scans
+            self.reset()
+        reduced = np.ascontiguousarray(self.bin(self.smooth(scan)))
+        self.frame_id = (self.frame_id + 1) & 0xffffffff
+        return reduced
@@ -1,6 +1,181 @@
 import socket
-import math
+import asyncio
+import random
+import struct
+import sys
+import time
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from specDataClass import SpecInfo
+from control import parse_request, make_ack, ControlError, SETTINGS_COMMANDS
+from protocol import (pack_frame, add_parity, fec_from_request, unpack_header, path_chunk_size, MSG_AXIS,
+                      newer, MSG_PRODUCTS, MSG_BURST, NACK_TYPES, HEADER_SIZE, MIN_DATAGRAM, MAX_DATAGRAM)
+from spec_codecs import SpecEncoder, CODECS, encode_burst
+from reduction import Reduction
+from products import Products, PRODUCTS_DTYPE
+from metrics import timed, watch
+
+# Codec and zlib level used for clients that do not ask for one
+DEFAULT_CODEC = ('raw', None)
+
+# zlib level of bursts, which are sent once per shot and compress well
+BURST_ZLIB_LEVEL = 1
+
+# Seconds between attempts to reopen a spectrometer whose acquisition failed
+REOPEN_DELAY = 2.0
+
+# Seconds a chunk sent again to the multicast group covers the NACKs of every other viewer that lost it.
+# Well below the clients' recovery window, so a viewer that lost the retransmission too gets it again
+GROUP_NACK_WINDOW = 0.01
+
+# UDP generic segmentation offload (Linux 4.18+): one sendmsg call carries many equally sized
+# datagrams, which the kernel splits up. The socket module only has the constants on newer Pythons.
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65000
+# sendmsg is not available on Windows, where every datagram is joined into one bytes object
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class Subscriptions:
+    '''Keeps track of clients that are streaming spectra.
+
+    Subscribers are keyed by the address they send control messages from and are dropped
+    once they have not been heard from for `keepalive_timeout` seconds. Subscribers without a
+    data address listen on the multicast group instead of getting their own copy of each frame.
+    Every unicast subscriber has a codec and a reduction (see `reduction.Reduction.key`, None for full spectra),
+    or products (see `products.Products.key`) if it gets those instead of spectra.
+
+    Attributes
+    ----------
+    keepalive_timeout (float): Seconds of silence before a subscriber is dropped.
+    '''
+    def __init__(self, keepalive_timeout=5.0):
+        '''Constructor for Subscriptions class.
+
+        Parameters
+        ----------
+        keepalive_timeout: <float>
+            Seconds of silence before a subscriber is dropped.
+        '''
+        self.keepalive_timeout = keepalive_timeout
+        self.subscribers = {}
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def __contains__(self, control_address):
+        return control_address in self.subscribers
+
+    def subscribe(self, control_address, data_address, codec=DEFAULT_CODEC, reduction=None, products=None):
+        '''Adds (or refreshes) a subscriber that wants frames sent to `data_address`, encoded with `codec`.
+
+        A `data_address` of None subscribes to the multicast group, whose codec is set by the server
+        and whose spectra are never reduced.
+        '''
+        self.subscribers[control_address] = [data_address, time.monotonic(), codec, reduction, products]
+
+    def set_reduction(self, control_address, reduction):
+        '''Changes the reduction of a subscriber. Returns False if the address is not subscribed.'''
+        if control_address not in self.subscribers:
+            return False
+        self.subscribers[control_address][3] = reduction
+        return True
+
+    def keepalive(self, control_address):
+        '''Refreshes a subscriber. Returns False if the address is not subscribed.'''
+        if control_address not in self.subscribers:
+            return False
+        self.subscribers[control_address][1] = time.monotonic()
+        return True
+
+    def unsubscribe(self, control_address):
+        '''Removes a subscriber if it exists.'''
+        self.subscribers.pop(control_address, None)
+
+    def expire(self):
+        '''Drops subscribers that stopped sending keepalives.
+
+        Returns
+        -------
+        expired: <list>
+            Control addresses of the subscribers that were dropped.
+        '''
+        now = time.monotonic()
+        expired = []
+        for control_address, (_, last_seen, _, _, _) in list(self.subscribers.items()):
+            if now - last_seen > self.keepalive_timeout:
+                print("Subscriber {} timed out.".format(control_address))
+                del self.subscribers[control_address]
+                expired.append(control_address)
+        return expired
+
+    def data_addresses(self):
+        '''Every address frames are sent to, None for the multicast group.'''
+        return {data_address for data_address, _, _, _, _ in self.subscribers.values()}
+
+    def destinations(self):
+        '''`(data_address, codec, reduction, products)` that every streamed frame should be unicast to.'''
+        return [(data_address, codec, reduction, products)
+                for data_address, _, codec, reduction, products in self.subscribers.values()
+                if data_address is not None]
+
+    def reduction_of(self, data_address):
+        '''Reduction of the subscriber that receives frames on `data_address`, None if there is none.'''
+        for address, _, _, reduction, _ in self.subscribers.values():
+            if address == data_address:
+                return reduction
+        return None
+
+    def multicast_count(self):
+        '''Number of subscribers listening on the multicast group.'''
+        return sum(1 for data_address, _, _, _, _ in self.subscribers.values() if data_address is None)
+
+
+class RetransmitCache:
+    '''Keeps the datagrams of the last frames sent to every destination, so lost chunks can be sent again.
+
+    Only the `(header, payload slice)` pairs are kept, which share the encoded payload with every
+    other destination, so caching copies nothing. Only message types in `protocol.NACK_TYPES` are kept.
+
+    Attributes
+    ----------
+    frames (int): Frames kept per destination.
+    destinations (int): Destinations kept, the one sent to least recently is forgotten first.
+    '''
+    def __init__(self, frames=16, destinations=64):
+        self.frames = frames
+        self.destinations = destinations
+        # Destination -> (msg_type, frame_id) -> datagrams, oldest first
+        self.cache = OrderedDict()
+
+    def add(self, address, datagrams):
+        '''Keeps the datagrams of a frame that was just sent to `address`.'''
+        header = unpack_header(datagrams[0][0])
+        if header is None or header[0] not in NACK_TYPES:
+            return
+        frames = self.cache.get(address)
+        if frames is None:
+            frames = self.cache[address] = OrderedDict()
+            if len(self.cache) > self.destinations:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(address)
+        frames[header[0], header[3]] = datagrams
+        if len(frames) > self.frames:
+            frames.popitem(last=False)
+
+    def get(self, address, msg_type, frame_id):
+        '''The datagrams of a frame sent to `address`, None if it is not cached (anymore).'''
+        frames = self.cache.get(address)
+        return None if frames is None else frames.get((msg_type, frame_id))
+
+    def forget(self, address):
+        '''Drops every frame sent to `address`.'''
+        self.cache.pop(address, None)
+
 
 # Receives parameters for spectrometer settings from client
 class ReceiveSettings:
@@ -71,72 +246,1032 @@ class SendSpecData(SpecInfo):
     
     Parameters
     ----------
-    chunk_size (int): Determines how many bytes are sent at a time.
+    chunk_size (int): Determines how many bytes are sent at a time. None fits every datagram into the path MTU.
     address (list): contains ip address (group) and port number in form [IP, port].
     ttl (int): Time that a datagram has to live in the network.
+    multicast_group (tuple): (group, port) that frames are published to once for all multicast subscribers.
+    multicast_codec (tuple): (codec name, zlib level) of the frames published to the multicast group.
+    mtu (int): MTU used to size datagrams when `chunk_size` is None, read from the route if None.
+    device (object): Spectrometer backend, see `SpecInfo`.
+    device_index (int): Index of the spectrometer on a `SpecServer`, written to every frame header.
+    frames_acquired (int): Spectra acquired.
+    frames_sent (int): Frames, axes and products sent, counted once per destination.
+    datagrams_sent (int): Datagrams sent.
+    bytes_sent (int): Bytes sent, headers included.
+    datagrams_retransmitted (int): Datagrams sent again because a client asked for them with a NACK.
+    nacks_missed (int): NACKs for frames that were no longer in the retransmit cache.
+    group_nacks_merged (int): Chunks multicast viewers asked for that had just been sent to the group again.
+    send_errors (int): Frames that could not be sent to one of their destinations.
+    shot_micros (int): Duration of a shot in trigger mode 3, captured as one burst, None for one spectrum per trigger.
     '''
-    def __init__(self, chunk_size, address, ttl):
+    def __init__(self, chunk_size, address, ttl, multicast_group=None, multicast_codec=DEFAULT_CODEC, mtu=None,
+                 device=None, device_index=0):
         '''Constructor for SendSpecData class.
         
         Parameters
         ----------
         chunk_size: <int>
-            Determines how many bytes are sent at a time.
+            Determines how many bytes of payload are sent per datagram. None picks the largest
+            size that is not fragmented on the way to each client (see `protocol.path_chunk_size`).
         address: <list>
             contains ip address (group) and port number in form [IP, port].
         ttl: <int>
             Time that a datagram has to live in the network.
+        multicast_group: <tuple>
+            (group, port) to publish frames to, e.g. ('224.1.1.1', 5007). None turns multicast off.
+        multicast_codec: <tuple>
+            (codec name, zlib level) of the frames published to the multicast group.
+        mtu: <int>
+            MTU to size datagrams for when `chunk_size` is None, e.g. 9000 for jumbo frames. None
+            reads it from the route to each client, which only works on Linux (1500 elsewhere).
+        device: <object>
+            Spectrometer backend, e.g. `spec_simulator.SimulatedSpectrometer`. None opens the
+            first OceanInsight device.
+        device_index: <int>
+            Index of the spectrometer on a `SpecServer`, written to every frame header.
         '''
-        SpecInfo.__init__(self)
+        SpecInfo.__init__(self, device)
+        self.device_index = device_index
         self.chunk_size = chunk_size
+        self.mtu = mtu
+        # Chunk size per destination, the largest datagram each subscriber said it can receive,
+        # and the (k, m) parity (see `protocol.add_parity`) of the subscribers that asked for it
+        self.chunk_sizes = {}
+        self.datagram_limits = {}
+        self.fec = {}
+        self.use_gso = sys.platform.startswith('linux') and HAS_SENDMSG
+        # Destinations the kernel refused segmentation offload for, e.g. a fixed chunk size above their MTU
+        self.no_gso = set()
         self.address = address
         self.ttl = ttl
-        self.spec = b""
+        self.multicast_group = multicast_group
+        self.multicast_codec = multicast_codec
+        self.intensities = None
         self.shape = ()
+        self.timestamp = 0.0
+        self.frame_id = 0
+        # One reduction per reduction key in use (see `reduction.Reduction`) and the current frame
+        # after each of them
+        self.reducers = {}
+        self.reduced = {}
+        # One `products.Products` per products key in use
+        self.products = {}
+        # One encoder per codec and reduction in use, the encoded current frame for each of them,
+        # and its datagrams for each chunk size
+        self.encoders = {}
+        self.payloads = {}
+        self.encoded = {}
+        self.axis_seq = 0
+        self.sent_axis_id = self.axis_id
+        # Burst mode: two preallocated (spectra, timestamps) blocks that shots are captured into in
+        # turn, so one is sent while the next shot is captured, and the shot that is sent now
+        self.shot_micros = None
+        self.burst_blocks = [None, None]
+        self.burst_block = 0
+        self.burst = None
+        self.burst_id = 0
+        # Lets clients tell a restarted server apart from a stream of stale frames
+        self.stream_id = random.getrandbits(16)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.subscriptions = Subscriptions()
+        # Clients that asked for a single frame without subscribing
+        self.one_shot = []
+        self.frames_acquired = 0
+        self.frames_sent = 0
+        self.datagrams_sent = 0
+        self.bytes_sent = 0
+        # Recent frames of every destination, for clients that lost some of their chunks
+        self.retransmit_cache = RetransmitCache()
+        self.datagrams_retransmitted = 0
+        self.nacks_missed = 0
+        # (msg_type, frame_id, chunk index) -> when it was last sent again to the multicast group
+        self.group_resent = {}
+        self.group_nacks_merged = 0
+        # Frames that could not be sent, and the destinations they were for
+        self.send_errors = 0
+        self.failed_destinations = set()
+        watch(self, ('frames_acquired', 'frames_sent', 'datagrams_sent', 'bytes_sent', 'datagrams_retransmitted',
+                     'nacks_missed', 'group_nacks_merged', 'send_errors'), 'server')
+        # Set up by `serve`, replies go out of the control socket the requests came in on
+        self.executor = None
+        self.wake = None
+        self.transport = None
     
     # Setting socket to be able to send data
     def set_socket_send(self):
         '''Sets socket option for sending data.'''
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
         
+    @property
+    def settings(self):
+        '''Settings on the device and the shot duration, as acknowledged to clients.'''
+        return dict(SpecInfo.settings.fget(self), shot_micros=self.shot_micros)
+
+    @property
+    def bursting(self):
+        '''True if every trigger starts a shot that is captured and sent as one burst.
+
+        The number of spectra per shot comes from the integration time, so until one is set
+        every trigger is a single spectrum.
+        '''
+        return bool(self.shot_micros) and self.trig_val == 3 and bool(self.int_time_micros)
+
     def get_data(self):
-        '''Gets spectrum data from SpecInfo class.
-        
+        '''Gets the intensities from SpecInfo class and makes them the current frame.
+
+        Every frame gets the next frame id and is timestamped right after acquisition. The
+        wavelengths are not part of the frame, clients get them from `send_axis`.
+
         Returns
         -------
-        spec: <bytes>
-            Spectrum in bytes.
+        intensities: <numpy.ndarray>
+            1D array of intensities.
         '''
-        SpecInfo.get_spec(self)
-        self.spec = SpecInfo.get_spec_compressed(self)
-        self.shape = list(SpecInfo.get_shape(self))
-        return self.spec
+        self.set_frame(*self.acquire())
+        return self.intensities
 
-    def send_data(self, client_address):
-        '''Sends the compressed spectrum data, an empty bytes string, and the shape of the original np array.
-        
-        An empty bytes string is sent over to the client so the client knows when to stop receiving data.
+    def chunk_size_for(self, address):
+        '''Payload bytes per datagram sent to `address`.
+
+        The fixed `chunk_size` if one was given, otherwise the largest payload that fits the path
+        MTU to `address`. Never more than the subscriber said it can receive.
+        '''
+        chunk_size = self.chunk_sizes.get(address)
+        if chunk_size is None:
+            chunk_size = self.chunk_size or path_chunk_size(address, self.mtu)
+            self.chunk_sizes[address] = chunk_size
+        limit = self.datagram_limits.get(address)
+        if limit is not None:
+            chunk_size = max(1, min(chunk_size, limit - HEADER_SIZE))
+        return chunk_size
+
+    def get_datagrams(self, codec=DEFAULT_CODEC, chunk_size=None, reduction=None, fec=None):
+        '''Encodes the current frame with `codec` and splits it into datagrams.
+
+        Every codec is only encoded once per frame and reduction and split once per chunk size,
+        however many clients use it, and parity is only computed once per chunk size and FEC
+        setting. The datagrams share the encoded payload instead of copying it.
+
+        Parameters
+        ----------
+        codec: <tuple>
+            `(codec name, zlib level)`, see `spec_codecs.SpecEncoder`.
+        chunk_size: <int>
+            Payload bytes per datagram, `chunk_size` if None.
+        reduction: <tuple>
+            Key of the reduction (see `reduction.Reduction.key`), None for the full spectrum.
+        fec: <tuple>
+            (k, m) of the parity datagrams to add, see `protocol.add_parity`. None for none.
+
+        Returns
+        -------
+        datagrams: <list> or None
+            `(header, payload slice)` pairs from `protocol.pack_frame`, None if the reduction is
+            still averaging scans and has no frame yet.
+        '''
+        chunk_size = chunk_size or self.chunk_size or path_chunk_size(self.address, self.mtu)
+        frame = self.reduced.get(reduction) if reduction is not None else (self.intensities, self.frame_id, self.axis_id)
+        if frame is None:
+            return None
+        intensities, frame_id, axis_id = frame
+        datagrams = self.encoded.get((codec, reduction, chunk_size))
+        if datagrams is None:
+            encoded = self.payloads.get((codec, reduction))
+            if encoded is None:
+                encoder = self.encoders.get((codec, reduction))
+                if encoder is None:
+                    encoder = self.encoders[codec, reduction] = SpecEncoder(*codec)
+                encoded = self.payloads[codec, reduction] = encoder.encode(intensities, frame_id)
+            codec_id, flags, dtype, payload = encoded
+            datagrams = self.encoded[codec, reduction, chunk_size] = pack_frame(
+                payload, frame_id, dtype, list(intensities.shape), self.timestamp, chunk_size,
+                self.stream_id, axis_id=axis_id, codec=codec_id, flags=flags, device=self.device_index)
+        return self.add_fec((codec, reduction, chunk_size), datagrams, fec)
+
+    def add_fec(self, key, datagrams, fec):
+        '''Adds parity datagrams to the datagrams of the current frame, once per frame and FEC setting.
+
+        Parameters
+        ----------
+        key: <tuple>
+            Key of `datagrams` in `encoded`, the datagrams with parity are kept under `key + (fec,)`.
+        datagrams: <list>
+            `(header, payload slice)` pairs from `protocol.pack_frame`.
+        fec: <tuple>
+            (k, m) of the parity datagrams to add, see `protocol.add_parity`. None for none.
+
+        Returns
+        -------
+        datagrams: <list>
+            `datagrams` followed by their parity, or `datagrams` themselves without `fec`.
+        '''
+        if fec is None:
+            return datagrams
+        protected = self.encoded.get(key + (fec,))
+        if protected is None:
+            protected = self.encoded[key + (fec,)] = add_parity(datagrams, *fec)
+        return protected
+
+    def send_datagrams(self, datagrams, address, retransmission=False):
+        '''Sends `(header, payload slice)` pairs without joining them first.
+
+        On Linux the datagrams go out in batches of up to `GSO_MAX_SEGMENTS` per system call with
+        UDP segmentation offload. Kernels (or interfaces) without it get one `sendmsg` per datagram,
+        still without copying the payload, and Windows gets one `sendto` per datagram.
+
+        Parameters
+        ----------
+        datagrams: <list>
+            `(header, payload slice)` pairs from `protocol.pack_frame`.
+        address: <tuple>
+            Address that receives the datagrams.
+        retransmission: <bool>
+            True if the datagrams were sent before, they are then neither counted as a frame nor cached again.
+        '''
+        if retransmission:
+            self.datagrams_retransmitted += len(datagrams)
+        else:
+            self.frames_sent += 1
+            self.retransmit_cache.add(address, datagrams)
+        self.datagrams_sent += len(datagrams)
+        self.bytes_sent += HEADER_SIZE * len(datagrams) + sum(len(payload) for _, payload in datagrams)
+        if self.use_gso and len(datagrams) > 1 and address not in self.no_gso:
+            try:
+                self.send_segmented(datagrams, address)
+                return
+            except OSError as e:
+                print("UDP segmentation offload failed for {} ({}), sending its datagrams one at a time.".format(address, e))
+                self.no_gso.add(address)
+        if HAS_SENDMSG:
+            for header, payload in datagrams:
+                self.sock.sendmsg([header, payload], [], 0, address)
+        else:
+            for header, payload in datagrams:
+                self.sock.sendto(header + payload, address)
+
+    def send_segmented(self, datagrams, address):
+        '''Sends datagrams in as few `sendmsg` calls as UDP segmentation offload allows.
+
+        The kernel splits one call into datagrams of the size of the first one, only the last one
+        may be shorter. Datagrams of a frame are all the same size except the last chunk, which
+        parity datagrams (see `protocol.add_parity`) can follow, so a shorter datagram ends its call.
+        '''
+        start = 0
+        while start < len(datagrams):
+            segment_size = HEADER_SIZE + len(datagrams[start][1])
+            per_call = max(1, min(GSO_MAX_SEGMENTS, GSO_MAX_BYTES // segment_size))
+            stop = start + 1
+            while stop < len(datagrams) and stop - start < per_call:
+                size = HEADER_SIZE + len(datagrams[stop][1])
+                if size > segment_size:
+                    break
+                stop += 1
+                if size < segment_size:
+                    break
+            buffers = [piece for datagram in datagrams[start:stop] for piece in datagram]
+            self.sock.sendmsg(buffers, [(SOL_UDP, UDP_SEGMENT, struct.pack('=H', segment_size))], 0, address)
+            start = stop
+
+    def send_axis(self, client_address, reduction=None):
+        '''Sends the wavelength axis, which clients cache and combine with every frame.
+
+        Parameters
+        ----------
+        client_address: <tuple>
+            Address that receives the frames.
+        reduction: <tuple>
+            Key of the reduction the client gets its spectra with, None for the full axis.
+        '''
+        if reduction is None:
+            wavelengths, axis_id = self.wavelengths, self.axis_id
+        else:
+            reducer = self.reducers[reduction]
+            reducer.set_axis(self.wavelengths, self.axis_id)
+            wavelengths, axis_id = reducer.wavelengths, reducer.axis_id
+        self.axis_seq = (self.axis_seq + 1) & 0xffffffff
+        datagrams = pack_frame(wavelengths.tobytes(), self.axis_seq, wavelengths.dtype,
+                               wavelengths.shape, time.time(), self.chunk_size_for(client_address),
+                               self.stream_id, msg_type=MSG_AXIS, axis_id=axis_id, device=self.device_index)
+        self.send_datagrams(datagrams, client_address)
+
+    @timed('send')
+    def send_data(self, client_address, codec=DEFAULT_CODEC, reduction=None):
+        '''Sends the datagrams of the last frame.
+
+        Every datagram carries a header with the frame id, chunk index and count, dtype, shape
+        and timestamp, so the client needs neither a terminator nor a separate shape datagram.
+
+        Parameters
+        ----------
+        client_address: <tuple>
+            Address of the client from which the data came from.
+        codec: <tuple>
+            `(codec name, zlib level)` the client asked for.
+        reduction: <tuple>
+            Key of the reduction the client asked for, None for the full spectrum.
+        '''
+        datagrams = self.get_datagrams(codec, self.chunk_size_for(client_address), reduction,
+                                       self.fec.get(client_address))
+        if datagrams is not None:
+            self.send_datagrams(datagrams, client_address)
+
+    def forget_destinations(self):
+        '''Drops the per-destination state of every address no subscriber receives frames on anymore.
+
+        Chunk sizes, datagram limits, parity, offload state and cached datagrams are kept per data
+        address, so without this clients on ephemeral ports (including the ones that only asked for
+        single frames) would pile up on a long-running server.
+        '''
+        in_use = self.subscriptions.data_addresses()
+        in_use.add(self.multicast_group)
+        for table in (self.chunk_sizes, self.datagram_limits, self.fec):
+            for address in [address for address in table if address not in in_use]:
+                del table[address]
+        self.no_gso &= in_use
+        self.failed_destinations &= in_use
+        for address in [address for address in self.retransmit_cache.cache if address not in in_use]:
+            self.retransmit_cache.forget(address)
+
+    def add_reduction(self, request):
+        '''Gets the reduction a subscribe or settings request asks for ready.
+
+        Clients that ask for the same reduction share it, so each frame is only reduced once for all of them.
+
+        Returns
+        -------
+        reduction: <tuple>
+            Key of the reduction, None if the request asks for full spectra or for an invalid reduction.
+        '''
+        try:
+            reduction = Reduction.from_request(request.get("reduction"))
+        except (TypeError, ValueError) as e:
+            print("Invalid reduction {!r} ({}), sending full spectra.".format(request.get("reduction"), e))
+            return None
+        if reduction is None:
+            return None
+        if reduction.key not in self.reducers:
+            # Numbered on from the full stream, so a client that switches to it never sees frame ids go back
+            reduction.frame_id = self.frame_id
+            reduction.set_axis(self.wavelengths, self.axis_id)
+            self.reducers[reduction.key] = reduction
+        return reduction.key
+
+    def add_products(self, request):
+        '''Gets the products a subscribe request asks for ready, shared by every client that asks for the same.
+
+        Returns
+        -------
+        products: <tuple>
+            Key of the products, None if the request asks for spectra or for invalid products.
+        '''
+        try:
+            products = Products.from_request(request.get("products"))
+        except (TypeError, ValueError) as e:
+            print("Invalid products {!r} ({}), sending spectra.".format(request.get("products"), e))
+            return None
+        if products is None:
+            return None
+        if products.key not in self.products:
+            products.set_axis(self.wavelengths, self.axis_id)
+            self.products[products.key] = products
+        return products.key
+
+    @timed('products')
+    def send_products(self, client_address, products):
+        '''Computes (once per frame) and sends the products of the current frame.
+
+        Parameters
+        ----------
+        client_address: <tuple>
+            Address that receives the products.
+        products: <tuple>
+            Key of the products the client asked for.
+        '''
+        chunk_size = self.chunk_size_for(client_address)
+        datagrams = self.encoded.get((MSG_PRODUCTS, products, chunk_size))
+        if datagrams is None:
+            calculator = self.products[products]
+            values = self.payloads.get((MSG_PRODUCTS, products))
+            if values is None:
+                calculator.set_axis(self.wavelengths, self.axis_id)
+                values = self.payloads[MSG_PRODUCTS, products] = calculator.compute(self.intensities)
+            datagrams = self.encoded[MSG_PRODUCTS, products, chunk_size] = pack_frame(
+                values.tobytes(), self.frame_id, PRODUCTS_DTYPE, calculator.shape, self.timestamp, chunk_size,
+                self.stream_id, msg_type=MSG_PRODUCTS, axis_id=calculator.products_id, device=self.device_index)
+        datagrams = self.add_fec((MSG_PRODUCTS, products, chunk_size), datagrams, self.fec.get(client_address))
+        self.send_datagrams(datagrams, client_address)
+
+    @timed('reduce')
+    def reduce_frame(self, reductions):
+        '''Runs the current frame through every reduction in `reductions` and forgets the ones no one uses.'''
+        for key in list(self.reducers):
+            if key not in reductions:
+                del self.reducers[key]
+        for codec, reduction in list(self.encoders):
+            if reduction is not None and reduction not in reductions:
+                del self.encoders[codec, reduction]
+        self.reduced.clear()
+        for key in reductions:
+            reducer = self.reducers[key]
+            reducer.set_axis(self.wavelengths, self.axis_id)
+            intensities = reducer.add(self.intensities)
+            self.reduced[key] = None if intensities is None else (intensities, reducer.frame_id, reducer.axis_id)
+
+    def handle_request(self, received_data, client_address):
+        '''Applies a request from a client.
+
+        Runs on the event loop and never blocks: settings are queued on the spectrometer's
+        executor and frames are sent by `stream_frames`. Clients that are not subscribed get a
+        single frame back for every request, like before streaming existed.
 
         Parameters
         ----------
+        received_data: <bytes>
+            Datagram received on the control socket.
         client_address: <tuple>
             Address of the client from which the data came from.
         '''
-        # Sending over spectrum data by chunk
-        b = b""
-        i = 0
-        for i in range(math.ceil(len(self.spec) / self.chunk_size)):
-            b = self.spec[i * self.chunk_size:(i + 1) * self.chunk_size]
-            self.sock.sendto(b, client_address)
-            
-        print("Data has been sent.")    
+        try:
+            request = parse_request(received_data)
+        except ValueError as e:
+            print("Ignoring request from {}: {}".format(client_address, e))
+            if isinstance(e, ControlError) and e.request is not None:
+                self.acknowledge(e.request, client_address, ok=False, error=str(e))
+            return
+        try:
+            self.apply_request(request, client_address)
+        except (ControlError, KeyError, TypeError) as e:
+            print("Could not apply {!r} from {}: {}".format(request, client_address, e))
+            self.acknowledge(request, client_address, ok=False, error=str(e))
+
+    def reply(self, data, client_address):
+        '''Sends a reply from the control socket, so clients can tell it apart from frames.'''
+        if self.transport is not None:
+            self.transport.sendto(data, client_address)
+        else:
+            self.sock.sendto(data, client_address)
+
+    def acknowledge(self, request, client_address, ok=True, error=None, **fields):
+        '''Answers a request if the client gave it a sequence number, see `control.py`.'''
+        if "seq" in request:
+            self.reply(make_ack(request, ok, error, **fields), client_address)
+
+    def apply_request(self, request, client_address):
+        '''Applies a request that `parse_request` already turned into a dictionary.
+
+        Settings requests are acknowledged once they are on the device (see `apply_settings`),
+        every other request right away.
+
+        Parameters
+        ----------
+        request: <dict>
+            See `control.parse_request`.
+        client_address: <tuple>
+            Address of the client from which the data came from.
+        '''
+        cmd = request["cmd"]
+        if "device" in request and request["device"] not in (self.device_index, self.serial_number):
+            raise ControlError("No device {!r}".format(request["device"]))
+        if cmd == "devices":
+            self.reply(make_ack(request, devices=[self.serial_number]), client_address)
+            return
+        if cmd == "subscribe" and request.get("port") is None and self.multicast_group is None:
+            # Client joined the multicast group and only uses this socket for control messages
+            raise ControlError("{} asked for multicast, but the server has no multicast group".format(client_address))
+        if cmd == "subscribe":
+            # Checked before the settings are queued, so a bad request is not acknowledged twice, and before
+            # the subscriber is stored, so a bad address never reaches the send path of every frame
+            port = request.get("port")
+            if port is not None and (type(port) is not int or not 1 <= port <= 65535):
+                raise ControlError("port must be between 1 and 65535, got {!r}".format(port))
+            max_datagram = request.get("max_datagram", MAX_DATAGRAM)
+            if type(max_datagram) is not int or max_datagram < MIN_DATAGRAM:
+                raise ControlError("max_datagram must be at least {} bytes, got {!r}".format(MIN_DATAGRAM,
+                                                                                            max_datagram))
+            # zlib only fails on a bad level when the first frame is encoded
+            zlib_level = request.get("zlib_level")
+            if zlib_level is not None and (type(zlib_level) is not int or not -1 <= zlib_level <= 9):
+                raise ControlError("zlib_level must be None or between -1 and 9, got {!r}".format(zlib_level))
+            try:
+                fec = fec_from_request(request.get("fec"))
+            except (TypeError, ValueError, KeyError) as e:
+                raise ControlError("Invalid FEC {!r}: {}".format(request.get("fec"), e))
+        if cmd in SETTINGS_COMMANDS:
+            shot_changed = False
+            if "shot_micros" in request:
+                # Takes effect with the next trigger, 0 or None turns burst mode off
+                shot_micros = request["shot_micros"]
+                if shot_micros is not None and (not isinstance(shot_micros, int) or shot_micros < 0):
+                    raise ControlError("shot_micros must be a positive number of microseconds, got {!r}".format(
+                        shot_micros))
+                shot_changed = (shot_micros or None) != self.shot_micros
+                self.shot_micros = shot_micros or None
+            self.apply_settings(request.get("trig_val"), request.get("int_time_micros"), request, client_address,
+                                shot_changed)
+        if cmd in ("set", "settings") and "reduction" in request and client_address in self.subscriptions:
+            # Streaming clients change their reduction with their settings
+            data_address, _, codec, previous, _ = self.subscriptions.subscribers[client_address]
+            reduction = self.add_reduction(request)
+            if reduction is not None and reduction != previous:
+                # A stream others already use can be numbered behind the one the client leaves, so it is
+                # moved up to the full stream's ids. Its other clients see a jump, like after a settings change.
+                reducer = self.reducers[reduction]
+                if newer(self.frame_id, reducer.frame_id):
+                    reducer.frame_id = self.frame_id
+            self.subscriptions.set_reduction(client_address, reduction)
+            if data_address is not None:
+                if (codec, reduction) in self.encoders:
+                    self.encoders[codec, reduction].force_keyframe()
+                self.send_axis(data_address, reduction)
+            self.subscriptions.keepalive(client_address)
+            return
+        if cmd == "subscribe":
+            reduction = None
+            if request.get("port") is None:
+                data_address, codec = None, self.multicast_codec
+                if request.get("reduction"):
+                    print("{} joined the multicast group, which gets full spectra.".format(client_address))
+            else:
+                # Frames go to the data port the client asked for on the same host.
+                data_address = (client_address[0], request["port"])
+                codec = (request.get("codec", DEFAULT_CODEC[0]), request.get("zlib_level", DEFAULT_CODEC[1]))
+                if codec[0] not in CODECS:
+                    print("Unknown codec {!r}, using {!r}.".format(codec[0], DEFAULT_CODEC[0]))
+                    codec = DEFAULT_CODEC
+                self.datagram_limits[data_address] = min(max_datagram, MAX_DATAGRAM)
+                if fec is None:
+                    self.fec.pop(data_address, None)
+                else:
+                    self.fec[data_address] = fec
+                reduction = self.add_reduction(request)
+            products = None if data_address is None else self.add_products(request)
+            if (codec, reduction) in self.encoders:
+                # The new client has no reference frame for deltas yet
+                self.encoders[codec, reduction].force_keyframe()
+            self.subscriptions.subscribe(client_address, data_address, codec, reduction, products)
+            # A client that subscribes again may have moved to a new data port
+            self.forget_destinations()
+            if products is None:
+                # Products are plain numbers, only spectra need the wavelength axis
+                self.send_axis(data_address or self.multicast_group, reduction)
+            self.wake.set()
+            print("{} subscribed.".format(client_address))
+        elif cmd == "axis":
+            # Sent from the data socket that lost (or never got) the wavelength axis. Sockets
+            # listening on the multicast group share their port, so the group gets it instead.
+            if self.multicast_group is not None and client_address[1] == self.multicast_group[1]:
+                self.send_axis(self.multicast_group)
+            else:
+                self.send_axis(client_address, self.subscriptions.reduction_of(client_address))
+        elif cmd == "nack":
+            self.retransmit(request, client_address)
+        elif cmd == "unsubscribe":
+            self.subscriptions.unsubscribe(client_address)
+            self.forget_destinations()
+            print("{} unsubscribed.".format(client_address))
+        elif cmd == "keepalive":
+            self.subscriptions.keepalive(client_address)
+        elif cmd == "set":
+            # Only changes settings, the acknowledgement is the answer
+            self.subscriptions.keepalive(client_address)
+        elif not self.subscriptions.keepalive(client_address):
+            # "settings" and "next" from a client that is not streaming get the next frame
+            self.one_shot.append(client_address)
+            self.wake.set()
+        if cmd not in SETTINGS_COMMANDS:
+            self.acknowledge(request, client_address)
+
+    def retransmit(self, request, client_address):
+        '''Sends the chunks a client lost again, if their frame is still in the retransmit cache.
+
+        NACKs come from the data socket that lost the chunks, see `protocol.FrameAssembler`. Sockets
+        listening on the multicast group share their port, so the group gets the chunks instead. A loss
+        upstream of every viewer is NACKed by all of them, so a chunk that was sent to the group in the
+        last `GROUP_NACK_WINDOW` seconds is not sent again.
+
+        Parameters
+        ----------
+        request: <dict>
+            `{"cmd": "nack", "type": msg_type, "frame": frame_id, "missing": hex bitmask}`. Bit i of
+            `"missing"` stands for chunk i, without `"missing"` the whole frame is sent again.
+        client_address: <tuple>
+            Address of the data socket the NACK came from.
+        '''
+        if self.multicast_group is not None and client_address[1] == self.multicast_group[1]:
+            client_address = self.multicast_group
+        datagrams = self.retransmit_cache.get(client_address, request["type"], request["frame"])
+        if datagrams is None:
+            self.nacks_missed += 1
+            return
+        missing = request.get("missing")
+        if missing is not None:
+            # Bits are chunk indices, parity datagrams (see `protocol.add_parity`) are never asked for
+            missing = int(missing, 16)
+            datagrams = [datagram for datagram in datagrams if missing >> unpack_header(datagram[0])[4] & 1]
+        if client_address == self.multicast_group:
+            datagrams = self.merge_group_nacks(request["type"], request["frame"], datagrams)
+        if datagrams:
+            self.send_datagrams(datagrams, client_address, retransmission=True)
+
+    def merge_group_nacks(self, msg_type, frame_id, datagrams):
+        '''Leaves out the datagrams another multicast viewer had sent to the group within `GROUP_NACK_WINDOW`.'''
+        now = time.monotonic()
+        self.group_resent = {key: sent for key, sent in self.group_resent.items() if now - sent < GROUP_NACK_WINDOW}
+        resend = []
+        for datagram in datagrams:
+            key = (msg_type, frame_id, unpack_header(datagram[0])[4])
+            if key in self.group_resent:
+                self.group_nacks_merged += 1
+                continue
+            self.group_resent[key] = now
+            resend.append(datagram)
+        return resend
+
+    def apply_settings(self, trig_val, int_time_micros, request=None, client_address=None, shot_changed=False):
+        '''Queues new settings on the spectrometer's executor and acknowledges them once applied.
+
+        The executor runs one job at a time, so settings are applied between two acquisitions
+        and the event loop keeps serving other clients in the meantime. `SpecInfo` only talks to
+        the device about settings that changed. When they did, scans summed up for an average are
+        dropped, so no frame mixes the old and the new settings.
+
+        Parameters
+        ----------
+        trig_val: <int>
+            New trigger mode, None keeps the current one.
+        int_time_micros: <int>
+            New integration time in microseconds, None keeps the current one.
+        request: <dict>
+            Request the settings came with, answered if it has a sequence number.
+        client_address: <tuple>
+            Address of the client from which the request came from.
+        shot_changed: <bool>
+            True if the request changed `shot_micros`, which is acknowledged as a change too.
+        '''
+        loop = asyncio.get_running_loop()
+        applied = loop.run_in_executor(self.executor, self.setup_spec, trig_val, int_time_micros)
+
+        def settings_applied(future):
+            error = future.exception()
+            if error is not None:
+                print("Could not apply settings {}: {}".format((trig_val, int_time_micros), error))
+                if request is not None:
+                    self.acknowledge(request, client_address, ok=False, error=str(error))
+                return
+            changed = future.result()
+            if changed:
+                for reducer in self.reducers.values():
+                    reducer.reset()
+            if request is not None:
+                self.acknowledge(request, client_address, changed=changed or shot_changed, settings=self.settings)
+
+        applied.add_done_callback(settings_applied)
+
+    def acquire(self):
+        '''Gets the intensities of one spectrum and the time they were acquired.
+
+        Blocks for the integration time, so it runs on the spectrometer's executor.
+
+        Returns
+        -------
+        frame: <tuple>
+            (intensities, timestamp)
+        '''
+        intensities = SpecInfo.get_intensities(self)
+        return intensities, time.time()
+
+    def acquire_burst(self):
+        '''Captures one shot into the next preallocated block, see `SpecInfo.get_burst`.
+
+        The shot has as many spectra as integration times fit into `shot_micros`. Blocks are only
+        allocated again when that number or the pixel count changes.
+
+        Returns
+        -------
+        burst: <tuple>
+            (spectra, timestamps), one row and timestamp per spectrum.
+        '''
+        spectra = max(1, -(-self.shot_micros // self.int_time_micros))
+        self.burst_block ^= 1
+        block = self.burst_blocks[self.burst_block]
+        if block is None or block[0].shape != (spectra, len(self.wavelengths)):
+            block = self.burst_blocks[self.burst_block] = (np.empty((spectra, len(self.wavelengths))),
+                                                           np.empty(spectra))
+        return SpecInfo.get_burst(self, *block)
+
+    def set_burst(self, spectra, timestamps):
+        '''Makes a shot the current burst, and its last spectrum the current frame.
+
+        Subscribers with a reduction or products, and clients asking for a single frame, get the
+        last spectrum of every shot, everyone else gets the whole burst (see `send_burst`).
+        '''
+        self.set_frame(spectra[-1], timestamps[-1])
+        self.burst = (spectra, timestamps)
+        self.burst_id = (self.burst_id + 1) & 0xffffffff
 
-        # Sending over 0 bytes so recv loop knows when to stop
-        b0 = b""
-        self.sock.sendto(b0, client_address)
+    @timed('send')
+    def send_burst(self, client_address):
+        '''Sends the current burst as one compressed `MSG_BURST` frame, encoded once for every client.
 
-        # Sending over shape for reshaping
-        self.sock.sendto(b"%a" % self.shape, client_address)
+        Parameters
+        ----------
+        client_address: <tuple>
+            Address that receives the burst.
+        '''
+        spectra, timestamps = self.burst
+        chunk_size = self.chunk_size_for(client_address)
+        datagrams = self.encoded.get((MSG_BURST, chunk_size))
+        if datagrams is None:
+            encoded = self.payloads.get(MSG_BURST)
+            if encoded is None:
+                encoded = self.payloads[MSG_BURST] = encode_burst(spectra, timestamps, BURST_ZLIB_LEVEL)
+            flags, dtype, payload = encoded
+            datagrams = self.encoded[MSG_BURST, chunk_size] = pack_frame(
+                payload, self.burst_id, dtype, spectra.shape, timestamps[0], chunk_size, self.stream_id,
+                msg_type=MSG_BURST, axis_id=self.axis_id, flags=flags, device=self.device_index)
+        datagrams = self.add_fec((MSG_BURST, chunk_size), datagrams, self.fec.get(client_address))
+        self.send_datagrams(datagrams, client_address)
+
+    def set_frame(self, intensities, timestamp):
+        '''Makes `intensities` the current frame that `get_datagrams` encodes.
+
+        Kept apart from `spectrum_data`, which the next acquisition overwrites while this frame is sent.
+        '''
+        self.intensities = intensities
+        self.timestamp = timestamp
+        self.shape = list(intensities.shape)
+        self.frame_id = (self.frame_id + 1) & 0xffffffff
+        self.frames_acquired += 1
+        self.payloads.clear()
+        self.encoded.clear()
+        self.burst = None
+
+    async def stream_frames(self):
+        '''Acquires and sends frames back to back for as long as anyone is subscribed.
+
+        Frames are sent at the spectrometer's own rate instead of one per client request. The
+        next acquisition starts before the current frame is encoded and sent, so the device never
+        waits on the network. Every frame is acquired once and sent to each unicast subscriber,
+        to everyone waiting for a single frame and, if anyone joined it, once to the multicast group.
+        In burst mode (see `bursting`) every trigger is a whole shot, sent as one burst.
+        '''
+        loop = asyncio.get_running_loop()
+        acquisition = None
+        streaming = bool(self.subscriptions)
+        while True:
+            if self.subscriptions.expire():
+                self.forget_destinations()
+            if not self.subscriptions and not self.one_shot:
+                break
+            if acquisition is None:
+                acquisition = loop.run_in_executor(self.executor, self.acquire_burst if self.bursting else self.acquire)
+            try:
+                intensities, timestamp = await acquisition
+            except Exception as e:
+                # The device failed (a USB error, an unplugged spectrometer), the clients stay subscribed
+                print("Acquisition on {} failed: {!r}".format(self.serial_number, e))
+                acquisition = None
+                await self.recover()
+                continue
+            acquisition = None
+            if self.subscriptions:
+                acquisition = loop.run_in_executor(self.executor, self.acquire_burst if self.bursting else self.acquire)
+            if intensities.ndim == 2:
+                self.set_burst(intensities, timestamp)
+            else:
+                self.set_frame(intensities, timestamp)
+
+            destinations = self.subscriptions.destinations()
+            # Each reduction in use is applied once, between acquisition and encoding
+            self.reduce_frame({reduction for _, _, reduction, products in destinations
+                               if reduction is not None and products is None})
+            in_use = {products for _, _, _, products in destinations}
+            for key in [key for key in self.products if key not in in_use]:
+                del self.products[key]
+            if self.multicast_group is not None and self.subscriptions.multicast_count():
+                # Published once, however many clients joined the group
+                destinations.append((self.multicast_group, self.multicast_codec, None, None))
+            for data_address, codec, reduction, products in destinations:
+                try:
+                    if products is not None:
+                        self.send_products(data_address, products)
+                        continue
+                    if self.axis_id != self.sent_axis_id:
+                        self.send_axis(data_address, reduction)
+                    if self.burst is not None and reduction is None:
+                        self.send_burst(data_address)
+                    else:
+                        self.send_data(data_address, codec, reduction)
+                except OSError as e:
+                    self.send_failed(data_address, e)
+            self.sent_axis_id = self.axis_id
+
+            one_shot, self.one_shot = self.one_shot, []
+            for client_address in one_shot:
+                try:
+                    self.send_axis(client_address)
+                    self.send_data(client_address)
+                    print("Data has been sent.")
+                except OSError as e:
+                    self.send_failed(client_address, e)
+        if acquisition is not None:
+            await acquisition
+        if streaming:
+            print("No subscribers left, waiting for requests.")
+
+    def start(self):
+        '''Creates the acquisition executor and the event that wakes `run`.
+
+        Called before the control socket is opened, so no request finds them missing.
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=str(self.serial_number))
+        self.wake = asyncio.Event()
+
+    async def run(self):
+        '''Streams frames whenever clients ask for them, until cancelled.
+
+        An error of the device (a USB error, an unplugged spectrometer) only pauses this device's
+        stream until it is reopened (see `recover`), and a destination that can not be sent to is
+        skipped (see `send_failed`). Anything else is logged and streaming starts over after
+        `REOPEN_DELAY` seconds. The other devices of a `SpecServer` keep streaming either way.
+        '''
+        try:
+            while True:
+                await self.wake.wait()
+                self.wake.clear()
+                try:
+                    await self.stream_frames()
+                except Exception as e:
+                    print("Streaming from {} failed: {!r}".format(self.serial_number, e))
+                    await asyncio.sleep(REOPEN_DELAY)
+                    self.wake.set()
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def recover(self):
+        '''Reopens the device every `REOPEN_DELAY` seconds until it works.'''
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(REOPEN_DELAY)
+            try:
+                await loop.run_in_executor(self.executor, self.reopen)
+            except Exception as e:
+                print("Could not reopen {}: {!r}".format(self.serial_number, e))
+                continue
+            print("{} reopened.".format(self.serial_number))
+            return
+
+    def send_failed(self, address, error):
+        '''Counts a frame that could not be sent to `address`, which is only logged the first time.'''
+        self.send_errors += 1
+        if address not in self.failed_destinations:
+            self.failed_destinations.add(address)
+            print("Could not send to {}: {!r}".format(address, error))
+
+    def reopen(self):
+        '''Closes and opens the device again and puts its settings back. Runs on the executor.'''
+        settings = (self.trig_val, self.int_time_micros)
+        try:
+            self.close_spectrometer()
+        except Exception as e:
+            # A device that is gone can not be closed
+            print("Could not close {}: {!r}".format(self.serial_number, e))
+        self.open_spectrometer()
+        self.setup_spec(*settings)
+
+    async def serve(self):
+        '''Serves clients until cancelled.
+
+        Control messages from any number of clients are handled by `ControlProtocol` on a
+        persistent socket bound to `address`, while frames are acquired on a single thread
+        executor so the blocking seabreeze calls never stall the event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        self.start()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: ControlProtocol(self), local_addr=tuple(self.address))
+        print("Listening on {}.".format(tuple(self.address)))
+        try:
+            await self.run()
+        finally:
+            self.transport.close()
+
+
+class SpecServer:
+    '''Serves every spectrometer on the host from one control socket.
+
+    Each spectrometer has its own `SendSpecData`, with its own acquisition thread, subscribers and
+    settings, so devices are read in parallel instead of one after another. Frames carry the index
+    of their device in the header. Requests pick a device by serial number or index with a
+    `"device"` key and go to the first device without one, like on a single device server.
+
+    Attributes
+    ----------
+    senders (list): One `SendSpecData` per spectrometer.
+    address (tuple): (IP, port) of the control socket.
+    '''
+    def __init__(self, senders, address):
+        '''Constructor for SpecServer class.
+
+        Parameters
+        ----------
+        senders: <list>
+            One `SendSpecData` per spectrometer, in the order of their device index.
+        address: <tuple>
+            (IP, port) of the control socket.
+        '''
+        self.senders = senders
+        self.address = address
+        self.transport = None
+        # One stream id for the whole server, so a client can receive several devices on one socket
+        for index, sender in enumerate(senders):
+            sender.device_index = index
+            sender.stream_id = senders[0].stream_id
+
+    def find(self, device):
+        '''The `SendSpecData` of a device given by serial number or index.'''
+        if isinstance(device, int):
+            if not 0 <= device < len(self.senders):
+                raise ControlError("No device {}".format(device))
+            return self.senders[device]
+        for sender in self.senders:
+            if sender.serial_number == device:
+                return sender
+        raise ControlError("No device {!r}".format(device))
+
+    def handle_request(self, received_data, client_address):
+        '''Hands a request to the device it is for.
+
+        `"devices"` is answered with the serial numbers of all devices, in the order of their index.
+        Keepalives and unsubscribes without a device are for every device the client streams from.
+
+        Parameters
+        ----------
+        received_data: <bytes>
+            Datagram received on the control socket.
+        client_address: <tuple>
+            Address of the client from which the data came from.
+        '''
+        try:
+            request = parse_request(received_data)
+        except ValueError as e:
+            print("Ignoring request from {}: {}".format(client_address, e))
+            if isinstance(e, ControlError) and e.request is not None:
+                self.senders[0].acknowledge(e.request, client_address, ok=False, error=str(e))
+            return
+        if request["cmd"] == "devices":
+            devices = [sender.serial_number for sender in self.senders]
+            self.transport.sendto(make_ack(request, devices=devices), client_address)
+            return
+        try:
+            if "device" in request:
+                self.find(request["device"]).apply_request(request, client_address)
+                return
+            subscribed = [sender for sender in self.senders if client_address in sender.subscriptions]
+            if request["cmd"] in ("next", "keepalive", "unsubscribe") and subscribed:
+                for sender in subscribed:
+                    sender.apply_request(request, client_address)
+            else:
+                self.senders[0].apply_request(request, client_address)
+        except (ControlError, KeyError, TypeError) as e:
+            print("Could not apply {!r} from {}: {}".format(request, client_address, e))
+            self.senders[0].acknowledge(request, client_address, ok=False, error=str(e))
+
+    async def serve(self):
+        '''Serves clients until cancelled, streaming from every device at the same time.'''
+        loop = asyncio.get_running_loop()
+        for sender in self.senders:
+            sender.start()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: ControlProtocol(self), local_addr=tuple(self.address))
+        # Every device answers out of the shared control socket
+        for sender in self.senders:
+            sender.transport = self.transport
+        print("Listening on {} for {}.".format(tuple(self.address),
+                                               ", ".join(str(sender.serial_number) for sender in self.senders)))
+        try:
+            await asyncio.gather(*(sender.run() for sender in self.senders))
+        finally:
+            self.transport.close()
+
+
+class ControlProtocol(asyncio.DatagramProtocol):
+    '''Hands every datagram that arrives on the control socket to `handle_request` of the server.'''
+    def __init__(self, sender):
+        '''Constructor for ControlProtocol class.
+
+        Parameters
+        ----------
+        sender: <class 'SendSpecData'> or <class 'SpecServer'>
+        '''
+        self.sender = sender
 
-        #self.sock.close()
+    def datagram_received(self, data, addr):
+        try:
+            self.sender.handle_request(data, addr)
+        except (ValueError, KeyError, TypeError) as e:
+            # A malformed request must not take the server down for everyone else
+            print("Bad request from {}: {!r}".format(addr, e))
+        except OSError as e:
+            # e.g. the axis or a single frame could not be sent to the address the request came from
+            print("Could not answer {}: {!r}".format(addr, e))
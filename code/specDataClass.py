@@ -1,27 +1,70 @@
-from seabreeze.spectrometers import Spectrometer, list_devices
 import zlib
+import time
 import numpy as np
+from metrics import timed
 
-class SpecInfo(Spectrometer):
+# seabreeze is only needed for real devices, the simulated one in spec_simulator.py runs without it
+try:
+    from seabreeze.spectrometers import Spectrometer, list_devices
+except ImportError:
+    Spectrometer = list_devices = None
+
+
+def open_devices():
+    '''Opens every OceanInsight device attached to this host.
+
+    Returns
+    -------
+    devices: <list>
+        One `seabreeze.spectrometers.Spectrometer` per device, ready to pass to `SpecInfo`.
+    '''
+    if Spectrometer is None:
+        raise RuntimeError("seabreeze is not installed, pass a simulated device instead")
+    return [Spectrometer(device) for device in list_devices()]
+
+class SpecInfo:
     '''Initializes OceanInsight device and obtains spectrum data using python-seabreeze library.
     
-    Inherits Spectrometer class from seabreeze.spectrometers.
+    The device is a backend with the interface of `seabreeze.spectrometers.Spectrometer`
+    (`trigger_mode`, `integration_time_micros`, `intensities`, `wavelengths`, `spectrum`,
+    `open` and `close`), e.g. `spec_simulator.SimulatedSpectrometer` when there is no hardware.
+
+    The settings last sent to the device are cached, so asking for the same settings again does
+    not cost any USB transfers.
+
+    Attributes
+    ----------
+    trig_val (int): Trigger mode on the device, None until it is set.
+    int_time_micros (int): Integration time on the device in microseconds, None until it is set.
     '''
-    def __init__(self):
+    def __init__(self, device=None):
         '''Constructor for SpecInfo class.
         
-        Initializes Spectrometer class from seabreeze.spectrometers.
+        Parameters
+        ----------
+        device: <object>
+            Spectrometer backend to use. None opens the first OceanInsight device found by seabreeze.
         '''
         # Initializing spectrometer device
-        device = list_devices()[0]
-        Spectrometer.__init__(self, device)
-        self.spectrometer = Spectrometer(device)
+        if device is None:
+            if Spectrometer is None:
+                raise RuntimeError("seabreeze is not installed, pass a simulated device instead")
+            device = Spectrometer(list_devices()[0])
+        self.spectrometer = device
+        self.serial_number = device.serial_number
+        self.trig_val = None
+        self.int_time_micros = None
         
         # Initializing spectrum data
         self.spectrum_data = np.array([[]])
 
+        # The wavelength axis is a fixed calibration, so it is read once and cached
+        self.wavelengths = np.array([])
+        self.axis_id = 0
+        self.get_wavelengths()
+
     def setup_spec(self, trig_val, int_time_ms):
-        '''Sets trigger mode and integration time.
+        '''Sets trigger mode and integration time, only sending the ones that changed to the device.
         
         Parameters
         ----------
@@ -29,15 +72,35 @@ class SpecInfo(Spectrometer):
             normal = 0\n
             level/software = 1\n
             synchronization = 2\n
-            edge/hardware = 3
+            edge/hardware = 3\n
+            None keeps the current trigger mode.
         
         int_time_ms: <int>
-            Integration time in microseconds.
+            Integration time in microseconds, None keeps the current one.
+
+        Returns
+        -------
+        changed: <bool>
+            True if the device was reconfigured.
         '''
-        self.spectrometer.trigger_mode(trig_val)
-        self.spectrometer.integration_time_micros(int_time_ms)
+        changed = False
+        if trig_val is not None and trig_val != self.trig_val:
+            self.spectrometer.trigger_mode(trig_val)
+            self.trig_val = trig_val
+            changed = True
+        if int_time_ms is not None and int_time_ms != self.int_time_micros:
+            self.spectrometer.integration_time_micros(int_time_ms)
+            self.int_time_micros = int_time_ms
+            changed = True
+        return changed
+
+    @property
+    def settings(self):
+        '''Settings on the device, as a dictionary with `trig_val` and `int_time_micros`.'''
+        return {"trig_val": self.trig_val, "int_time_micros": self.int_time_micros}
 
     # Gets spectrometer data using seabreeze's spectrum() function
+    @timed('acquire')
     def get_spec(self):
         '''This function obtains data (intensity and wavelength) from the spectrometer.
         
@@ -51,6 +114,75 @@ class SpecInfo(Spectrometer):
         spec = self.spectrometer
         self.spectrum_data = spec.spectrum()
         return self.spectrum_data
+
+    @timed('acquire')
+    def get_intensities(self):
+        '''Obtains only the intensities from the spectrometer.
+
+        The wavelengths are left out because they never change between spectra, see `get_wavelengths`.
+
+        Returns
+        -------
+        spectrum_data: <numpy.ndarray>
+            1D array of intensities.
+        '''
+        spec = self.spectrometer
+        self.spectrum_data = spec.intensities()
+        return self.spectrum_data
+
+    @timed('burst')
+    def get_burst(self, spectra, timestamps):
+        '''Acquires one shot of back to back spectra into a preallocated block.
+
+        The first scan waits for the trigger edge of trigger mode 3. For the rest of the shot the
+        device runs free in trigger mode 0, so scans follow each other at the detector's full rate
+        instead of each waiting for an edge, and it goes back to trigger mode 3 for the next shot.
+
+        Only the first spectrum of a shot is synchronized to the hardware trigger, the others are
+        free-running and their timestamps are the only record of when they were taken. Switching
+        the trigger mode costs two extra USB transfers per shot, and the settings cache (see
+        `setup_spec`) keeps `trig_val` at 3 throughout, since it describes the configuration
+        rather than the mode the device is in during a shot. If switching back fails, the error
+        reaches the server, which reopens the device and sends its settings again.
+
+        Parameters
+        ----------
+        spectra: <numpy.ndarray>
+            2D array with one row per spectrum of the shot, overwritten.
+        timestamps: <numpy.ndarray>
+            Overwritten with the time every scan was read, in seconds since the epoch.
+
+        Returns
+        -------
+        spectra: <numpy.ndarray>
+        timestamps: <numpy.ndarray>
+        '''
+        spec = self.spectrometer
+        spectra[0] = spec.intensities()
+        timestamps[0] = time.time()
+        if len(spectra) > 1:
+            spec.trigger_mode(0)
+            try:
+                for row in range(1, len(spectra)):
+                    spectra[row] = spec.intensities()
+                    timestamps[row] = time.time()
+            finally:
+                spec.trigger_mode(self.trig_val)
+        self.spectrum_data = spectra[-1]
+        return spectra, timestamps
+
+    def get_wavelengths(self):
+        '''Reads the wavelength axis from the device and updates `axis_id` if the calibration changed.
+
+        Returns
+        -------
+        wavelengths: <numpy.ndarray>
+            1D array of wavelengths.
+        '''
+        spec = self.spectrometer
+        self.wavelengths = np.ascontiguousarray(spec.wavelengths(), dtype=np.float64)
+        self.axis_id = zlib.crc32(self.wavelengths.tobytes())
+        return self.wavelengths
         
     def get_shape(self):
         '''Gets the shape of the 2D numpy array for the spectrum.
@@ -63,6 +195,7 @@ class SpecInfo(Spectrometer):
         return shape
     
     # Compresses spectrometer data for easy sending
+    @timed('compress')
     def get_spec_compressed(self):
         '''Compresses spectrum data from getSpec() method for easy sending.
 
@@ -80,4 +213,8 @@ class SpecInfo(Spectrometer):
 
     def open_spectrometer(self):
         spec = self.spectrometer
-        spec.open()
\ No newline at end of file
+        spec.open()
+        # Calibration could be different after reopening, and the settings are the device's defaults again
+        self.get_wavelengths()
+        self.trig_val = None
+        self.int_time_micros = None
\ No newline at end of file
@@ -0,0 +1,223 @@
+import time
+import zlib
+import numpy as np
+from metrics import timed
+
+# Codec names a client can ask for when subscribing
+CODECS = ('raw', 'float32', 'uint16', 'delta')
+
+# How the values in a frame are stored, written to the `codec` field of the header
+CODEC_PLAIN = 0  # the values themselves, in the dtype of the header
+CODEC_DELTA = 1  # difference to the frame with the previous frame id
+
+# Bits of the `flags` field of the header
+FLAG_ZLIB = 1
+
+
+def as_counts(intensities):
+    '''Returns the intensities as uint16 if that is lossless, otherwise None.
+
+    Most spectrometers report raw ADC counts, which always fit. Devices that apply
+    nonlinearity or dark corrections return fractional values, which do not.
+    '''
+    counts = intensities.astype(np.uint16)
+    if np.array_equal(counts, intensities):
+        return counts
+    return None
+
+
+class SpecEncoder:
+    '''Encodes the intensities of consecutive frames for one session.
+
+    Codecs
+    ------
+    raw: float64 values as they come from the spectrometer.\n
+    float32: values rounded to float32, half the size.\n
+    uint16: lossless ADC counts, a quarter of the size. Falls back to raw for frames that are not integer counts.\n
+    delta: uint16 keyframes followed by int16 differences to the previous frame, which compress well with zlib.
+
+    Attributes
+    ----------
+    codec (str): One of `CODECS`.
+    zlib_level (int): zlib compression level for every frame, None for no compression.
+    keyframe_interval (float): Maximum number of seconds between keyframes in `delta` mode.
+    '''
+    def __init__(self, codec='raw', zlib_level=None, keyframe_interval=0.5):
+        '''Constructor for SpecEncoder class.
+
+        Parameters
+        ----------
+        codec: <str>
+            One of `CODECS`.
+        zlib_level: <int>
+            zlib compression level (0-9, -1 for the zlib default). None sends the data uncompressed.
+        keyframe_interval: <float>
+            Maximum number of seconds between keyframes in `delta` mode, so new or unlucky
+            clients never wait long for a frame they can decode.
+        '''
+        if codec not in CODECS:
+            raise ValueError("Unknown codec {!r}, choose from {}".format(codec, CODECS))
+        self.codec = codec
+        self.zlib_level = zlib_level
+        self.keyframe_interval = keyframe_interval
+        self.previous = None
+        self.previous_id = None
+        self.last_keyframe = 0.0
+
+    def force_keyframe(self):
+        '''Makes the next `delta` frame a keyframe, e.g. when a client joins.'''
+        self.previous = None
+
+    @timed('encode')
+    def encode(self, intensities, frame_id):
+        '''Encodes one frame.
+
+        Parameters
+        ----------
+        intensities: <numpy.ndarray>
+            1D array of intensities.
+        frame_id: <int>
+            Frame id the payload is sent with. Deltas are only taken against the frame right before it.
+
+        Returns
+        -------
+        codec_id: <int>
+            `CODEC_PLAIN` or `CODEC_DELTA`.
+        flags: <int>
+            `FLAG_ZLIB` if the payload is compressed.
+        dtype: <numpy.dtype>
+            dtype of the values in the payload.
+        payload: <bytes>
+        '''
+        codec_id = CODEC_PLAIN
+        if self.codec == 'float32':
+            values = intensities.astype('<f4')
+        elif self.codec == 'raw':
+            values = intensities.astype('<f8', copy=False)
+        else:
+            counts = as_counts(intensities)
+            values = counts if counts is not None else intensities.astype('<f8', copy=False)
+            if self.codec == 'delta':
+                values, codec_id = self._delta(counts, frame_id, values)
+
+        payload = values.tobytes()
+        flags = 0
+        if self.zlib_level is not None:
+            payload = zlib.compress(payload, self.zlib_level)
+            flags |= FLAG_ZLIB
+        return codec_id, flags, values.dtype, payload
+
+    def _delta(self, counts, frame_id, values):
+        '''Turns `values` into a difference to the previous frame when possible.'''
+        previous, previous_id = self.previous, self.previous_id
+        self.previous = None if counts is None else counts.astype(np.int32)
+        self.previous_id = frame_id
+        now = time.monotonic()
+        if (counts is not None and previous is not None and previous_id == (frame_id - 1) & 0xffffffff
+                and now - self.last_keyframe < self.keyframe_interval):
+            difference = self.previous - previous
+            if difference.min() >= -32768 and difference.max() <= 32767:
+                return difference.astype('<i2'), CODEC_DELTA
+        self.last_keyframe = now
+        return values, CODEC_PLAIN
+
+
+class SpecDecoder:
+    '''Decodes frames made by `SpecEncoder`, whatever codec the session uses.
+
+    Every frame says in its header how it was encoded, so the decoder needs no settings.
+    '''
+    def __init__(self):
+        '''Constructor for SpecDecoder class.'''
+        self.reset()
+
+    def reset(self):
+        '''Forgets the reference frame for deltas.'''
+        self.previous = None
+        self.previous_id = None
+
+    @timed('decode')
+    def decode(self, frame):
+        '''Decodes one frame.
+
+        Parameters
+        ----------
+        frame: <class 'protocol.Frame'>
+
+        Returns
+        -------
+        intensities: <numpy.ndarray> or None
+            1D float64 array, or None for a delta frame whose reference frame was lost.
+        '''
+        payload = zlib.decompress(frame.payload) if frame.flags & FLAG_ZLIB else frame.payload
+        values = np.frombuffer(payload, dtype=frame.dtype)
+        previous, previous_id = self.previous, self.previous_id
+        self.previous, self.previous_id = None, frame.frame_id
+
+        if frame.codec == CODEC_DELTA:
+            if previous is None or previous_id != (frame.frame_id - 1) & 0xffffffff:
+                return None
+            counts = previous + values
+        elif values.dtype == np.uint16:
+            counts = values.astype(np.int32)
+        else:
+            return values.astype(np.float64)
+        self.previous = counts
+        return counts.astype(np.float64)
+
+
+def encode_burst(spectra, timestamps, zlib_level=1):
+    '''Encodes the spectra of one shot into the payload of one `protocol.MSG_BURST` frame.
+
+    The payload is the float64 timestamp of every spectrum followed by the spectra as one block,
+    as lossless uint16 counts where possible. Spectra of one shot are alike, so the whole block is
+    compressed at once.
+
+    Parameters
+    ----------
+    spectra: <numpy.ndarray>
+        2D array with one spectrum per row.
+    timestamps: <numpy.ndarray>
+        Acquisition time of every spectrum in seconds since the epoch.
+    zlib_level: <int>
+        zlib compression level, None sends the block uncompressed.
+
+    Returns
+    -------
+    flags: <int>
+        `FLAG_ZLIB` if the payload is compressed.
+    dtype: <numpy.dtype>
+        dtype of the spectra in the payload.
+    payload: <bytes>
+    '''
+    counts = as_counts(spectra)
+    values = counts if counts is not None else spectra.astype('<f8', copy=False)
+    payload = timestamps.astype('<f8', copy=False).tobytes() + values.tobytes()
+    flags = 0
+    if zlib_level is not None:
+        payload = zlib.compress(payload, zlib_level)
+        flags |= FLAG_ZLIB
+    return flags, values.dtype, payload
+
+
+@timed('decode')
+def decode_burst(frame):
+    '''Decodes a `protocol.MSG_BURST` frame made by `encode_burst`.
+
+    Parameters
+    ----------
+    frame: <class 'protocol.Frame'>
+        Its shape is (spectra, pixels).
+
+    Returns
+    -------
+    timestamps: <numpy.ndarray>
+        Acquisition time of every spectrum in seconds since the epoch.
+    spectra: <numpy.ndarray>
+        2D float64 array with one spectrum per row.
+    '''
+    payload = zlib.decompress(frame.payload) if frame.flags & FLAG_ZLIB else frame.payload
+    rows = frame.shape[0]
+    timestamps = np.frombuffer(payload, dtype='<f8', count=rows).copy()
+    spectra = np.frombuffer(payload, dtype=frame.dtype, offset=8 * rows).reshape(frame.shape)
+    return timestamps, spectra.astype(np.float64)
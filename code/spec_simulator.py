@@ -0,0 +1,157 @@
+import threading
+import time
+import numpy as np
+
+# Emission lines of the default simulated source: (wavelength in nm, counts per ms of integration, FWHM in nm)
+DEFAULT_PEAKS = [(404.7, 300.0, 1.5), (435.8, 900.0, 1.5), (546.1, 1200.0, 1.5), (577.0, 250.0, 1.5),
+                 (579.1, 250.0, 1.5), (696.5, 150.0, 2.0), (763.5, 500.0, 2.0), (811.5, 350.0, 2.0)]
+
+
+class SimulatedSpectrometer:
+    '''Stands in for `seabreeze.spectrometers.Spectrometer` when there is no device on USB.
+
+    Has the methods `SpecInfo` uses, takes as long as a real device to return a spectrum and
+    returns float64 ADC counts: a dark baseline, Gaussian peaks that grow with the integration
+    time, shot noise and read noise.
+
+    Trigger modes
+    -------------
+    0, 1, 2: Free running. Scans are back to back, `intensities` returns the next one that completes.\n
+    3: Edge/hardware. Every scan waits for `trigger()`, or for the next tick of `trigger_period`.
+
+    Attributes
+    ----------
+    pixels (int): Number of pixels (and wavelengths) in a spectrum.
+    peaks (list): `(wavelength, counts per ms, FWHM)` of every peak.
+    noise (bool): Adds shot and read noise if True, otherwise spectra are identical.
+    dark (float): Counts of the dark baseline.
+    read_noise (float): Standard deviation of the read noise in counts.
+    max_counts (int): Saturation level.
+    trigger_period (float): Seconds between simulated hardware triggers, None to only use `trigger()`.
+    '''
+    model = "SIMULATED"
+    integration_time_micros_limits = (1000, 10000000)
+
+    def __init__(self, pixels=2048, wavelength_range=(200.0, 1100.0), peaks=None, noise=True, dark=1500.0,
+                 read_noise=8.0, max_counts=65535, trigger_period=None, seed=None, serial_number=None):
+        '''Constructor for SimulatedSpectrometer class.
+
+        Parameters
+        ----------
+        pixels: <int>
+            Number of pixels in a spectrum.
+        wavelength_range: <tuple>
+            (first, last) wavelength in nm.
+        peaks: <list>
+            `(wavelength, counts per ms, FWHM)` tuples, `DEFAULT_PEAKS` if None.
+        noise: <bool>
+            Adds Poisson shot noise and Gaussian read noise if True.
+        dark: <float>
+            Counts of the dark baseline.
+        read_noise: <float>
+            Standard deviation of the read noise in counts.
+        max_counts: <int>
+            Counts are clipped to this, like a saturated detector.
+        trigger_period: <float>
+            Seconds between simulated hardware triggers in trigger mode 3, None to only use `trigger()`.
+        seed: <int>
+            Seed of the noise, for reproducible runs.
+        serial_number: <str>
+            Serial number the device reports, made up from the pixel count if None.
+        '''
+        self.pixels = pixels
+        self.peaks = DEFAULT_PEAKS if peaks is None else peaks
+        self.noise = noise
+        self.dark = dark
+        self.read_noise = read_noise
+        self.max_counts = max_counts
+        self.trigger_period = trigger_period
+        self.serial_number = serial_number or "SIM{:05d}".format(pixels)
+        self.rng = np.random.default_rng(seed)
+        self._wavelengths = np.linspace(wavelength_range[0], wavelength_range[1], pixels)
+        # Counts per microsecond of every pixel, without the dark baseline
+        self._signal = np.zeros(pixels)
+        for center, height, fwhm in self.peaks:
+            sigma = fwhm / 2.3548
+            self._signal += height / 1000.0 * np.exp(-0.5 * ((self._wavelengths - center) / sigma) ** 2)
+        self._mode = 0
+        self._integration_time = 0.1
+        self._scan_start = time.monotonic()
+        self._triggered = threading.Event()
+        self._open = True
+
+    def open(self):
+        '''Opens the simulated device.'''
+        self._open = True
+        self._scan_start = time.monotonic()
+
+    def close(self):
+        '''Closes the simulated device.'''
+        self._open = False
+
+    def trigger_mode(self, mode):
+        '''Sets the trigger mode, see the class docstring.'''
+        if mode not in (0, 1, 2, 3):
+            raise ValueError("Unsupported trigger mode {}".format(mode))
+        self._mode = mode
+        self._triggered.clear()
+
+    def integration_time_micros(self, integration_time_micros):
+        '''Sets the integration time. Scans restart, as on a real device.'''
+        low, high = self.integration_time_micros_limits
+        if not low <= integration_time_micros <= high:
+            raise ValueError("Integration time {} us is outside {}".format(integration_time_micros, (low, high)))
+        self._integration_time = integration_time_micros / 1e6
+        self._scan_start = time.monotonic()
+
+    def trigger(self):
+        '''Fires one hardware trigger edge for trigger mode 3.'''
+        self._triggered.set()
+
+    def wavelengths(self):
+        '''Returns the wavelength axis in nm.'''
+        return self._wavelengths.copy()
+
+    def intensities(self):
+        '''Waits for the next scan and returns its counts.
+
+        Returns
+        -------
+        intensities: <numpy.ndarray>
+            1D float64 array of counts.
+        '''
+        if not self._open:
+            raise RuntimeError("Device {} is closed".format(self.serial_number))
+        if self._mode == 3:
+            self._wait_for_trigger()
+            time.sleep(self._integration_time)
+        else:
+            # Free running scans end every integration time after the last restart; a request
+            # gets the first scan that ends after it, like the device's own buffer would
+            now = time.monotonic()
+            scans = int((now - self._scan_start) // self._integration_time) + 1
+            time.sleep(max(0.0, self._scan_start + scans * self._integration_time - now))
+        return self._scan()
+
+    def spectrum(self):
+        '''Returns a 2D array with the wavelengths and the intensities of the next scan.'''
+        return np.vstack((self.wavelengths(), self.intensities()))
+
+    def _wait_for_trigger(self):
+        '''Blocks until `trigger()` is called or the next `trigger_period` tick.'''
+        if self.trigger_period is None:
+            self._triggered.wait()
+        else:
+            now = time.monotonic()
+            next_tick = (now // self.trigger_period + 1) * self.trigger_period
+            self._triggered.wait(next_tick - now)
+        self._triggered.clear()
+
+    def _scan(self):
+        '''Makes the counts of one scan with the current integration time.'''
+        expected = self._signal * (self._integration_time * 1e6)
+        if self.noise:
+            counts = self.rng.poisson(expected) + self.rng.normal(self.dark, self.read_noise, self.pixels)
+        else:
+            counts = expected + self.dark
+        return np.clip(np.rint(counts), 0, self.max_counts)